@@ -0,0 +1,92 @@
+"""
+Triggered transient capture
+Each channel keeps its last CAPTURE_DEPTH measurements, taken every control period, in a ring buffer.
+A trigger (safety trip, saturation, threshold crossing or host command) records CAPTURE_POST more samples,
+then freezes the buffer until the communication core has uploaded it
+"""
+import time
+import micropython
+from array import array
+from micropython import const
+from config import CAPTURE_DEPTH, CAPTURE_POST
+
+ARMED = const(0)
+TRIGGERED = const(1)  # Recording the post-trigger samples
+FROZEN = const(2)  # Waiting for the upload, nothing is recorded
+
+NO_THRESHOLD = const(0)
+THRESHOLD_I = const(1)
+THRESHOLD_V = const(2)
+
+
+class Capture:
+    """Pre-trigger ring buffer of one channel"""
+
+    def __init__(self):
+        self.t = array('i', [0] * CAPTURE_DEPTH)  # ticks_ms of each sample
+        self.i = array('f', [0.0] * CAPTURE_DEPTH)
+        self.v = array('f', [0.0] * CAPTURE_DEPTH)
+        self.index = 0  # Next sample position
+        self.count = 0  # Valid samples in the buffer
+        self.state = ARMED
+        self.post = 0  # Post-trigger samples still to record
+        self.reason = None
+        self.trigger_t = 0
+        self.threshold = NO_THRESHOLD  # Single-shot level crossing trigger
+        self.level = 0.0
+        self.above = -1  # Side of the level of the last sample, -1 before the first one
+
+    @micropython.native
+    def record(self, i, v) -> None:
+        """Add the measurements of one control period, None values are stored as nan"""
+        if self.state == FROZEN:
+            return
+        k = self.index
+        self.t[k] = time.ticks_ms()
+        self.i[k] = i if i is not None else float('nan')
+        self.v[k] = v if v is not None else float('nan')
+        self.index = (k + 1) % CAPTURE_DEPTH
+        if self.count < CAPTURE_DEPTH:
+            self.count += 1
+        if self.state == TRIGGERED:
+            self.post -= 1
+            if self.post <= 0:
+                self.state = FROZEN
+        elif self.threshold != NO_THRESHOLD:
+            x = i if self.threshold == THRESHOLD_I else v
+            if x is None:
+                return
+            above = 1 if x > self.level else 0
+            if self.above >= 0 and above != self.above:
+                self.threshold = NO_THRESHOLD
+                self.trigger('threshold')
+            self.above = above
+
+    def trigger(self, reason: str) -> bool:
+        """Start the post-trigger recording, False if a capture is already in progress"""
+        if self.state != ARMED:
+            return False
+        self.state = TRIGGERED
+        self.post = CAPTURE_POST
+        self.reason = reason
+        self.trigger_t = time.ticks_ms()
+        return True
+
+    def arm_threshold(self, field: int, level: float) -> None:
+        """Trigger once when the current (THRESHOLD_I) or the voltage (THRESHOLD_V) crosses level"""
+        self.threshold = field
+        self.level = level
+        self.above = -1
+
+    def samples(self):
+        """Yields (ms from the trigger, i, v) from the oldest sample"""
+        start = (self.index - self.count) % CAPTURE_DEPTH
+        for n in range(self.count):
+            k = (start + n) % CAPTURE_DEPTH
+            yield time.ticks_diff(self.t[k], self.trigger_t), self.i[k], self.v[k]
+
+    def rearm(self) -> None:
+        """Record again once the frozen buffer is uploaded, the pre-trigger history starts over"""
+        self.count = 0
+        self.reason = None
+        self.state = ARMED
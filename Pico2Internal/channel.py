@@ -0,0 +1,179 @@
+"""
+Channel state
+"""
+import time
+import micropython
+from config import DEFAULT_STREAM_FIELDS, PWM_RESOLUTION
+from capture import Capture
+
+
+class Pulse:
+    """
+    Pulsed mode of a channel: every Period control periods, the output is driven to the pulse level for Width us
+    and sampled Delay us after the pulse start. The pulse duty cycle is regulated from one pulse to the next,
+    the channel regulates to its usual setpoint (the base level) between pulses
+    """
+    __slots__ = ('SetPoint', 'Width', 'Delay', 'Period', 'Ticks', 'Duty', 'SeOld', 'Count',
+                 'Phase', 'Start', 'Device', 'Config')
+
+    def __init__(self, setpoint, width_us, delay_us, period_ticks, duty):
+        self.SetPoint = setpoint  # Pulse level, in the unit of the channel regulation mode
+        self.Width = width_us
+        self.Delay = delay_us
+        self.Period = period_ticks
+        self.Ticks = 0  # Control periods since the last pulse
+        self.Duty = duty  # Duty cycle applied during the pulses
+        self.SeOld = 0  # Q14 error signal of the previous pulse
+        self.Count = 0  # Number of pulses sampled
+        self.Phase = 0  # Phase of the pulse in progress, 0 between pulses (see advance_pulse() in main.py)
+        self.Start = 0  # ticks_us of the pulse start
+        self.Device = None  # INA3221 sampling the pulse, and its configuration to restore after the sample
+        self.Config = None
+
+
+class Aggregate:
+    """
+    Constant-memory accumulators of the measurements taken between two telemetry frames:
+    count, sums for the means, minimums and maximums of the current and the voltage
+    """
+    __slots__ = ('Count', 'ISum', 'IMin', 'IMax', 'VSum', 'VMin', 'VMax', 'PSum')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.Count = 0
+        self.ISum = 0.0
+        self.IMin = None
+        self.IMax = None
+        self.VSum = 0.0
+        self.VMin = None
+        self.VMax = None
+        self.PSum = 0.0
+
+    @micropython.native
+    def add(self, i, v):
+        if self.Count == 0:
+            self.IMin = self.IMax = i
+            self.VMin = self.VMax = v
+        else:
+            if i < self.IMin:
+                self.IMin = i
+            elif i > self.IMax:
+                self.IMax = i
+            if v < self.VMin:
+                self.VMin = v
+            elif v > self.VMax:
+                self.VMax = v
+        self.Count += 1
+        self.ISum += i
+        self.VSum += v
+        self.PSum += i*v
+
+    def mean(self, total):
+        """Mean of one of the sums, None without measurements"""
+        return total/self.Count if self.Count else None
+
+
+class Integrator:
+    """
+    Charge (mAh) and energy (mWh) delivered by a channel, integrated at every regulator reading
+    over the time elapsed since the previous one, measured in microseconds.
+    Floats are single precision on the pico: the sums are compensated (Kahan summation)
+    so that the tiny increments of a long run are not rounded away
+    """
+    __slots__ = ('Charge', 'Energy', 'Time', 'QErr', 'EErr', 'TErr', 'Last')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.Charge = 0.0
+        self.Energy = 0.0
+        self.Time = 0.0  # Integration time in seconds
+        self.QErr = 0.0
+        self.EErr = 0.0
+        self.TErr = 0.0
+        self.Last = None  # ticks_us of the previous reading
+
+    @micropython.native
+    def add(self, i, v):
+        now = time.ticks_us()
+        last = self.Last
+        self.Last = now
+        if last is None:
+            return
+        dt = time.ticks_diff(now, last)*1e-6
+        x = i*dt/3600 - self.QErr
+        total = self.Charge + x
+        self.QErr = (total - self.Charge) - x
+        self.Charge = total
+        x = i*v*dt/3600 - self.EErr
+        total = self.Energy + x
+        self.EErr = (total - self.Energy) - x
+        self.Energy = total
+        x = dt - self.TErr
+        total = self.Time + x
+        self.TErr = (total - self.Time) - x
+        self.Time = total
+
+
+class Channel:
+    """
+    State of one output channel
+    Attributes are looked up by name instead of the string keys of the former dictionnary.
+    MicroPython ignores __slots__: it only lists the attributes, and catches misspelled ones on CPython (simulator)
+    """
+    __slots__ = ('Name', 'V_SetPoint', 'I_SetPoint', 'MaxPower', 'V_Measured', 'I_Measured',
+                 'Range', 'Rshunt', 'ShuntRaw', 'BusRaw', 'Shunt', 'Bus', 'SpValue', 'SpShunt', 'SpCounts',
+                 'Load', 'Duty', 'SeOld', 'PushPullConnected', 'State', 'Alert', 'Errors', 'Fields',
+                 'Pulse', 'Characterizing', 'SettleStart', 'SettleCount', 'SettleFF', 'SettleSp', 'Settled', 'Capture', 'Aggregate', 'Integrator',
+                 'Activity', 'Requested', 'LastPoll',
+                 'SafetyRelayPin', 'SafetyRelayOn', 'SwitchPin', 'pwm',
+                 'HigIDevice', 'LowIDevice', 'BusId')
+
+    def __init__(self, name, safety_relay_pin, switch_pin, pwm, high_i_device, low_i_device, bus_id,
+                 push_pull_connected=False):
+        self.Name = name
+        self.V_SetPoint = 0  # Target voltage in volts
+        self.I_SetPoint = None  # Target current in milliamps
+        self.MaxPower = None
+        self.V_Measured = None
+        self.I_Measured = None
+        self.Range = None
+        self.Rshunt = None
+        self.ShuntRaw = None  # Last shunt and bus register counts, for the raw telemetry fields
+        self.BusRaw = None
+        self.Shunt = 0  # Register counts of the last regulator reading
+        self.Bus = 0
+        self.SpValue = None  # Setpoint and shunt SpCounts was computed for
+        self.SpShunt = None
+        self.SpCounts = 0  # Setpoint in register counts: mV, or shunt counts in current regulation
+        self.Load = []
+        self.Duty = PWM_RESOLUTION  # Like the PWM outputs at startup: 0 V after the inverter
+        self.SeOld = 0  # Error signal of the previous regulator iteration, Q14 (see fixedpid.py)
+        self.PushPullConnected = push_pull_connected
+        self.State = ''
+        self.Alert = None  # Reason of a safety trip not reported to the host yet
+        self.Errors = 0  # Control periods that failed in a row
+        self.Fields = DEFAULT_STREAM_FIELDS  # Fields of the channel sent in the telemetry stream
+        self.Pulse = None  # Pulsed mode settings, None for continuous regulation
+        self.Characterizing = False  # Regulation suspended while the duty cycle to voltage curve is measured
+        self.SettleStart = None  # Time of the last setpoint change, until the output settles
+        self.SettleCount = 0
+        self.SettleFF = False  # The last setpoint change used the feedforward lookup
+        self.SettleSp = None  # Setpoint of the last setpoint change
+        self.Settled = []  # (ms, feedforward, setpoint) of the settled changes not reported to the host yet, ms=-1 if it timed out
+        self.Capture = Capture()  # Pre-trigger buffer of the transient capture
+        self.Aggregate = Aggregate()  # Measurements since the last telemetry frame
+        self.Integrator = Integrator()  # Charge and energy since the last reset
+        self.Activity = 'monitor'  # 'active' (regulated), 'monitor' (measured at a reduced rate) or 'parked'
+        self.Requested = None  # Activity requested by the host, None to follow the push-pull switch
+        self.LastPoll = 0  # ticks_ms of the last reading of a monitored channel
+        self.SafetyRelayPin = safety_relay_pin
+        self.SafetyRelayOn = True
+        self.SwitchPin = switch_pin
+        self.pwm = pwm
+        self.HigIDevice = high_i_device
+        self.LowIDevice = low_i_device
+        self.BusId = bus_id
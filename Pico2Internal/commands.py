@@ -0,0 +1,166 @@
+"""
+Serial command reader
+Incoming bytes go to a fixed receive buffer per link, lines are tokenized in place
+and dispatched on pre-hashed tokens, so reading commands does not allocate
+"""
+import micropython
+from micropython import const
+import log
+
+RX_BUFFER_SIZE = const(256)
+MAX_TOKENS = const(6)
+_NEWLINE = const(10)
+
+# Link, buffer of the line being executed and start and end positions of its tokens
+source = None
+rx_buf = None
+rx_mv = None
+tok_start = [0] * MAX_TOKENS
+tok_end = [0] * MAX_TOKENS
+
+# Command handlers, keyed by the hash of the first token of the line
+commands = {}
+
+
+@micropython.viper
+def token_hash(buf: ptr8, start: int, end: int) -> int:
+    """djb2 hash of buf[start:end], masked to stay a small int"""
+    h = 5381
+    i = start
+    while i < end:
+        h = ((h << 5) + h + buf[i]) & 0x3FFFFFF
+        i += 1
+    return h
+
+
+def hash_of(token: str) -> int:
+    """Hash of a token given as a string, to build the dispatch tables"""
+    b = token.encode()
+    return token_hash(b, 0, len(b))
+
+
+def register(token: str, handler) -> None:
+    """
+    Register the handler of the lines starting with token
+    The handler is called as handler(context, ntok) and returns True if the command was processed
+    """
+    commands[hash_of(token)] = handler
+
+
+@micropython.native
+def tokenize(start: int, end: int) -> int:
+    """
+    Locate the space-separated tokens of rx_buf[start:end]
+    Returns the number of tokens, positions of the first MAX_TOKENS are stored in tok_start and tok_end
+    """
+    n = 0
+    i = start
+    while i < end:
+        while i < end and rx_buf[i] <= 32:
+            i += 1
+        if i >= end:
+            break
+        s = i
+        while i < end and rx_buf[i] > 32:
+            i += 1
+        if n < MAX_TOKENS:
+            tok_start[n] = s
+            tok_end[n] = i
+        n += 1
+    return n
+
+
+def token(n: int) -> int:
+    """Hash of the token n of the current line"""
+    return token_hash(rx_buf, tok_start[n], tok_end[n])
+
+
+def token_str(n: int) -> str:
+    """Token n as a string (allocates, only for values and messages)"""
+    return str(rx_mv[tok_start[n]:tok_end[n]], 'utf-8')
+
+
+def token_float(n: int, strip: int = 0) -> float:
+    """Token n converted to a float, ignoring the last strip characters"""
+    return float(str(rx_mv[tok_start[n]:tok_end[n] - strip], 'utf-8'))
+
+
+def token_int(n: int) -> int:
+    return int(str(rx_mv[tok_start[n]:tok_end[n]], 'utf-8'))
+
+
+def token_last_char(n: int) -> int:
+    return rx_buf[tok_end[n] - 1]
+
+
+def execute(context, start: int, end: int) -> None:
+    """Execute the command line rx_buf[start:end]"""
+    ntok = tokenize(start, end)
+    # Skip empty lines
+    if ntok == 0:
+        return
+    processed = False
+    try:
+        handler = commands.get(token(0))
+        if handler is not None:
+            processed = handler(context, ntok)
+    except Exception as e:
+        log.error("Error parsing command: %s", e)
+        processed = True
+    if not processed and log.enabled(log.WARN):
+        # As bytes: a line received at the wrong baud rate is not valid utf-8
+        log.warn("Unknown command: %s", bytes(rx_mv[start:end]))
+
+
+class CommandReader:
+    """Receive buffer of the commands coming from one link"""
+
+    def __init__(self, link):
+        self.link = link
+        self.buf = bytearray(RX_BUFFER_SIZE)
+        self.mv = memoryview(self.buf)
+        self.length = 0
+
+    def read(self, context) -> int:
+        """
+        Read the available bytes and execute every complete line of the buffer
+        An incomplete line is kept at the beginning of the buffer for the next call
+        Returns the number of executed lines
+        """
+        global source, rx_buf, rx_mv
+        n = self.link.any()
+        if not n:
+            return 0
+        if self.length == RX_BUFFER_SIZE:
+            log.warn("Command buffer overflow, dropping %d bytes", self.length)
+            self.length = 0
+        got = self.link.readinto(self.mv[self.length:], min(n, RX_BUFFER_SIZE - self.length))
+        if not got:
+            return 0
+        buf = self.buf
+        scan = self.length
+        self.length += got
+
+        executed = 0
+        start = 0
+        while scan < self.length:
+            if buf[scan] == _NEWLINE:
+                source, rx_buf, rx_mv = self.link, buf, self.mv
+                execute(context, start, scan)
+                executed += 1
+                start = scan + 1
+            scan += 1
+
+        # Keep the incomplete line at the start of the buffer
+        if start:
+            self.length = _shift(buf, start, self.length)
+        return executed
+
+
+@micropython.viper
+def _shift(buf: ptr8, start: int, length: int) -> int:
+    i = start
+    while i < length:
+        buf[i - start] = buf[i]
+        i += 1
+    return length - start
@@ -3,6 +3,13 @@ Constants and Pin definitions
 """
 
 PID_DT = 5  # Time in milliseconds between regulator updates
+PID_DT_FAST = 2  # Shorter period used when a single channel is regulated and none is pulsed
+# The PID works on increments with gains per period: at PID_DT_FAST the loop gain of the PID_K* values below is
+# 2.5 times higher and unstable (see python -m sim in Pico2Tools). Only enable it with gains validated for this period
+PID_DT_FAST_ENABLED = False
+MONITOR_PERIOD = 100  # Time in milliseconds between two readings of a monitored (not regulated) channel
+CONTROL_ON_CORE1 = True  # Run the regulators and safety checks on the second core, otherwise a hardware timer drives them on the first one
+CONTROL_ERROR_LIMIT = 10  # Control periods failing in a row on a channel before its safety relay is opened
 
 
 # INA3221 high-current wiring
@@ -26,12 +33,69 @@ PWM_PIN_CHA = 16  # PWM output for the first channel
 PWM_PIN_CHB = 17  # PWM output for the second channel
 PWM_PIN_CHC = 18  # PWM output for the third channel
 
+# Feedforward duty cycle lookup
+FF_FILE= 'feedforward.json' # Duty cycle to voltage curves of the channels, in flash
+FF_POINTS= 17 # Duty cycles measured by the characterization
+FF_SETTLE_MS= 100 # Time for the output and the INA3221 averaging to settle on each point
+FF_MAX_VOLTAGE= 6 # Highest output voltage of a characterization, whatever the limit of the command
+
+# Settling time report after a setpoint change
+SETTLE_TOLERANCE= 0.01 # Error below which the output is settled: volts, or relative error in current regulation
+SETTLE_PERIODS= 5 # Consecutive control periods within the tolerance
+SETTLE_TIMEOUT= 5000 # Time in milliseconds after which a setpoint change is reported as not settled
+SETTLE_REPORTS= 8 # Settling results kept for the host between two reports, the oldest are dropped
+
+# Transient capture
+CAPTURE_DEPTH= 200 # Samples kept per channel, one per control period
+CAPTURE_POST= 50 # Samples recorded after the trigger, the others precede it
+CAPTURE_CHUNK= 10 # Samples per line of the uploaded capture
+
+# Pulsed mode
+PULSE_MAX_WIDTH= 20 # Longest pulse in milliseconds
+PULSE_CONVERSION_US= 700 # Duration of the in-pulse single-shot conversion (shunt and bus, 332us each)
+PULSE_TIMER_MIN_US= 20 # Shortest wait of the pulse phase timer, a phase already due runs after it
+
 # Regulation parameters
 MAX_PWM_INCREMENT= 1000 # Set a limit to the power output rising time
+# Tuned at PID_DT with the simulator of Pico2Tools: the sensors give a new reading every 26.4 ms, KD/PID_DT acts as the proportional
+# gain on it and KP as the integral one. The former KP=5e-3, KD=0.5 limit-cycled by about 0.1 V.
+# In current regulation the error is relative to the setpoint, the loop gain is that of voltage regulation divided
+# by the DUT voltage: below about 1 V across the DUT the current loop still oscillates
+PID_KI= 1e-4 # integral gain for voltage regulation
+PID_KP= 1e-2 # proportional gain for voltage regulation
+PID_KD= 0.15 # derivative gain for voltage regulation
+
+# Run a timed garbage collection when the free heap goes below this value (bytes)
+GC_MIN_FREE= 32768
+
+# Host link
+UART_BAUD= 115200 # Default uart1 baud rate, the host can negotiate a higher one
+USB_LINK= True # Also accept the host link on the native USB port
+LINK_CONFIRM_TIMEOUT= 1000 # Time in milliseconds for the host to confirm a new baud rate
+
+# Transmit queue: messages are buffered and sent by a task, events before telemetry
+TX_TELEMETRY_SIZE= 2048 # Bytes of telemetry frames waiting to be sent
+TX_PRIORITY_SIZE= 512 # Bytes of events (alerts, states, replies) waiting to be sent
+TX_UART_BUFFER= 256 # uart1 driver buffer, the largest chunk written at once
+TX_DRAIN_PERIOD= 2 # Time in milliseconds between two transmissions
+TX_DROP_OLDEST= True # When the telemetry queue is full, drop the oldest frames instead of the new one
+
+# Telemetry stream fields: (i)current, (v)oltage, (d)uty, (s)etpoint, (p)ower,
+# the raw INA3221 values the host converts itself: (r)ange, sh(u)nt and (b)us register counts,
+# and the aggregates of the measurements since the previous frame: cou(n)t, current min (j) and max (k),
+# voltage min (w) and max (x). With aggregation on, i, v and p are the means since the previous frame.
+# The charge (q) in mAh and (e)nergy in mWh are integrated since their last reset
+STREAM_FIELDS= 'ivdsprubnjkwxqe'
+DEFAULT_STREAM_FIELDS= 'iv'
+SEQ_MODULO= 65536 # Telemetry frames are numbered modulo this value so the host can detect missing ones
 
 # Range selector pins
 RANGE_SELECTOR_PINS = [10,11,12,13,14]  # for 0.1, 1, 10, 100, 1k ohm shunt resistors respectively
 
+# INA3221 register LSBs: 40uV shunt and 8mV bus steps, left-aligned on 3 bits
+SHUNT_LSB_MA= 40e-6/8*1e3 # mA per shunt count across a 1 ohm shunt
+BUS_LSB_V= 8e-3/8 # V per bus count
+
 # Gross shunt resistor values, common for all channels
 SHUNTS= {
     0: 0.1,
@@ -64,4 +128,13 @@ SR_PIN_CHB= 27
 SR_PIN_CHC= 28
 
 # Safety relays reactivation button
-SR_ACTIVATE_PIN= 22
\ No newline at end of file
+SR_ACTIVATE_PIN= 22
+
+# Time in milliseconds the panel pins must be stable before being read
+PANEL_DEBOUNCE_MS= 20
+
+# Device log, see log.py
+# Levels: 0 off, 1 error, 2 warn, 3 info, 4 debug. Calls above LOG_LEVEL are compiled out
+LOG_LEVEL= 2
+LOG_BUFFER_SIZE= 1024 # Bytes of messages kept until the host fetches them
+LOG_ECHO= False # Also print the messages on the REPL, for development only
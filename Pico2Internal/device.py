@@ -2,7 +2,7 @@
 Initialize the hardware components: I2C, ADC, PWM, and SPI.
 """
 
-from machine import I2C, Pin, PWM, UART
+from machine import I2C, Pin, PWM, UART, Timer
 from ina3221 import INA3221
 from config import *
 
@@ -49,8 +49,8 @@ pwmc = PWM(
 
 # Serial Initialization
 
-uart1 = UART(1, baudrate=115200, tx=Pin(4), rx=Pin(5))
-uart1.init(115200)
+uart1 = UART(1, baudrate=UART_BAUD, tx=Pin(4), rx=Pin(5), txbuf=TX_UART_BUFFER)
+uart1.init(UART_BAUD)
 
 # Range selector pins initialization
 # Set to input with pull-up resistors, assuming the shunt resistor selection is done by connecting the corresponding pin to gnd
@@ -0,0 +1,59 @@
+"""
+Feedforward duty cycle lookup
+The duty cycle to output voltage curve of each channel is measured by characterize() in main.py
+and stored in flash. On a setpoint change the regulator jumps to the interpolated duty cycle,
+the PID only corrects the residual error
+"""
+import json
+from config import FF_FILE
+import log
+
+enabled = True
+tables = {}  # Channel name -> list of (voltage, duty) points sorted by voltage
+
+
+def load() -> None:
+    """Read the stored curves, if any"""
+    global tables
+    try:
+        with open(FF_FILE) as f:
+            tables = {name: [tuple(p) for p in points] for name, points in json.load(f).items()}
+        if log.enabled(log.INFO):
+            log.info("Feedforward curves loaded for channels %s", list(tables))
+    except (OSError, ValueError):
+        tables = {}
+
+
+def save() -> None:
+    try:
+        with open(FF_FILE, 'w') as f:
+            json.dump(tables, f)
+    except OSError as e:
+        log.error("Cannot save the feedforward curves: %s", e)
+
+
+def store(name: str, points: list) -> None:
+    """Keep the (voltage, duty) points measured on a channel"""
+    points.sort()
+    tables[name] = points
+    save()
+
+
+def duty_for(name: str, v: float):
+    """
+    Duty cycle giving the voltage v on a channel, interpolated between the measured points
+    and clamped to the measured range. None without curve or when the lookup is disabled
+    """
+    points = tables.get(name)
+    if not enabled or not points:
+        return None
+    if v <= points[0][0]:
+        return points[0][1]
+    for k in range(1, len(points)):
+        v1, d1 = points[k]
+        if v <= v1:
+            v0, d0 = points[k - 1]
+            if v1 == v0:
+                return d1
+            return int(d0 + (d1 - d0) * (v - v0) / (v1 - v0))
+    return points[-1][1]
@@ -0,0 +1,134 @@
+"""
+Fixed-point PID of the control loop
+The error signal is computed from the INA3221 register counts and kept in Q14 (1/16384 steps),
+the gains are pre-scaled integers: a PID iteration only handles small ints, so it allocates nothing,
+while every float result is a heap object on MicroPython. The measurements of the control step
+(poll_sensors(), aggregates and integrals) are still floats, for the telemetry and the limits.
+Every intermediate value stays below 2**30, the small int limit of the rp2 port, see Pico2Tools/check_pid.py
+"""
+import micropython
+from micropython import const
+from config import PID_KP, PID_KI, PID_KD, PWM_RESOLUTION, MAX_PWM_INCREMENT, SHUNT_LSB_MA, SETTLE_TOLERANCE, PID_DT, MAX_VOLTAGE
+
+SE_BITS = const(14)  # Fraction bits of the error signal
+GAIN_BITS = const(2)  # Fraction bits of the gains
+SHIFT = const(16)  # SE_BITS + GAIN_BITS
+SE_LIMIT = const(262144)  # The proportional term saturates beyond +-16 (volts, or relative current error)
+COUNTS_LIMIT = const(32767)  # Full scale of the INA3221 registers
+SETPOINT_MV_LIMIT = int(MAX_VOLTAGE * 1000)  # Voltage setpoints beyond the safety limit are clamped
+
+SETTLE_TOLERANCE_Q = int(SETTLE_TOLERANCE * (1 << SE_BITS))
+
+# Proportional (with the integral term) and derivative gains for the control period, and the derivative clamp
+gains = (0, 0, 0)
+
+
+def set_period(dt: int) -> None:
+    """
+    Scale the gains for a control period of dt ms, the float version computed
+        increment = (KP*se + KD*(se-se_old)/dt + KI*se*dt)*PWM_RESOLUTION
+    Beyond dse_limit the derivative term alone saturates the increment whatever the clamped proportional term,
+    so the clamp keeps the product within the small ints without changing the result.
+    Errors beyond SE_LIMIT always saturate the increment, where the float version could still
+    have the derivative term cancel the proportional one
+    """
+    global gains
+    gp = int(PWM_RESOLUTION * (PID_KP + PID_KI*dt) * (1 << GAIN_BITS) + 0.5)
+    gd = int(PWM_RESOLUTION * PID_KD / dt * (1 << GAIN_BITS) + 0.5)
+    p_max = (gp * SE_LIMIT) >> SHIFT
+    dse_limit = ((p_max + MAX_PWM_INCREMENT) << SHIFT) // gd + 1
+    gains = (gp, gd, dse_limit)
+
+
+def setpoint_mv(v: float) -> int:
+    """
+    Voltage setpoint in bus counts (1 mV), clamped to the output range 0..MAX_VOLTAGE
+    so that the error signal of any bus count stays a small int
+    """
+    mv = int(v * 1000 + 0.5)
+    if mv < 0:
+        return 0
+    if mv > SETPOINT_MV_LIMIT:
+        return SETPOINT_MV_LIMIT
+    return mv
+
+
+def setpoint_counts(i: float, rshunt: float) -> int:
+    """Current setpoint in mA as shunt counts, at least one count"""
+    counts = int(i * rshunt / SHUNT_LSB_MA + 0.5)
+    if counts < 1:
+        return 1
+    if counts > COUNTS_LIMIT:
+        return COUNTS_LIMIT
+    return counts
+
+
+@micropython.native
+def voltage_error(sp_mv: int, bus: int) -> int:
+    """Error signal sp - v in volts, Q14 rounded to nearest"""
+    diff = sp_mv - bus
+    if diff >= 0:
+        return ((diff << SE_BITS) + 500) // 1000
+    return -(((-diff << SE_BITS) + 500) // 1000)
+
+
+@micropython.native
+def current_error(sp_counts: int, shunt: int) -> int:
+    """
+    Error signal 1 - i/sp weighted by the current setpoint, Q14 rounded to nearest
+    A reverse current counts as no current: the difference of the positive counts stays within
+    COUNTS_LIMIT, and the shifted difference below 2**29
+    """
+    if shunt < 0:
+        shunt = 0
+    diff = sp_counts - shunt
+    half = sp_counts >> 1
+    if diff >= 0:
+        return ((diff << SE_BITS) + half) // sp_counts
+    return -(((-diff << SE_BITS) + half) // sp_counts)
+
+
+@micropython.native
+def next_duty(duty: int, se: int, se_old: int) -> int:
+    """
+    PID update of the duty cycle from the Q14 error signal and its previous value
+    Each term is truncated towards zero like the former int(increment)
+    Returns the new duty cycle clamped to the PWM range
+    """
+    g = gains
+    gd = g[1]
+    limit = g[2]
+    dse = se - se_old
+    if dse > limit:
+        dse = limit
+    elif dse < -limit:
+        dse = -limit
+    if se > SE_LIMIT:
+        se = SE_LIMIT
+    elif se < -SE_LIMIT:
+        se = -SE_LIMIT
+    if se >= 0:
+        increment = (g[0] * se) >> SHIFT
+    else:
+        increment = -((g[0] * -se) >> SHIFT)
+    if dse >= 0:
+        increment += (gd * dse) >> SHIFT
+    else:
+        increment -= (gd * -dse) >> SHIFT
+
+    # Apply the rising time limit
+    if increment > MAX_PWM_INCREMENT:
+        increment = MAX_PWM_INCREMENT
+    elif increment < -MAX_PWM_INCREMENT:
+        increment = -MAX_PWM_INCREMENT
+
+    duty -= increment
+    # Clamp duty cycle to valid range when saturation occurs
+    if duty < 0:
+        return 0
+    if duty > PWM_RESOLUTION:
+        return PWM_RESOLUTION
+    return duty
+
+
+set_period(PID_DT)
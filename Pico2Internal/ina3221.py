@@ -178,10 +178,35 @@ class INA3221:
             value = bit
         self.update(_REG_CONFIG, bit, value)
 
+    def shunt_voltage_raw(self, channel=1):
+        """Returns the channel's shunt voltage register as a signed count (5uV per count)"""
+        return self._to_signed(self._read_register(_REG_SHUNT_VOLTAGE_CH[channel]))
+
+    def bus_voltage_raw(self, channel=1):
+        """Returns the channel's bus voltage register as a signed count (1mV per count)"""
+        return self._to_signed(self._read_register(_REG_BUS_VOLTAGE_CH[channel]))
+
+    def start_single_shot(self, channel=1):
+        """
+        Start one shunt and bus conversion of a single channel, without averaging and with 332us conversion times
+        Returns the previous configuration, to be given back to restore_config() once the conversion is read
+        """
+        config = self._read_register(_REG_CONFIG)
+        self._write_register(_REG_CONFIG, _ENABLE_CH[channel] | _AVERAGING_NONE | _VBUS_CONV_TIME_332US |
+                             _SHUNT_CONV_TIME_332US | _MODE_SHUNT_AND_BUS_TRIGGERED)
+        return config
+
+    def conversion_ready(self):
+        """Returns True once the conversions started are complete"""
+        return (self._read_register(_REG_MASK_ENABLE) & _CONV_READY_FLAG) != 0
+
+    def restore_config(self, config):
+        self._write_register(_REG_CONFIG, config)
+
     def shunt_voltage(self, channel=1):
         """Returns the channel's shunt voltage in Volts"""
         #assert 1 <= channel <= 3, "channel argument must be 1, 2, or 3"
-        value = self._to_signed(self._read_register(_REG_SHUNT_VOLTAGE_CH[channel])) / 8.0
+        value = self.shunt_voltage_raw(channel) / 8.0
         # convert to volts - LSB = 40uV
         return value * 0.00004
 
@@ -0,0 +1,230 @@
+"""
+Transports of the host link
+Telemetry and replies go to the active link, commands are read from all of them
+Outgoing messages wait in two ring buffers, events and telemetry, sent by tx_loop()
+so that writing a message never blocks the task producing it
+"""
+import sys
+import select
+import time
+import asyncio
+from micropython import const
+from config import *
+from device import uart1
+import loopstats
+
+_NEWLINE = const(10)
+
+
+class UartLink:
+    """Link over the uart1 pins, the baud rate can be raised at runtime"""
+    name = 'uart'
+
+    def __init__(self, uart, baud: int):
+        self.uart = uart
+        self.baud = baud
+        # Previous baud rate and deadline while a new rate waits for the host confirmation
+        self.fallback = None
+        self.deadline = 0
+
+    def any(self) -> int:
+        return self.uart.any()
+
+    def readinto(self, buf, n: int) -> int:
+        return self.uart.readinto(buf, n)
+
+    def write(self, data) -> None:
+        self.uart.write(data)
+
+    def ready(self) -> bool:
+        """True when a chunk of TX_UART_BUFFER bytes can be written without blocking"""
+        return self.uart.txdone()
+
+    def set_baud(self, baud: int) -> None:
+        """Switch to a new baud rate once the pending bytes are sent, reverted if not confirmed in time"""
+        self.uart.flush()
+        self.fallback = self.baud
+        self.deadline = time.ticks_add(time.ticks_ms(), LINK_CONFIRM_TIMEOUT)
+        self.uart.init(baud)
+        self.baud = baud
+
+    def confirm(self) -> None:
+        self.fallback = None
+
+    def check_fallback(self) -> bool:
+        """Go back to the previous baud rate if the host did not confirm the new one, True if it did"""
+        if self.fallback is not None and time.ticks_diff(time.ticks_ms(), self.deadline) > 0:
+            self.uart.init(self.fallback)
+            self.baud = self.fallback
+            self.fallback = None
+            return True
+        return False
+
+
+class UsbLink:
+    """Link over the native USB CDC port of the pico (shared with the REPL)"""
+    name = 'usb'
+
+    def __init__(self):
+        self.inp = sys.stdin.buffer
+        self.out = sys.stdout.buffer
+        self.poll = select.poll()
+        self.poll.register(sys.stdin, select.POLLIN)
+        self.byte = bytearray(1)  # Read buffer: reading bytes objects would allocate one per byte
+
+    def any(self) -> int:
+        for _ in self.poll.ipoll(0):
+            return 1
+        return 0
+
+    def readinto(self, buf, n: int) -> int:
+        count = 0
+        byte = self.byte
+        while count < n and self.any():
+            self.inp.readinto(byte)
+            buf[count] = byte[0]
+            count += 1
+        return count
+
+    def write(self, data) -> None:
+        self.out.write(data)
+
+    def ready(self) -> bool:
+        return True
+
+
+class TxRing:
+    """Fixed-size ring buffer of newline-terminated messages"""
+
+    def __init__(self, size: int):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.size = size
+        self.start = 0
+        self.length = 0
+
+    def put(self, data) -> bool:
+        """Append a message, False if there is not enough room for it"""
+        n = len(data)
+        if n > self.size - self.length:
+            return False
+        end = (self.start + self.length) % self.size
+        first = min(n, self.size - end)
+        self.mv[end:end + first] = data[:first]
+        if first < n:
+            self.mv[0:n - first] = data[first:]
+        self.length += n
+        return True
+
+    def drop_oldest(self) -> None:
+        """Remove the first message"""
+        i = self.start
+        n = 0
+        while n < self.length:
+            n += 1
+            if self.buf[i] == _NEWLINE:
+                break
+            i = (i + 1) % self.size
+        self.start = (self.start + n) % self.size
+        self.length -= n
+
+    def chunk(self, n: int):
+        """Up to n contiguous bytes from the start of the buffer"""
+        return self.mv[self.start:self.start + min(n, self.length, self.size - self.start)]
+
+    def consume(self, n: int) -> None:
+        self.start = (self.start + n) % self.size
+        self.length -= n
+
+
+uart_link = UartLink(uart1, UART_BAUD)
+usb_link = UsbLink() if USB_LINK else None
+links = [uart_link] if usb_link is None else [uart_link, usb_link]
+active = uart_link
+
+
+priority = TxRing(TX_PRIORITY_SIZE)
+telemetry = TxRing(TX_TELEMETRY_SIZE)
+# Ring the message being sent comes from, the other one waits for its end
+sending = None
+
+
+def write(data, bulk: bool = False) -> None:
+    """
+    Queue a message for the host, bulk messages are telemetry frames that can be dropped
+    Without room for a telemetry frame, the oldest ones are dropped if TX_DROP_OLDEST is set,
+    except the one partly sent already, otherwise the new frame is dropped
+    """
+    if not bulk:
+        if not priority.put(data):
+            loopstats.count_tx_drop(True)
+    else:
+        while not telemetry.put(data):
+            if not TX_DROP_OLDEST or telemetry.length == 0 or sending is telemetry:
+                loopstats.count_tx_drop(False)
+                break
+            telemetry.drop_oldest()
+            loopstats.count_tx_drop(False)
+    loopstats.note_tx_fill(priority.length + telemetry.length)
+
+
+def send(block: bool = False) -> bool:
+    """
+    Write the next chunk of the queues to the active link, events first
+    Returns False if there was nothing to send or the link was busy
+    """
+    global sending
+    if not block and not active.ready():
+        return False
+    ring = sending
+    if ring is None:
+        ring = priority if priority.length else telemetry
+    if ring.length == 0:
+        return False
+    data = ring.chunk(TX_UART_BUFFER)
+    active.write(data)
+    n = len(data)
+    # Messages are never interleaved: keep sending from this ring until the end of a message
+    sending = None if data[n - 1] == _NEWLINE else ring
+    ring.consume(n)
+    return True
+
+
+def flush_priority() -> None:
+    """
+    Send the queued events, blocking: the message being sent is completed first,
+    the telemetry frames stay in their queue
+    """
+    while sending is not None or priority.length:
+        send(block=True)
+
+
+async def write_paced(data) -> None:
+    """
+    Queue a message that must not be dropped once the events queue is empty,
+    so that the lines of a long upload never take the room of the events
+    """
+    while priority.length:
+        await asyncio.sleep_ms(TX_DRAIN_PERIOD)
+    write(data)
+
+
+async def tx_loop() -> None:
+    while True:
+        send()
+        await asyncio.sleep_ms(TX_DRAIN_PERIOD)
+
+
+def activate(link) -> None:
+    global active
+    active = link
+
+
+def reset() -> None:
+    """Back to the default link: uart at UART_BAUD"""
+    global active
+    flush_priority()
+    active = uart_link
+    if uart_link.baud != UART_BAUD:
+        uart_link.set_baud(UART_BAUD)
+        uart_link.confirm()
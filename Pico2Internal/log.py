@@ -0,0 +1,145 @@
+"""
+Device log
+Messages are kept in a fixed ring buffer instead of being printed on the REPL,
+the host fetches them with the log command or has them streamed as they come:
+    LOG <ticks_ms> <level> <message>
+    LOGEND <lost>       end of a fetch, with the number of messages lost since the previous one
+Levels above LOG_LEVEL (config.py) are compiled out: their functions do nothing, the message is not even formatted.
+The other ones can still be silenced at runtime with set_level()
+The arguments are still evaluated by the caller: call sites building a costly argument (list, bytes, token string)
+check enabled() first, the others only pass values they already have
+"""
+import time
+import asyncio
+import _thread
+from micropython import const
+from config import LOG_LEVEL, LOG_BUFFER_SIZE, LOG_ECHO
+import link
+
+OFF = const(0)
+ERROR = const(1)
+WARN = const(2)
+INFO = const(3)
+DEBUG = const(4)
+NAMES = ('off', 'error', 'warn', 'info', 'debug')
+
+_NEWLINE = const(10)
+
+ring = link.TxRing(LOG_BUFFER_SIZE)
+level = LOG_LEVEL  # Runtime level, never above LOG_LEVEL
+streaming = False  # Send the messages to the host as they come
+fetching = False  # Send the buffered messages then LOGEND
+lost = 0  # Messages overwritten before being sent, or written while the buffer was busy
+
+# Both cores log: the control core gives up a message rather than waiting for the buffer
+_lock = _thread.allocate_lock()
+
+
+def _write(lvl: int, fmt: str, args: tuple) -> None:
+    global lost
+    if lvl > level:
+        return
+    try:
+        text = fmt % args if args else fmt
+    except Exception:
+        text = fmt
+    line = f"LOG {time.ticks_ms()} {NAMES[lvl]} {text}\n".encode('utf-8')
+    if len(line) > ring.size:
+        line = line[:ring.size - 1] + b'\n'
+    if LOG_ECHO:
+        print(line[4:-1].decode('utf-8'))
+    if not _lock.acquire(0):
+        lost += 1
+        return
+    try:
+        while not ring.put(line):
+            ring.drop_oldest()
+            lost += 1
+    finally:
+        _lock.release()
+
+
+def error(fmt: str, *args) -> None:
+    _write(ERROR, fmt, args)
+
+
+if LOG_LEVEL >= WARN:
+    def warn(fmt: str, *args) -> None:
+        _write(WARN, fmt, args)
+else:
+    def warn(fmt: str, *args) -> None:
+        pass
+
+if LOG_LEVEL >= INFO:
+    def info(fmt: str, *args) -> None:
+        _write(INFO, fmt, args)
+else:
+    def info(fmt: str, *args) -> None:
+        pass
+
+if LOG_LEVEL >= DEBUG:
+    def debug(fmt: str, *args) -> None:
+        _write(DEBUG, fmt, args)
+else:
+    def debug(fmt: str, *args) -> None:
+        pass
+
+
+def enabled(lvl: int) -> bool:
+    """True if the messages of the level lvl are kept, at runtime and by LOG_LEVEL"""
+    return lvl <= level
+
+
+def set_level(name: str) -> bool:
+    """Runtime level by name, capped to LOG_LEVEL, False for an unknown name"""
+    global level
+    if name not in NAMES:
+        return False
+    level = min(NAMES.index(name), LOG_LEVEL)
+    return True
+
+
+def clear() -> None:
+    global lost
+    with _lock:
+        ring.consume(ring.length)
+    lost = 0
+
+
+def _pop_line():
+    """Remove the oldest message from the buffer, None if it is empty"""
+    with _lock:
+        if ring.length == 0:
+            return None
+        i = ring.start
+        n = 0
+        while n < ring.length:
+            n += 1
+            if ring.buf[i] == _NEWLINE:
+                break
+            i = (i + 1) % ring.size
+        first = min(n, ring.size - ring.start)
+        line = bytes(ring.mv[ring.start:ring.start + first])
+        if first < n:
+            line += bytes(ring.mv[0:n - first])
+        ring.consume(n)
+    return line
+
+
+async def forward() -> None:
+    """
+    Send the buffered messages when streaming or fetching, on the communication core
+    The lines wait for the events queue to be empty, so the log never takes the room of the events
+    """
+    global fetching, lost
+    while True:
+        if streaming or fetching:
+            line = _pop_line()
+            while line is not None:
+                await link.write_paced(line)
+                line = _pop_line()
+            if fetching:
+                await link.write_paced(f"LOGEND {lost}\n".encode('utf-8'))
+                fetching = False
+                lost = 0
+        await asyncio.sleep_ms(100)
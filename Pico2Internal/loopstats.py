@@ -0,0 +1,153 @@
+"""
+Loop timing instrumentation
+Each instrumented task counts its iterations, its worst lateness and a histogram of the period jitter.
+Garbage collections run by collect(), I2C errors and control period errors are counted too.
+The automatic collections, triggered by an allocation when the heap is full, are detected by watch_heap()
+"""
+import gc
+import time
+from array import array
+
+# Upper bounds of the jitter histogram bins in microseconds, the last bin holds everything above
+JITTER_BINS_US = (100, 500, 1000, 2000, 5000, 10000)
+# Rise of the free heap revealing a collection, smaller ones can come from buffers freed explicitly by the runtime
+GC_AUTO_MIN_RISE = 2048
+
+tasks = [] # Every LoopStats instance, in creation order
+
+gc_count = 0
+gc_pause_us = 0
+gc_max_pause_us = 0
+gc_auto = 0 # Automatic collections detected by watch_heap()
+last_free = None # Free heap at the previous watch_heap() or after collect()
+i2c_errors = 0
+overruns = 0 # Control ticks skipped because the previous one was still running
+control_errors = 0 # Exceptions caught in the control periods
+tx_dropped = 0 # Telemetry frames dropped because the transmit queue was full
+tx_lost = 0 # Events lost because the priority transmit queue was full
+tx_peak = 0 # Highest number of bytes waiting in the transmit queues
+
+
+class LoopStats:
+    """Timing statistics of a periodic task"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hist = array('L', [0] * (len(JITTER_BINS_US) + 1))
+        self.reset()
+        tasks.append(self)
+
+    def reset(self) -> None:
+        self.count = 0
+        self.worst_us = 0
+        self.last = None
+        for n in range(len(self.hist)):
+            self.hist[n] = 0
+
+    def tick(self, period_us: int) -> None:
+        """
+        To be called once per iteration with the period the task is supposed to run at
+        The jitter is the difference between the measured and the expected periods
+        """
+        now = time.ticks_us()
+        self.count += 1
+        if self.last is not None:
+            jitter = abs(time.ticks_diff(now, self.last) - period_us)
+            if jitter > self.worst_us:
+                self.worst_us = jitter
+            n = 0
+            for bound in JITTER_BINS_US:
+                if jitter < bound:
+                    break
+                n += 1
+            self.hist[n] += 1
+        self.last = now
+
+    def summary(self) -> str:
+        """name=count,worst_us,h0/h1/.../hn"""
+        return f"{self.name}={self.count},{self.worst_us}," + '/'.join(str(h) for h in self.hist)
+
+
+def collect() -> None:
+    """Run a garbage collection and account for its duration"""
+    global gc_count, gc_pause_us, gc_max_pause_us, last_free
+    t0 = time.ticks_us()
+    gc.collect()
+    pause = time.ticks_diff(time.ticks_us(), t0)
+    gc_count += 1
+    gc_pause_us += pause
+    if pause > gc_max_pause_us:
+        gc_max_pause_us = pause
+    last_free = gc.mem_free()
+
+
+def watch_heap() -> None:
+    """
+    To be called periodically: the free heap only grows through a collection, so a rise since the previous call
+    that collect() did not cause is an automatic collection. gc.mem_free() scans the heap, so this is not done
+    in the loops themselves: several collections between two calls count as one and their duration is unknown
+    """
+    global gc_auto, last_free
+    free = gc.mem_free()
+    if last_free is not None and free > last_free + GC_AUTO_MIN_RISE:
+        gc_auto += 1
+    last_free = free
+
+
+def count_i2c_error() -> None:
+    global i2c_errors
+    i2c_errors += 1
+
+
+def count_overrun() -> None:
+    global overruns
+    overruns += 1
+
+
+def count_control_error() -> None:
+    global control_errors
+    control_errors += 1
+
+
+def count_tx_drop(priority: bool) -> None:
+    global tx_dropped, tx_lost
+    if priority:
+        tx_lost += 1
+    else:
+        tx_dropped += 1
+
+
+def note_tx_fill(n: int) -> None:
+    global tx_peak
+    if n > tx_peak:
+        tx_peak = n
+
+
+def reset() -> None:
+    global gc_count, gc_pause_us, gc_max_pause_us, gc_auto, i2c_errors, overruns, control_errors, tx_dropped, tx_lost, tx_peak
+    for task in tasks:
+        task.reset()
+    gc_count = 0
+    gc_pause_us = 0
+    gc_max_pause_us = 0
+    gc_auto = 0
+    i2c_errors = 0
+    overruns = 0
+    control_errors = 0
+    tx_dropped = 0
+    tx_lost = 0
+    tx_peak = 0
+
+
+def snapshot() -> str:
+    """
+    Statistics as a single line:
+    STATS <task>=<count>,<worst_us>,<hist> ... gc=<count>,<pause_us>,<max_pause_us>,<auto> mem=<free bytes> i2c=<errors> overruns=<ticks>
+          errors=<control errors> tx=<dropped frames>,<lost events>,<peak bytes>
+    """
+    message = "STATS"
+    for task in tasks:
+        message += ' ' + task.summary()
+    message += f" gc={gc_count},{gc_pause_us},{gc_max_pause_us},{gc_auto} mem={gc.mem_free()} i2c={i2c_errors} overruns={overruns}"
+    message += f" errors={control_errors} tx={tx_dropped},{tx_lost},{tx_peak}"
+    return message
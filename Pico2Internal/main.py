@@ -1,135 +1,660 @@
 import asyncio
 import time
+import gc
+import micropython
+from micropython import const
+import _thread
 from device import *
+from channel import Channel, Pulse
+import commands as cmd
+import link
+import loopstats
+import feedforward
+import capture
+import panel
+import fixedpid
+import log
 
 # default sampling frequency
 sampling_freq = 1
 
+# Report the mean of the measurements since the previous frame instead of the last one
+aggregate= False
+
+# Control period in milliseconds, PID_DT_FAST when a single channel is regulated and PID_DT_FAST_ENABLED
+control_dt= PID_DT
+
 # Current range switch
 range_switch= None
 
+class _NoLock:
+    """Stands for state_lock when the control loop runs on the same core as the communications"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# Protects the channels state shared between the communication core and the control core:
+# setpoints, ranges and relays written by core0, measurements and duty cycles written by core1
+# Timer ticks run between two bytecodes of core0 and must not wait for a lock held by the code they interrupted
+state_lock= _thread.allocate_lock() if CONTROL_ON_CORE1 else _NoLock()
+
+# Control loop timer, used when the control loop runs on the first core
+control_timer= None
+timer_dt= PID_DT
+control_stats= None
+control_channels= None
+tick_pending= False
+
+# Pulse in progress, one at a time: its phases run at pulse_deadline, see advance_pulse()
+PULSE_IDLE= const(0)
+PULSE_ON= const(1) # Pulse duty cycle applied, the conversion starts at the deadline
+PULSE_SAMPLING= const(2) # Conversion running, the pulse ends at the deadline
+pulse_channel= None
+running_pulse= None
+pulse_deadline= 0
+# One-shot timer of the pulse phases, when the control loop runs on the first core
+pulse_timer= None
+
+# Pre-hashed command tokens
+TOK_NC= cmd.hash_of('nc')
+TOK_V= cmd.hash_of('v')
+TOK_I= cmd.hash_of('i')
+TOK_SAMPLING= cmd.hash_of('sampling')
+TOK_AGGREGATE= cmd.hash_of('aggregate')
+TOK_VOFFSET= cmd.hash_of('voffset')
+TOK_STATE= cmd.hash_of('STATE')
+TOK_RESET= cmd.hash_of('reset')
+TOK_BAUD= cmd.hash_of('baud')
+TOK_LINK= cmd.hash_of('link')
+TOK_CONFIRM= cmd.hash_of('confirm')
+TOK_UART= cmd.hash_of('uart')
+TOK_USB= cmd.hash_of('usb')
+TOK_FEEDFORWARD= cmd.hash_of('feedforward')
+TOK_NOW= cmd.hash_of('now')
+TOK_AUTO= cmd.hash_of('auto')
+TOK_ACTIVE= cmd.hash_of('active')
+TOK_MONITOR= cmd.hash_of('monitor')
+TOK_PARKED= cmd.hash_of('parked')
+TOK_STREAM= cmd.hash_of('stream')
+TOK_LEVEL= cmd.hash_of('level')
+TOK_CLEAR= cmd.hash_of('clear')
+CHAR_W= ord('w')
+
 
 async def serial_write(channels:list):
     global sampling_freq
+    stats= loopstats.LoopStats('serial_write')
+    seq= 0 # Frame counter, wraps at SEQ_MODULO
     while True:
-        # Update all channel measurements
-        for ch in channels:
-            get_values(ch)
-        
+        stats.tick(int(1e6/sampling_freq))
         # Get current time in seconds since the program started
         current_time = time.ticks_ms() / 1000
 
-        # send the values of all channels over UART
-        message=f"{current_time} "
-        for ch in channels:
-            message += f"{ch['Name']} {ch['I_Measured']} {ch['V_Measured']} "
-        write_serial(message)
+        # send the last values of the subscribed channels and fields: D <seq> <time> <name>:<fields> <values>...
+        message=f"D {seq} {current_time}"
+        seq= (seq + 1) % SEQ_MODULO
+        with state_lock:
+            for ch in channels:
+                if ch.Fields:
+                    message += f" {ch.Name}:{ch.Fields}"
+                    for field in ch.Fields:
+                        message += f" {field_value(ch, field)}"
+                ch.Aggregate.reset()
+        write_serial(message, bulk=True)
         #print("Sending message over UART:", message.strip())
         await asyncio.sleep_ms(int(1000/sampling_freq))  # Send message every second
 
 
-async def adjust_channel(ch:dict, row:list) -> None:
+def field_value(ch:Channel, field:str):
+    """
+    Value of a stream field: (i)current, (v)oltage, (d)uty, (s)etpoint, (p)ower in mW,
+    the raw values: (r)ange, sh(u)nt and (b)us register counts,
+    the aggregates since the previous frame: cou(n)t, current min (j) and max (k), voltage min (w) and max (x),
+    or the integrals since their reset: charge (q) in mAh and (e)nergy in mWh
+    """
+    agg= ch.Aggregate
+    if field == 'i':
+        return agg.mean(agg.ISum) if aggregate else ch.I_Measured
+    if field == 'v':
+        return agg.mean(agg.VSum) if aggregate else ch.V_Measured
+    if field == 'd':
+        return ch.Duty
+    if field == 's':
+        return ch.V_SetPoint if ch.V_SetPoint is not None else ch.I_SetPoint
+    if field == 'p':
+        if aggregate:
+            return agg.mean(agg.PSum)
+        if ch.I_Measured is None or ch.V_Measured is None:
+            return None
+        return ch.I_Measured*ch.V_Measured
+    if field == 'r':
+        return ch.Range
+    if field == 'u':
+        return ch.ShuntRaw
+    if field == 'b':
+        return ch.BusRaw
+    if field == 'n':
+        return agg.Count
+    if field == 'j':
+        return agg.IMin
+    if field == 'k':
+        return agg.IMax
+    if field == 'w':
+        return agg.VMin
+    if field == 'x':
+        return agg.VMax
+    if field == 'q':
+        return ch.Integrator.Charge
+    if field == 'e':
+        return ch.Integrator.Energy
+    return None
+
+
+def send_stream_layout(channels:list) -> None:
+    """Send the subscribed fields of each channel: STREAM a:iv b: c:"""
+    message= "STREAM"
+    for ch in channels:
+        message+= f" {ch.Name}:{ch.Fields}"
+    write_serial(message)
+
+
+def command_subscribe(channels:list, ntok:int) -> bool:
+    """
+    subscribe                 back to the default stream: current and voltage of all channels
+    subscribe <ch> <fields>   select the fields of a channel among STREAM_FIELDS, '-' for none
+    """
+    if ntok == 1:
+        for ch in channels:
+            ch.Fields= DEFAULT_STREAM_FIELDS
+    elif ntok == 3:
+        name= cmd.token_str(1)
+        fields= cmd.token_str(2)
+        if fields == '-':
+            fields= ''
+        for f in fields:
+            if f not in STREAM_FIELDS:
+                log.warn("Unknown stream field %s", f)
+                return True
+        for ch in channels:
+            if ch.Name == name:
+                ch.Fields= fields
+                break
+        else:
+            return False
+    else:
+        return False
+    send_stream_layout(channels)
+    return True
+
+
+def adjust_channel(ch:Channel, n:int) -> None:
+    """
+    Apply the parameter given by the token n of the current command line to a channel
+    """
     try:
+        param= cmd.token(n)
         # Case when the user yaml ask for a mesurement with push pull output disconnected
-        if row[1] == 'nc':
-            print(f"Push pull output not to be used on channel {ch['Name']}")
+        if param == TOK_NC:
+            ch.Pulse= None
+            ch.Requested= 'monitor'
+            log.info("Push pull output not to be used on channel %s", ch.Name)
 
         # Set the channel to votage regulation
-        elif row[1] == 'v':
-            if ch['V_SetPoint'] is None: #ignore if already in the right mode
-                ch['V_SetPoint'] = 0
-                ch['I_SetPoint'] = None
-                print(f"Channel {ch['Name']} set to voltage regulation mode")
-        
+        elif param == TOK_V:
+            ch.Pulse= None # Selecting a mode ends the pulsed mode
+            ch.Requested= None # and follows the push-pull switch again
+            if ch.V_SetPoint is None: #ignore if already in the right mode
+                ch.V_SetPoint = 0
+                ch.I_SetPoint = None
+                log.info("Channel %s set to voltage regulation mode", ch.Name)
+
         # Set the channel to current regulation
-        elif row[1] == 'i':
-            if ch['I_SetPoint'] is None: #ignore if already in the right mode
-                ch['V_SetPoint'] = None
-                ch['I_SetPoint'] = 0
-                print(f"Channel {ch['Name']} set to current regulation mode")
+        elif param == TOK_I:
+            ch.Pulse= None
+            ch.Requested= None
+            if ch.I_SetPoint is None: #ignore if already in the right mode
+                ch.V_SetPoint = None
+                ch.I_SetPoint = 0
+                log.info("Channel %s set to current regulation mode", ch.Name)
 
-        # Set the setpoint value
-        elif is_numeric(row[1]):
-            if ch['V_SetPoint'] is not None:
-                ch['V_SetPoint']= float(row[1])
-                print(f"Channel {ch['Name']}: V_Setpoint set to {float(row[1])}")
-            else:
-                ch['I_SetPoint']= float(row[1])
-                print(f"Channel {ch['Name']}: I_Setpoint set to {float(row[1])}")
-        
         # Set the max power value
-        elif row[1][-1]=='w':
-            mp= row[1][0:-1]
-            if float(mp):
-                ch['MaxPower']= float(mp)*1000 # Set the power in mW internally
-                print(f"Channel {ch['Name']}: Max_Power set to {float(mp)}")
+        elif cmd.token_last_char(n) == CHAR_W:
+            mp= cmd.token_float(n, strip=1)
+            if mp:
+                ch.MaxPower= mp*1000 # Set the power in mW internally
+                log.info("Channel %s: Max_Power set to %s", ch.Name, mp)
             else:
-                print("Cannot parse MaxPower value {mp}")
+                log.warn("Cannot parse MaxPower value %s", mp)
+
+        # Set the setpoint value
         else:
-            print("Invalid parameter for channel adjustment:", row[1])
+            sp= cmd.token_float(n)
+            duty= None
+            if ch.V_SetPoint is not None:
+                ch.V_SetPoint= sp
+                log.info("Channel %s: V_Setpoint set to %s", ch.Name, sp)
+                # Jump to the duty cycle of the new voltage, the regulator only corrects the residual error
+                duty= feedforward.duty_for(ch.Name, sp)
+                if duty is not None:
+                    ch.Duty= duty
+            else:
+                ch.I_SetPoint= sp
+                log.info("Channel %s: I_Setpoint set to %s", ch.Name, sp)
+            ch.SettleStart= time.ticks_ms()
+            ch.SettleCount= 0
+            ch.SettleFF= duty is not None
+            ch.SettleSp= sp
+    except ValueError:
+        if log.enabled(log.WARN):
+            log.warn("Invalid parameter for channel adjustment: %s", cmd.token_str(n))
     except Exception as e:
-        print("Error adjusting channel parameters:", e)
+        log.error("Error adjusting channel parameters: %s", e)
+
+
+def command_characterize(channels:list, ntok:int) -> bool:
+    """
+    characterize <ch> <max_v> confirm   measure the duty cycle to voltage curve of a channel up to max_v volts
+    The output of the channel is driven open loop, the command must be confirmed
+    """
+    if ntok != 4:
+        return False
+    name= cmd.token_str(1)
+    for ch in channels:
+        if ch.Name != name:
+            continue
+        if cmd.token(3) != TOK_CONFIRM:
+            log.warn("Channel %s not characterized, the command must end with confirm", ch.Name)
+            write_serial(f"FEEDFORWARD {ch.Name} failed")
+            return True
+        try:
+            limit= min(cmd.token_float(2), FF_MAX_VOLTAGE)
+        except ValueError:
+            return False
+        asyncio.create_task(characterize(ch, limit))
+        return True
+    return False
+
 
+async def characterize(ch:Channel, limit:float) -> None:
+    """
+    Measure the output voltage of a channel at FF_POINTS duty cycles, from 0 V upwards,
+    and store the curve for the feedforward lookup. The regulation of the channel is suspended meanwhile,
+    its limits are still checked by the control loop. Reports FEEDFORWARD <ch> <points> or FEEDFORWARD <ch> failed
 
-def is_numeric(string):
+    Arguments:
+        - ch: channel to characterize
+        - limit: highest output voltage, the ramp stops before the next point would exceed it
+          or when the power goes over the MaxPower of the channel
+    """
+    if ch.Characterizing or not ch.PushPullConnected or ch.Activity == 'parked' or ch.Range is None or limit <= 0:
+        write_serial(f"FEEDFORWARD {ch.Name} failed")
+        return
+    log.info("Measuring the duty cycle to voltage curve of channel %s up to %s V...", ch.Name, limit)
+    points= []
+    with state_lock:
+        ch.Characterizing= True
+        duty0= ch.Duty
     try:
-        float(string)
+        for k in range(FF_POINTS):
+            duty= PWM_RESOLUTION - k*PWM_RESOLUTION//(FF_POINTS-1)
+            with state_lock:
+                ch.pwm.duty_u16(duty)
+            await asyncio.sleep_ms(FF_SETTLE_MS)
+            with state_lock:
+                i, v= poll_sensors(ch)
+                ch.I_Measured= i
+                ch.V_Measured= v
+            if v is None or not ch.SafetyRelayOn or v > limit:
+                break
+            points.append((v, duty))
+            if ch.MaxPower is not None and i is not None and i*v > ch.MaxPower:
+                break
+            # The curve is smooth: the next point is extrapolated from the last two
+            if len(points) > 1 and 2*v - points[-2][0] > limit:
+                break
+    finally:
+        with state_lock:
+            ch.pwm.duty_u16(duty0)
+            ch.Characterizing= False
+    if len(points) < 2:
+        write_serial(f"FEEDFORWARD {ch.Name} failed")
+        return
+    feedforward.store(ch.Name, points)
+    write_serial(f"FEEDFORWARD {ch.Name} {len(points)}")
+
+
+def command_pulse(channels:list, ntok:int) -> bool:
+    """
+    pulse <ch> <level> <width_ms> <delay_ms> <period_ms>   pulsed mode, the channel setpoint is the base level
+    pulse <ch> off                                        back to continuous regulation
+    """
+    if ntok not in (3, 6):
+        return False
+    name= cmd.token_str(1)
+    for ch in channels:
+        if ch.Name != name:
+            continue
+        if ntok == 3:
+            with state_lock:
+                ch.Pulse= None
+            update_control_period(channels)
+            log.info("Channel %s: pulsed mode off", ch.Name)
+            return True
+        level= cmd.token_float(2)
+        width= int(cmd.token_float(3)*1000)
+        delay= int(cmd.token_float(4)*1000)
+        period= int(cmd.token_float(5)/PID_DT + 0.5)
+        if width > PULSE_MAX_WIDTH*1000 or delay + PULSE_CONVERSION_US > width or width >= period*PID_DT*1000:
+            log.warn("Invalid pulse timing on channel %s: %d us wide, sampled at %d us, every %d ms", ch.Name, width, delay, period*PID_DT)
+            return True
+        duty= feedforward.duty_for(ch.Name, level) if ch.V_SetPoint is not None else None
+        with state_lock:
+            if ch.Pulse is None:
+                ch.Pulse= Pulse(level, width, delay, period, ch.Duty if duty is None else duty)
+            else: # Without lookup, keep the duty cycle learned at the previous level
+                ch.Pulse.SetPoint, ch.Pulse.Width, ch.Pulse.Delay, ch.Pulse.Period= level, width, delay, period
+                if duty is not None:
+                    ch.Pulse.Duty= duty
+        update_control_period(channels)
+        log.info("Channel %s: %s pulses of %d us every %d ms", ch.Name, level, width, period*PID_DT)
         return True
-    except ValueError:
+    return False
+
+
+def command_capture(channels:list, ntok:int) -> bool:
+    """
+    capture <ch> now             trigger a capture of the channel
+    capture <ch> <i|v> <level>   trigger once when the current (mA) or voltage (V) crosses level
+    """
+    if ntok not in (3, 4):
+        return False
+    name= cmd.token_str(1)
+    for ch in channels:
+        if ch.Name != name:
+            continue
+        field= cmd.token(2)
+        if ntok == 3 and field == TOK_NOW:
+            with state_lock:
+                started= ch.Capture.trigger('host')
+            if not started:
+                log.warn("Channel %s: capture already in progress", ch.Name)
+            return True
+        if ntok == 4 and field in (TOK_I, TOK_V):
+            level= cmd.token_float(3)
+            with state_lock:
+                ch.Capture.arm_threshold(capture.THRESHOLD_I if field == TOK_I else capture.THRESHOLD_V, level)
+            if log.enabled(log.INFO):
+                log.info("Channel %s: capture on %s crossing %s", ch.Name, cmd.token_str(2), level)
+            return True
         return False
+    return False
+
+
+async def upload_captures(channels:list) -> None:
+    """
+    Send the frozen captures as one block:
+        CAPTURE <ch> <reason> <samples> <period_ms>
+        CAPDATA <ch> <ms>,<i>,<v> ...     CAPTURE_CHUNK samples per line, times relative to the trigger
+        CAPEND <ch>
+    The buffer is frozen, so it is read without the lock, and armed again once sent
+    """
+    while True:
+        for ch in channels:
+            cap= ch.Capture
+            if cap.state != capture.FROZEN:
+                continue
+            await link.write_paced(f"CAPTURE {ch.Name} {cap.reason} {cap.count} {control_dt}\n".encode('utf-8'))
+            line= f"CAPDATA {ch.Name}"
+            n= 0
+            for t, i, v in cap.samples():
+                line+= f" {t},{i:.5g},{v:.5g}"
+                n+= 1
+                if n == CAPTURE_CHUNK:
+                    await link.write_paced((line + '\n').encode('utf-8'))
+                    line= f"CAPDATA {ch.Name}"
+                    n= 0
+            if n:
+                await link.write_paced((line + '\n').encode('utf-8'))
+            await link.write_paced(f"CAPEND {ch.Name}\n".encode('utf-8'))
+            with state_lock:
+                cap.rearm()
+        await asyncio.sleep_ms(50)
+
+
+def command_integral(channels:list, ntok:int) -> bool:
+    """
+    integral [<ch>]           report the charge and energy: INTEGRAL <ch> <mAh> <mWh> <seconds>
+    integral [<ch>] reset     restart the integration
+    """
+    reset= ntok > 1 and cmd.token(ntok-1) == TOK_RESET
+    if ntok > 3 or (ntok == 3 and not reset):
+        return False
+    selected= channels
+    if ntok == 3 or (ntok == 2 and not reset):
+        name= cmd.token_str(1)
+        selected= [ch for ch in channels if ch.Name == name]
+        if not selected:
+            return False
+    for ch in selected:
+        integ= ch.Integrator
+        with state_lock:
+            if reset:
+                integ.reset()
+                continue
+            charge, energy, elapsed= integ.Charge, integ.Energy, integ.Time
+        write_serial(f"INTEGRAL {ch.Name} {charge} {energy} {elapsed}")
+    return True
+
+
+def command_log(channels:list, ntok:int) -> bool:
+    """
+    log                  send the buffered messages, then LOGEND <lost>
+    log stream 0|1       send the messages as they come
+    log level <name>     off, error, warn, info or debug, up to the LOG_LEVEL the firmware is built with
+    log clear            drop the buffered messages
+    """
+    if ntok == 1:
+        log.fetching= True
+        return True
+    action= cmd.token(1)
+    if ntok == 3 and action == TOK_STREAM:
+        log.streaming= cmd.token_int(2) != 0
+    elif ntok == 3 and action == TOK_LEVEL:
+        return log.set_level(cmd.token_str(2))
+    elif ntok == 2 and action == TOK_CLEAR:
+        log.clear()
+    else:
+        return False
+    return True
+
+
+def command_set(channels:list, ntok:int) -> bool:
+    """set <parameter> <value>"""
+    global sampling_freq, aggregate
+    if ntok != 3:
+        return False
+    par= cmd.token(1)
+    if par == TOK_SAMPLING:
+        sampling_freq = cmd.token_float(2)
+        log.info("Updated sampling frequency to %s Hz", sampling_freq)
+    elif par == TOK_AGGREGATE:
+        aggregate= cmd.token_int(2) != 0
+        log.info("Telemetry reports the %s of the measurements", 'means' if aggregate else 'last values')
+    elif par == TOK_VOFFSET:
+        log.warn("Voffset must be implemented")
+    #    set_voltage_offset(Ch1, Ch1, Ch1, float(row[2]))
+    elif par == TOK_FEEDFORWARD:
+        feedforward.enabled= cmd.token_int(2) != 0
+        log.info("Feedforward duty cycle lookup %s", 'on' if feedforward.enabled else 'off')
+    elif par == TOK_BAUD:
+        # Announce the new rate at the current one, then wait for the host confirmation
+        baud= cmd.token_int(2)
+        write_serial(f"BAUD {baud}")
+        link.flush_priority()
+        link.uart_link.set_baud(baud)
+    elif par == TOK_LINK:
+        target= cmd.token(2)
+        if target == TOK_USB and link.usb_link is not None:
+            link.activate(link.usb_link)
+            write_serial("LINK usb")
+        elif target == TOK_UART:
+            link.activate(link.uart_link)
+            write_serial(f"LINK uart {link.uart_link.baud}")
+        else:
+            return False
+    else:
+        return False
+    return True
+
+
+def command_link(channels:list, ntok:int) -> bool:
+    """link confirm|reset"""
+    if ntok != 2:
+        return False
+    action= cmd.token(1)
+    if action == TOK_CONFIRM:
+        link.uart_link.confirm()
+        write_serial(f"LINK uart {link.uart_link.baud}")
+    elif action == TOK_RESET:
+        link.reset()
+    else:
+        return False
+    return True
+
+
+def command_user_panel(channels:list, ntok:int) -> bool:
+    """USER PANEL STATE"""
+    if ntok == 3 and cmd.token(2) == TOK_STATE:
+        send_user_panel_state(channels)
+        return True
+    return False
+
+
+def command_channel(ch:Channel):
+    """<channel name> <parameter>"""
+    def handler(channels:list, ntok:int) -> bool:
+        if ntok != 2:
+            return False
+        with state_lock:
+            adjust_channel(ch, 1)
+        update_activity(ch, channels)
+        update_control_period(channels) # A mode change ends the pulsed mode
+        return True
+    return handler
+
+
+def command_activity(channels:list, ntok:int) -> bool:
+    """activity <ch> active|monitor|parked|auto"""
+    if ntok != 3:
+        return False
+    name= cmd.token_str(1)
+    requests= {TOK_AUTO: None, TOK_ACTIVE: 'active', TOK_MONITOR: 'monitor', TOK_PARKED: 'parked'}
+    request= cmd.token(2)
+    if request not in requests:
+        return False
+    for ch in channels:
+        if ch.Name == name:
+            ch.Requested= requests[request]
+            update_activity(ch, channels)
+            return True
+    return False
+
+
+def update_activity(ch:Channel, channels:list) -> None:
+    """
+    Set the activity of a channel from the host request and its push-pull switch:
+        active    regulated every control period
+        monitor   measured every MONITOR_PERIOD ms, the duty cycle is left as it is
+        parked    neither measured nor regulated, output at 0 V and sensor channels off
+    Without request, a channel is active when its push-pull output is connected and monitored otherwise,
+    it cannot be active while disconnected. Changes are reported as ACTIVITY <ch> <activity>
+    """
+    activity= ch.Requested
+    if activity is None or (activity == 'active' and not ch.PushPullConnected):
+        activity= 'active' if ch.PushPullConnected else 'monitor'
+    if activity == ch.Activity:
+        return
+    with state_lock:
+        if activity == 'parked':
+            ch.Duty= PWM_RESOLUTION # 0 V after the inverter
+            ch.pwm.duty_u16(ch.Duty)
+            ch.I_Measured= None
+            ch.V_Measured= None
+            enable_sensors(ch, False)
+        elif ch.Activity == 'parked':
+            enable_sensors(ch, True)
+        ch.Activity= activity
+    log.info("Channel %s: %s", ch.Name, activity)
+    write_serial(f"ACTIVITY {ch.Name} {activity}")
+    update_control_period(channels)
+
+
+def enable_sensors(ch:Channel, enable:bool) -> None:
+    """
+    Turn the INA3221 channels of a channel on or off,
+    the sensors then convert the other channels more often
+    """
+    try:
+        ch.HigIDevice.enable_channel(ch.BusId, enable)
+        ch.LowIDevice.enable_channel(ch.BusId, enable)
+    except Exception as e:
+        log.error("Error switching the sensors of channel %s: %s", ch.Name, e)
+        loopstats.count_i2c_error()
+
+
+def update_control_period(channels:list) -> None:
+    """
+    The control loop runs at PID_DT_FAST when a single channel is regulated and none is pulsed,
+    if PID_DT_FAST_ENABLED
+    """
+    global control_dt
+    active= 0
+    pulsed= False
+    for ch in channels:
+        if ch.Activity == 'active':
+            active+= 1
+        if ch.Pulse is not None:
+            pulsed= True
+    control_dt= PID_DT_FAST if PID_DT_FAST_ENABLED and active == 1 and not pulsed else PID_DT
+    # The gains of the fixed-point PID depend on the period
+    fixedpid.set_period(control_dt)
+
+
+def command_stats(channels:list, ntok:int) -> bool:
+    """stats [reset]"""
+    if ntok == 1:
+        write_serial(loopstats.snapshot())
+    elif ntok == 2 and cmd.token(1) == TOK_RESET:
+        loopstats.reset()
+    else:
+        return False
+    return True
 
 
 async def serial_read(channels:list):
-    global sampling_freq
-    serial_buffer = ""
+    cmd.register('set', command_set)
+    cmd.register('USER', command_user_panel)
+    cmd.register('stats', command_stats)
+    cmd.register('link', command_link)
+    cmd.register('subscribe', command_subscribe)
+    cmd.register('pulse', command_pulse)
+    cmd.register('characterize', command_characterize)
+    cmd.register('capture', command_capture)
+    cmd.register('integral', command_integral)
+    cmd.register('activity', command_activity)
+    cmd.register('log', command_log)
+    for ch in channels:
+        cmd.register(ch.Name, command_channel(ch))
+    readers= [cmd.CommandReader(l) for l in link.links]
     while True:
-        if uart1.any():
-            data = uart1.read(uart1.any())
-            if data is not None:
-                # Append new data to buffer
-                serial_buffer += data.decode('utf-8')
-                
-                # Process complete lines (ending with \n or \r)
-                while '\n' in serial_buffer:
-                    # Split on \n
-                    if '\n' in serial_buffer:
-                        line, serial_buffer = serial_buffer.split('\n', 1)
-                        line = line.strip()
-                        
-                        # Skip empty lines
-                        if not line:
-                            break
-                        
-                        print("Received data over UART:", line)
-                        # parse and update setpoints if needed
-                        try:
-                            processed= False
-                            row = line.split(' ')
-                            if len(row) == 3:
-                                if row[1] == 'sampling':
-                                    sampling_freq = float(row[2])
-                                    print(f"Updated sampling frequency to {sampling_freq} Hz")
-                                    processed= True
-                                elif row[2] == 'STATE':
-                                    send_user_panel_state(channels)
-                                    processed= True
-                                elif row[1] == 'voffset':
-                                    print("Voffset must be implemented")
-                                    processed= True
-                                #    set_voltage_offset(Ch1, Ch1, Ch1, float(row[2]))
-                            elif len(row) == 2:
-                                for ch in channels:
-                                    if ch['Name']==row[0]:
-                                        await adjust_channel(ch, row)
-                                        processed= True
-                                        break
-
-                            if not processed:
-                                print("Unknown command: ", line)
-
-                        except Exception as e:
-                            print("Error parsing command:", e)
-                        break
+        # Execute every complete command received since the last pass
+        for reader in readers:
+            reader.read(channels)
+        if link.uart_link.check_fallback():
+            log.warn("Baud rate not confirmed, back to %d", link.uart_link.baud)
         await asyncio.sleep_ms(10)  # Check for incoming data every x ms
 
 
@@ -141,22 +666,37 @@ def send_user_panel_state(channels: list) -> None:
     Argument: list of channels
     """
     global range_switch
-    message= f"STATE {range_switch}"
+    message= f"PANEL {range_switch}"
     for ch in channels:
-        message+=  f" {ch['PushPullConnected']}"
+        message+=  f" {ch.PushPullConnected}"
         # If regulation is active, reset the State variable 
         # so that send_channels_state() function will update it
-        if ch['PushPullConnected']:
-            ch['State']=''
+        if ch.PushPullConnected:
+            ch.State=''
     write_serial(message)
 
 
-def write_serial(message: str) -> None:
+def write_serial(message: str, bulk: bool = False) -> None:
     """
-    This function writes the provided message on the serial connection uart1
+    This function queues the provided message for the active host link,
+    bulk messages (telemetry) are sent after the others and dropped first when the link is too slow
+    Every message starts with its type tag:
+        D <seq> <time> <name>:<fields> <values>...   telemetry frame
+        PANEL <range> <a> <b> <c>                   user panel state, answer to USER PANEL STATE
+        RANGE <range>                               ammeter range switch moved
+        SWITCH <ch> <True|False>                    push-pull switch moved
+        STATE <ch> <message>                        regulation state
+        ALERT <ch> <message>                        safety relay tripped
+        SETTLED <ch> <ms|timeout> <ff|pid> <sp>     settling time of the change to the setpoint sp
+        FEEDFORWARD <ch> <points|failed>            end of the duty cycle to voltage characterization
+        CAPTURE, CAPDATA, CAPEND                    triggered transient capture, see upload_captures()
+        INTEGRAL <ch> <mAh> <mWh> <seconds>         charge and energy, answer to the integral command
+        ACTIVITY <ch> <active|monitor|parked>       channel activity changed
+        LOG, LOGEND                                 device log messages, see log.py
+        STATS, STREAM, BAUD, LINK                   answers to the stats, subscribe, set and link commands
     """
     message+= '\n'
-    uart1.write(message.encode('utf-8'))
+    link.write(message.encode('utf-8'), bulk)
 
 
 async def watch_user_panel_state(channels:list):
@@ -165,213 +705,274 @@ async def watch_user_panel_state(channels:list):
     it updates the shunt resistor values
     Five shunts resistors are available: 0.1, 1, 10, 100 and 1k ohms
     This allows to mesure current in the 1µA - 10A range (with good accuracy?)
-    It also check for the push-pull outputs switches state
+    It also check for the push-pull outputs switches state and the safety relays reactivation button
+    The pins are read when their interrupts signal a change, once debounced
     """
-    print("Starting range selector monitoring...")
-    global range_switch
+    log.info("Starting range selector monitoring...")
+
+    def range_moving(pin):
+        # The shunt is unknown as soon as the selector moves, the sensors are not read with the wrong one
+        for ch in channels:
+            ch.Rshunt= None
+
+    panel.watch(range_selector_pins, range_moving)
+    panel.watch([ch.SwitchPin for ch in channels] + [sractivate])
     while True:
-        # Read the state of the five GPIO pins of the range selector
-        n=0
-        selected= None
-        for i, _ in enumerate(RANGE_SELECTOR_PINS):
-            val= range_selector_pins[i].value()
-            n+= val
-            if val==0:
-                selected= i
-        if n==4 and selected is not None:
-            if range_switch is None or selected != range_switch:
-                print(f"Selected shunt resistor: {selected}")
-                for ch in channels:
-                    ch['Range']= selected
-                    ch['Rshunt'] = SHUNTS[selected]
-                range_switch= selected
-                write_serial(f"Range {range_switch} selected")
-        else:
-            print("Invalid shunt resistor selection: ", [pin.value() for pin in range_selector_pins])
+        read_range_selector(channels)
+        read_push_pull_switches(channels)
+        # Check if the user pressed the reactivation button
+        if not sractivate.value():
+            reactivate_safety_relays(channels)
+        await panel.wait_stable()
+
+
+def read_range_selector(channels:list) -> None:
+    """Read the five GPIO pins of the range selector and set the shunt of the channels"""
+    global range_switch
+    n=0
+    selected= None
+    for i, _ in enumerate(RANGE_SELECTOR_PINS):
+        val= range_selector_pins[i].value()
+        n+= val
+        if val==0:
+            selected= i
+    if n==4 and selected is not None:
+        with state_lock:
             for ch in channels:
-                ch['Rshunt'] = None
-        
-        # Read the state of the push-pull switches
-        for ch in channels:
-            swstate= bool(ch['SwitchPin'].value())
-            if swstate != ch['PushPullConnected']:
-                print(f"Push-pull switch set to {swstate} on channel {ch['Name']}")
-                ch['PushPullConnected']= swstate
-                write_serial(f"CH {ch['Name']} PushPullConnected {swstate}")
-        await asyncio.sleep_ms(50)
+                ch.Range= selected
+                ch.Rshunt = SHUNTS[selected]
+        if range_switch is None or selected != range_switch:
+            log.info("Selected shunt resistor: %d", selected)
+            range_switch= selected
+            write_serial(f"RANGE {range_switch}")
+    else:
+        if log.enabled(log.WARN):
+            log.warn("Invalid shunt resistor selection: %s", [pin.value() for pin in range_selector_pins])
+        with state_lock:
+            for ch in channels:
+                ch.Rshunt = None
+
+
+def read_push_pull_switches(channels:list) -> None:
+    for ch in channels:
+        swstate= bool(ch.SwitchPin.value())
+        if swstate != ch.PushPullConnected:
+            log.info("Push-pull switch set to %s on channel %s", swstate, ch.Name)
+            ch.PushPullConnected= swstate
+            write_serial(f"SWITCH {ch.Name} {swstate}")
+            update_activity(ch, channels)
+
+
+def reactivate_safety_relays(channels:list) -> None:
+    log.info("User-button pressed, reactivating all safety switches...")
+    for ch in channels:
+        with state_lock:
+            ch.SafetyRelayOn= True
+            ch.SafetyRelayPin.value(0)
+        # Update the push-pull switch state to refresh the textbox showing the board status
+        write_serial(f"SWITCH {ch.Name} {ch.PushPullConnected}")
 
 
 async def send_channels_state(channels:list):
     while True:
         for ch in channels:
-            if ch['SafetyRelayOn'] and ch['PushPullConnected']:
+            # Settling times of the setpoint changes since the last report
+            if ch.Settled:
+                with state_lock:
+                    settled= ch.Settled
+                    ch.Settled= []
+                for ms, ff, sp in settled:
+                    write_serial(f"SETTLED {ch.Name} {ms if ms >= 0 else 'timeout'} {'ff' if ff else 'pid'} {sp}")
+            if ch.SafetyRelayOn and ch.Activity == 'active':
                 # Clamp duty cycle to valid range when saturation occurs
-                if ch['Duty'] == 0:
-                    if ch['State'] != 'Saturation High':
-                        print(f"Ch {ch['Name']} running on saturation High")
-                        ch['State']= 'Saturation High'
-                        write_serial(f"State {ch['Name']} Saturation High")
-                elif ch['Duty'] == PWM_RESOLUTION:
-                    if ch['State'] != 'Saturation Low':
-                        print(f"Ch {ch['Name']} running on saturation Low")
-                        ch['State']= 'Saturation Low'
-                        write_serial(f"State {ch['Name']} Saturation Low")
+                if ch.Duty == 0:
+                    if ch.State != 'Saturation High':
+                        log.info("Ch %s running on saturation High", ch.Name)
+                        ch.State= 'Saturation High'
+                        with state_lock:
+                            ch.Capture.trigger('saturation')
+                        write_serial(f"STATE {ch.Name} Saturation High")
+                elif ch.Duty == PWM_RESOLUTION:
+                    if ch.State != 'Saturation Low':
+                        log.info("Ch %s running on saturation Low", ch.Name)
+                        ch.State= 'Saturation Low'
+                        with state_lock:
+                            ch.Capture.trigger('saturation')
+                        write_serial(f"STATE {ch.Name} Saturation Low")
                 else:
-                    if ch['State'] != 'PID Regulation':
+                    if ch.State != 'PID Regulation':
                         # Add some hysteresis before getting back to the regulating state
-                        if ch['Duty'] < 0.95*PWM_RESOLUTION and ch['Duty'] > 0.05*PWM_RESOLUTION:
-                            print(f"Ch {ch['Name']} regulating")
-                            ch['State']= 'PID Regulation'
-                            write_serial(f"State {ch['Name']} PID Regulation")
+                        if ch.Duty < 0.95*PWM_RESOLUTION and ch.Duty > 0.05*PWM_RESOLUTION:
+                            log.info("Ch %s regulating", ch.Name)
+                            ch.State= 'PID Regulation'
+                            write_serial(f"STATE {ch.Name} PID Regulation")
         await asyncio.sleep_ms(500)
 
 
-async def regulator(ch:dict):
-    se_old = 0 # Stores the error signal for the derivative calculation
-    ise = 0 # Integral of the error signal
-    while True:
-        try:
-            i, v = poll_sensors(ch)
-        except Exception as e:
-            print(f"Error getting i and v on channel {ch['Name']}: ", e)
-            i, v = None, None
-    
-        # Skip regulation if sensors return None values
-        if v is None or i is None:
-            await asyncio.sleep_ms(PID_DT)
-            continue
+@micropython.native
+def measure(ch:Channel) -> tuple:
+    """
+    Poll the sensors of a channel, store the measurements and add them to the aggregates and integrals
+    Returns (i, v), None values when the sensors could not be read
+    """
+    try:
+        i, v = poll_sensors(ch)
+    except Exception as e:
+        log.error("Error getting i and v on channel %s: %s", ch.Name, e)
+        i, v = None, None
 
-        ch['I_Measured'] = i
-        ch['V_Measured'] = v
-
-        Ki= 1e-4 # integral gain for voltage regulation
-        Kp= 5e-3 # proportional gain for voltage regulation
-        Kd= 5e-1 # derivative gain for voltage regulation
-
-        se= 0 #error signal
-        if ch['I_SetPoint'] is None and ch['V_SetPoint'] is not None: #Voltage regulation
-            se= ch['V_SetPoint']-ch['V_Measured']
-        elif ch['V_SetPoint'] is None and ch['I_SetPoint'] is not None: #Current regulation
-            """
-            Voltage regulation if fairly easy, but it's another story
-            for current regulation because the load can vary over six decades...
-            The best solution I found is to use an error signal weighted by the current setpoint
-            """
-            if ch['I_SetPoint'] < 1e-6: #avoid the case of I_SetPoint=0
-                ch['I_SetPoint']= 1e-6
-            se= 1-ch['I_Measured']/ch['I_SetPoint']
+    # In pulsed mode, only the samples taken during the pulses are reported
+    if ch.Pulse is None:
+        ch.I_Measured = i
+        ch.V_Measured = v
 
-        else:
-            print("Error: Cant tell wether voltage or current must be regulated.")
-            await asyncio.sleep_ms(PID_DT)
-            continue
-        
-        # PWM Regulation Logic
-        ise= se*PID_DT
-        dse= (se-se_old)/PID_DT # Derivative of error
-        increment= (Kp*se + Kd*dse + Ki*ise)*PWM_RESOLUTION # Required voltage variation for this iteration
-
-        # Apply the rising time limit
-        if abs(increment) > MAX_PWM_INCREMENT:
-            increment = MAX_PWM_INCREMENT if increment > 0 else -MAX_PWM_INCREMENT
-        
-        ch['Duty']-= int(increment)
-        # Clamp duty cycle to valid range when saturation occurs
-        if ch['Duty'] < 0:
-            ch['Duty'] = 0
-            ise=0 #Reset the integrator
-        elif ch['Duty'] > PWM_RESOLUTION:
-            ch['Duty'] = PWM_RESOLUTION
-            ise=0 #Reset the integrator
-        ch['pwm'].duty_u16(ch['Duty'])
-    
-        # Update old error and damp the integrator
-        se_old=se
-        ise*=0.99
+    if v is not None and i is not None:
+        ch.Integrator.add(i, v)
+        if ch.Pulse is None:
+            ch.Aggregate.add(i, v)
+    return i, v
+
+
+@micropython.native
+def regulate(ch:Channel) -> None:
+    """
+    One regulator iteration: poll the sensors and update the PWM duty cycle of the channel
+    """
+    i, v = measure(ch)
+
+    # Skip regulation if sensors return None values
+    if v is None or i is None:
+        return
+
+    # The error signal is computed in fixed point from the register counts, see fixedpid.py
+    if ch.I_SetPoint is None and ch.V_SetPoint is not None: #Voltage regulation
+        if ch.SpValue != ch.V_SetPoint or ch.SpShunt is not None:
+            ch.SpCounts= fixedpid.setpoint_mv(ch.V_SetPoint)
+            ch.SpValue= ch.V_SetPoint
+            ch.SpShunt= None
+        se= fixedpid.voltage_error(ch.SpCounts, ch.Bus)
+    elif ch.V_SetPoint is None and ch.I_SetPoint is not None: #Current regulation
+        """
+        Voltage regulation if fairly easy, but it's another story
+        for current regulation because the load can vary over six decades...
+        The best solution I found is to use an error signal weighted by the current setpoint
+        """
+        # Read once: the range selector interrupt clears it on the other core
+        rshunt= ch.Rshunt
+        if rshunt is None:
+            return
+        if ch.SpValue != ch.I_SetPoint or ch.SpShunt != rshunt:
+            # At least one shunt count, this avoids the case of I_SetPoint=0
+            ch.SpCounts= fixedpid.setpoint_counts(ch.I_SetPoint, rshunt)
+            ch.SpValue= ch.I_SetPoint
+            ch.SpShunt= rshunt
+        se= fixedpid.current_error(ch.SpCounts, ch.Shunt)
+
+    else:
+        log.error("Cant tell wether voltage or current must be regulated on channel %s", ch.Name)
+        return
 
-        await asyncio.sleep_ms(PID_DT)
+    if ch.SettleStart is not None:
+        track_settling(ch, se)
 
+    # PWM Regulation Logic
+    ch.Duty= fixedpid.next_duty(ch.Duty, se, ch.SeOld)
+    ch.pwm.duty_u16(ch.Duty)
 
-def update_load(ch: dict) -> float:
+    # Update old error
+    ch.SeOld=se
+
+
+@micropython.native
+def track_settling(ch:Channel, se:int) -> None:
+    """
+    Count the control periods the Q14 error stays within SETTLE_TOLERANCE after a setpoint change,
+    the settling time is queued in ch.Settled for the communication core to report it
+    """
+    elapsed= time.ticks_diff(time.ticks_ms(), ch.SettleStart)
+    if abs(se) < fixedpid.SETTLE_TOLERANCE_Q:
+        ch.SettleCount+= 1
+        if ch.SettleCount >= SETTLE_PERIODS:
+            settled(ch, elapsed - (SETTLE_PERIODS-1)*control_dt)
+    else:
+        ch.SettleCount= 0
+        if elapsed > SETTLE_TIMEOUT:
+            settled(ch, -1)
+
+
+def settled(ch:Channel, ms:int) -> None:
+    """
+    End the settling tracking of a channel, its result is queued until the next report to the host
+    Only allocates once per setpoint change
+    """
+    if len(ch.Settled) >= SETTLE_REPORTS:
+        ch.Settled.pop(0)
+    ch.Settled.append((ms, ch.SettleFF, ch.SettleSp))
+    ch.SettleStart= None
+
+
+def update_load(ch: Channel) -> float:
     """
     This function calculate the load on the channel by calculating v/i
     To avoid instability, the load is averaged over several iterations
     Iterations are stored in the array 'Load'
-    Argument: channel dictionnary
+    Argument: channel
     Returns: average load
     """
-    if ch['I_Measured'] != 0:
-        R= 1e3*ch['V_Measured'] / ch['I_Measured'] # i is in mA so we need x1e3
+    if ch.I_Measured != 0:
+        R= 1e3*ch.V_Measured / ch.I_Measured # i is in mA so we need x1e3
     else:
         R=1e6 #If no current, assume a load of 1 Mohm
     
-    if len(ch['Load']) > 10: # Remove the oldest value from the array
-        ch['Load'].pop(0)
+    if len(ch.Load) > 10: # Remove the oldest value from the array
+        ch.Load.pop(0)
     
     # Update the array with the current load
-    ch['Load'].append(R)
-
-    return sum(ch['Load']) / len(ch['Load'])
-
+    ch.Load.append(R)
 
-async def do_nothing():
-    """
-    Simple async function that does nothing, used to keep the event loop running when there are no other tasks.
-    It's supposet to improve the accuracy of the timing of the other tasks by yielding control back to the event loop more frequently.
-    """
-    while True:
-        await asyncio.sleep_ms(0)
+    return sum(ch.Load) / len(ch.Load)
 
 
-def poll_sensors(ch:dict) -> tuple:
+@micropython.native
+def poll_sensors(ch:Channel) -> tuple:
     try:
-        # Get the data from the High Current device (range=0)
-        if ch['Range']==0:
-            v = ch['HigIDevice'].bus_voltage(ch['BusId'])
-            i = 1e3*ch['HigIDevice'].current(ch['BusId'])* 0.1 # current() function assumes a shunt resistor of 0.1 ohm, so we need to multiply by 10 to get the correct current for our shunt resistors
-            #print(f"High-I sensor values: {v}, {i}")
-        # Or get it from the low Current device (range>0)
-        else:
-            v = ch['LowIDevice'].bus_voltage(ch['BusId'])
-            i = 1e3*ch['LowIDevice'].current(ch['BusId'])* 0.1
-            #print(f"Low-I sensor values: {v}, {i}")
-
+        # Get the data from the High Current device (range=0) or from the low Current device (range>0)
+        dev = ch.HigIDevice if ch.Range==0 else ch.LowIDevice
+        # Read the registers once, the counts are kept for the raw telemetry fields
+        shunt = dev.shunt_voltage_raw(ch.BusId)
+        bus = dev.bus_voltage_raw(ch.BusId)
+        ch.Shunt = shunt
+        ch.Bus = bus
+        if ch.Pulse is None:
+            ch.ShuntRaw = shunt
+            ch.BusRaw = bus
+        v = bus*BUS_LSB_V
+        i = shunt*SHUNT_LSB_MA # current in mA across a 1 ohm shunt
+        #print(f"Sensor values: {v}, {i}")
 
         # Wait for the shunt resistor to have a value
-        if ch['Rshunt'] is None:
-            print(f"Shunt undefined for channel {ch['Name']}")
+        # Read once: the range selector interrupt clears it without taking the lock
+        rshunt= ch.Rshunt
+        if rshunt is None:
+            log.debug("Shunt undefined for channel %s", ch.Name)
             return (None, v)
         
         # Correct the current regarding the shunt resistor value
-        i/= ch['Rshunt'] # correct the current regarding the shunt resistor value
-        #print("Polled values on ch",ch['Name'], i, v)
+        i/= rshunt # correct the current regarding the shunt resistor value
+        #print("Polled values on ch",ch.Name, i, v)
         #time.sleep(0.5)
         return (i, v)
     
     except Exception as e:
-        print(f"Error polling sensors on channel {ch['Name']}: ", e)
+        log.error("Error polling sensors on channel %s: %s", ch.Name, e)
+        loopstats.count_i2c_error()
         # Disconnect the safety relay since we lost communication with sensors
-        ch['SafetyRelayOn']= False
-        ch['SafetyRelayPin'].value(1)
+        ch.SafetyRelayOn= False
+        ch.SafetyRelayPin.value(1)
         return (None, None)
 
 
 
-def get_values(ch:dict):
-    try:
-        i, v = poll_sensors(ch)
-        
-        # update the channel dictionary
-        ch['I_Measured'] = i
-        # add a logic later to choose between highI and lowI based on the value
-        ch['V_Measured'] = v
-        return True
-    except Exception as e:
-        print(f"Error getting i and v on channel {ch['Name']}: ", e)
-        return False
-
-
-
 async def test_pwm_output():
     """
     This function simply sweep the pwm duty cycle from 0 to max
@@ -395,148 +996,373 @@ async def safety_relays_control(channels:list)-> None:
         - the voltage and current limits givent in congif.py (board protection)
         - user-defined MaxPower variable set for each channel (measured device protection)
     A the safety relay is triggered if a value is exceeded
-    Then the user has to press a button to reactivate the output
+    Then the user has to press a button to reactivate the output, see watch_user_panel_state()
     """
     # On startup, activate all the realys
     for ch in channels:
-        ch['SafetyRelayPin'].value(0)
+        ch.SafetyRelayPin.value(0)
     # Then we get in the monitoring loop
+    stats= loopstats.LoopStats('safety')
     while True:
         await asyncio.sleep_ms(100)
+        stats.tick(100000)
         for ch in channels:
-            currently_on= ch['SafetyRelayOn']
-            v= ch['V_Measured']
-            i= ch['I_Measured']
-            message=""
-            # Voltage limit
-            if v is not None and v > MAX_VOLTAGE:
-                ch['SafetyRelayOn']= False
-                message="Max voltage reached"
-            # Current limit
-            if ch['Range'] is not None and i is not None:
-                if i > MAX_CURRENTS[ch['Range']]:
-                    ch['SafetyRelayOn']= False
-                    message="Max current reached"
-            # Power limit
-            if ch['MaxPower'] is not None and v is not None and i is not None:
-                if i*v > ch['MaxPower']:
-                    ch['SafetyRelayOn']= False
-                    message="Max power reached"
-            # Actuate the relay is a change was detected
-            if ch['SafetyRelayOn'] != currently_on:
-                ch['SafetyRelayPin'].value(1)
-                print(f"Ch {ch['Name']}: SafetyRelayOn Going from {currently_on} to {ch['SafetyRelayOn']}")
-                ch['State']='Alert'
-                write_serial(f"CH {ch['Name']} Alert {message}")
-        
-        # Check if the user is holding the reactivation button
-        buttonstate= not bool(sractivate.value())
-        if buttonstate:
-            print("User-button pressed, reactivating all safety switches...")
-            for ch in channels:
-                ch['SafetyRelayOn']= True
-                ch['SafetyRelayPin'].value(0)
-                # Update the push-pull switch state to refresh the textbox showing the board status
-                write_serial(f"CH {ch['Name']} PushPullConnected {ch['PushPullConnected']}")
+            # The limits are checked by the control loop, report the trips
+            message= ch.Alert
+            if message is not None:
+                ch.Alert= None
+                log.warn("Ch %s: SafetyRelayOn Going from True to False", ch.Name)
+                write_serial(f"ALERT {ch.Name} {message}")
 
 
 
+def trip_on_limits(ch:Channel) -> None:
+    """
+    Open the safety relay of a channel as soon as a limit is exceeded
+    The reason is left in ch.Alert for the communication core to report it
+    """
+    if ch.SafetyRelayOn:
+        message= check_limits(ch)
+        if message:
+            ch.SafetyRelayOn= False
+            ch.SafetyRelayPin.value(1)
+            ch.State='Alert'
+            ch.Alert= message
+            ch.Capture.trigger('alert')
+
+
+def control_loop(channels:list) -> None:
+    """
+    Regulation and safety loop of the second core
+    Each period regulates all channels in turn and checks their limits,
+    the period is kept on an absolute deadline so it does not depend on the work time
+    The phases of a pulse falling before the next period run at their own deadlines
+    """
+    log.info("Starting the control loop on core1...")
+    stats= loopstats.LoopStats('control')
+    deadline= time.ticks_us()
+    while True:
+        period= control_dt*1000
+        stats.tick(period)
+        control_step(channels)
+        deadline= time.ticks_add(deadline, period)
+        while pulse_channel is not None and time.ticks_diff(pulse_deadline, deadline) < 0:
+            delay= time.ticks_diff(pulse_deadline, time.ticks_us())
+            if delay > 0:
+                time.sleep_us(delay)
+            advance_pulse()
+        delay= time.ticks_diff(deadline, time.ticks_us())
+        if delay > 0:
+            time.sleep_us(delay)
+        else: # Overrun, start a new period from now
+            loopstats.count_overrun()
+            deadline= time.ticks_us()
+
+
+def control_step(channels:list) -> None:
+    """
+    One control period: regulate the active channels in turn, or start their pulse, read the monitored ones
+    when due, and check their limits. Parked channels are skipped, and so is a channel during its pulse
+    The measurements are recorded for the transient capture
+    The deadline of the pulse in progress is checked before each channel
+    """
+    for ch in channels:
+        advance_pulse()
+        if ch.Activity == 'parked' or ch is pulse_channel:
+            continue
+        with state_lock:
+            try:
+                if ch.Characterizing:
+                    pass
+                elif ch.Activity == 'monitor':
+                    if not monitor_due(ch):
+                        continue
+                    measure(ch)
+                elif ch.Pulse is not None and pulse_due(ch.Pulse) and start_pulse(ch, ch.Pulse):
+                    pass
+                else:
+                    regulate(ch)
+                trip_on_limits(ch)
+                ch.Capture.record(ch.I_Measured, ch.V_Measured)
+                ch.Errors= 0
+            except Exception as e:
+                control_error(ch, e)
+    advance_pulse()
+
+
+def control_error(ch:Channel, e:Exception) -> None:
+    """
+    An exception in the control period of a channel is logged and counted, the loop goes on with the others
+    After CONTROL_ERROR_LIMIT failing periods in a row the safety relay of the channel is opened,
+    its output is no longer regulated nor checked
+    """
+    loopstats.count_control_error()
+    ch.Errors+= 1
+    if ch.Errors == 1: # The following ones of the same run are only counted
+        log.error("Control error on channel %s: %s", ch.Name, e)
+    if ch.Errors >= CONTROL_ERROR_LIMIT and ch.SafetyRelayOn:
+        log.error("Channel %s: %d control errors in a row, opening the safety relay", ch.Name, ch.Errors)
+        ch.SafetyRelayOn= False
+        ch.SafetyRelayPin.value(1)
+        ch.State='Alert'
+        ch.Alert= 'Control errors'
+
+
+def monitor_due(ch:Channel) -> bool:
+    now= time.ticks_ms()
+    if time.ticks_diff(now, ch.LastPoll) < MONITOR_PERIOD:
+        return False
+    ch.LastPoll= now
+    return True
+
+
+def pulse_due(p:Pulse) -> bool:
+    p.Ticks+= 1
+    if p.Ticks < p.Period:
+        return False
+    p.Ticks= 0
+    return True
+
+
+def start_pulse(ch:Channel, p:Pulse) -> bool:
+    """
+    Apply the pulse duty cycle of a channel, the following phases run at their deadlines (see advance_pulse()),
+    the control loop goes on meanwhile
+    Returns False if the pulse of another channel is running, this one is then due again on the next period
+    """
+    global pulse_channel, running_pulse, pulse_deadline
+    if pulse_channel is not None:
+        p.Ticks= p.Period - 1
+        return False
+    if ch.Range is None or ch.Rshunt is None:
+        return True
+    p.Device= ch.HigIDevice if ch.Range==0 else ch.LowIDevice
+    p.Config= None
+    ch.pwm.duty_u16(p.Duty)
+    p.Start= time.ticks_us()
+    p.Phase= PULSE_ON
+    pulse_deadline= time.ticks_add(p.Start, p.Delay)
+    running_pulse= p
+    pulse_channel= ch
+    return True
+
+
+def advance_pulse() -> None:
+    """
+    Run the phase of the pulse in progress once its deadline passed: start a single-shot conversion
+    Delay us after the pulse start, then after Width us go back to the base duty cycle, read the conversion
+    and correct the pulse duty cycle from the sample
+    Called at the deadlines by the pulse timer or the control loop of the second core, and on every control period
+    in case they came late: nothing waits for the pulse, the regulation of the other channels goes on meanwhile
+    """
+    global pulse_channel, running_pulse, pulse_deadline
+    ch= pulse_channel
+    if ch is None or time.ticks_diff(time.ticks_us(), pulse_deadline) < 0:
+        return
+    p= running_pulse
+    with state_lock:
+        try:
+            if p.Phase == PULSE_ON:
+                p.Config= p.Device.start_single_shot(ch.BusId)
+                p.Phase= PULSE_SAMPLING
+                pulse_deadline= time.ticks_add(p.Start, p.Width)
+                return
+            # Back to the base duty cycle, the one set meanwhile if the channel was parked
+            ch.pwm.duty_u16(ch.Duty)
+            if p.Device.conversion_ready():
+                sample_pulse(ch, p, p.Device.shunt_voltage_raw(ch.BusId), p.Device.bus_voltage_raw(ch.BusId))
+            # Otherwise the conversion did not complete before the end of the pulse
+            p.Device.restore_config(p.Config)
+        except Exception as e:
+            ch.pwm.duty_u16(ch.Duty)
+            log.error("Error sampling the pulse on channel %s: %s", ch.Name, e)
+            loopstats.count_i2c_error()
+        p.Phase= PULSE_IDLE
+        running_pulse= None
+        pulse_channel= None
+
+
+@micropython.native
+def sample_pulse(ch:Channel, p:Pulse, shunt:int, bus:int) -> None:
+    """Store the in-pulse sample, and regulate the pulse level from one pulse to the next"""
+    rshunt= ch.Rshunt
+    if rshunt is None: # The range changed during the pulse
+        return
+    ch.ShuntRaw= shunt
+    ch.BusRaw= bus
+    i= shunt*SHUNT_LSB_MA/rshunt
+    v= bus*BUS_LSB_V
+    ch.I_Measured= i
+    ch.V_Measured= v
+    ch.Aggregate.add(i, v)
+    p.Count+= 1
+
+    if ch.V_SetPoint is not None:
+        se= fixedpid.voltage_error(fixedpid.setpoint_mv(p.SetPoint), bus)
+    else:
+        se= fixedpid.current_error(fixedpid.setpoint_counts(p.SetPoint, rshunt), shunt)
+    p.Duty= fixedpid.next_duty(p.Duty, se, p.SeOld)
+    p.SeOld= se
+
+
+def control_tick(channels:list) -> None:
+    """Control period scheduled by the timer interrupt, restarted at a new frequency when the period changes"""
+    global tick_pending, timer_dt
+    try:
+        control_stats.tick(timer_dt*1000)
+        control_step(channels)
+        arm_pulse_timer()
+        if control_dt != timer_dt:
+            timer_dt= control_dt
+            control_timer.init(freq=1000/timer_dt, mode=Timer.PERIODIC, callback=control_isr)
+    finally:
+        # Otherwise every following tick would be counted as an overrun and skipped
+        tick_pending= False
+
+
+def control_isr(timer) -> None:
+    """
+    Timer interrupt: schedule the control period as a soft interrupt,
+    since I2C transfers are not allowed in the interrupt itself
+    A tick still pending when the next one fires is skipped, as is one the full schedule queue cannot take
+    """
+    global tick_pending
+    if tick_pending:
+        loopstats.count_overrun()
+        return
+    tick_pending= True
+    try:
+        micropython.schedule(control_tick, control_channels)
+    except RuntimeError: # Schedule queue full
+        tick_pending= False
+        loopstats.count_overrun()
+
+
+def arm_pulse_timer() -> None:
+    """Fire the pulse timer at the deadline of the next phase of the pulse in progress, if any"""
+    if pulse_channel is None:
+        return
+    wait= time.ticks_diff(pulse_deadline, time.ticks_us())
+    pulse_timer.init(freq=1000000/max(wait, PULSE_TIMER_MIN_US), mode=Timer.ONE_SHOT, callback=pulse_isr)
+
+
+def pulse_tick(_) -> None:
+    """Pulse phase scheduled by the pulse timer, the timer is then set for the next one"""
+    advance_pulse()
+    arm_pulse_timer()
+
+
+def pulse_isr(timer) -> None:
+    """
+    Pulse timer interrupt: schedule the phase as a soft interrupt, like control_isr()
+    A phase the full schedule queue cannot take runs on the next control period
+    """
+    try:
+        micropython.schedule(pulse_tick, None)
+    except RuntimeError:
+        pass
+
+
+def start_control(channels:list) -> None:
+    """
+    Start the control loop, on the second core or driven by a hardware timer at exactly 1/control_dt
+    The timer-driven loop runs the pulse phases on a second, one-shot timer
+    """
+    global control_timer, control_stats, control_channels, timer_dt, pulse_timer
+    if CONTROL_ON_CORE1:
+        _thread.start_new_thread(control_loop, (channels,))
+    else:
+        log.info("Starting the timer-driven control loop...")
+        control_channels= channels
+        control_stats= loopstats.LoopStats('control')
+        timer_dt= control_dt
+        pulse_timer= Timer()
+        control_timer= Timer(freq=1000/timer_dt, mode=Timer.PERIODIC, callback=control_isr)
+
+
+@micropython.native
+def check_limits(ch:Channel) -> str:
+    """
+    Check the board and user limits of a channel
+    Returns the reason of the trip, or an empty string if all values are within the limits
+    """
+    v= ch.V_Measured
+    i= ch.I_Measured
+    message=""
+    # Voltage limit
+    if v is not None and v > MAX_VOLTAGE:
+        message="Max voltage reached"
+    # Current limit
+    if ch.Range is not None and i is not None:
+        if i > MAX_CURRENTS[ch.Range]:
+            message="Max current reached"
+    # Power limit
+    if ch.MaxPower is not None and v is not None and i is not None:
+        if i*v > ch.MaxPower:
+            message="Max power reached"
+    return message
+
+
+async def memory_keeper():
+    """
+    Run the garbage collections ourselves when the free heap gets low,
+    so that their number and duration are known and they rarely happen within the regulators,
+    and count the automatic ones that happened anyway
+    """
+    while True:
+        loopstats.watch_heap()
+        if gc.mem_free() < GC_MIN_FREE:
+            loopstats.collect()
+        await asyncio.sleep_ms(100)
+
+
 async def main():
-    print("Starting the program...")
+    log.info("Starting the program...")
+    feedforward.load()
 
     # Define channels parameters
     channels = [
-        {'Name': 'a',
-        'V_SetPoint': 0,  # Target voltage in volts
-        'I_SetPoint': None,  # Target current in milliamps
-        'MaxPower': None,
-        'V_Measured': None,
-        'I_Measured': None,
-        'Range': None,
-        'Rshunt': None,
-        'Load': [],
-        'Duty': 0,
-        'PushPullConnected': True,
-        'State': '',
-        'SafetyRelayPin': sra,
-        'SafetyRelayOn': True,
-        'SwitchPin': ppswitcha,
-        'pwm': pwma,
-        'HigIDevice': inaA,
-        'LowIDevice': inaB,
-        'BusId': 1},
-        
-        {'Name': 'b',
-        'V_SetPoint': 0,  # Target voltage in volts
-        'I_SetPoint': None,  # Target current in milliamps
-        'MaxPower': None,
-        'V_Measured': None,
-        'I_Measured': None,
-        'Range': None,
-        'Rshunt': None,
-        'Load': [],
-        'Duty': 0,
-        'PushPullConnected': False,
-        'State': '',
-        'SafetyRelayPin': srb,
-        'SafetyRelayOn': True,
-        'SwitchPin': ppswitchb,
-        'pwm': pwmb,
-        'HigIDevice': inaA,
-        'LowIDevice': inaB,
-        'BusId': 2},
-
-        {'Name': 'c',
-        'V_SetPoint': 0,  # Target voltage in volts
-        'I_SetPoint': None,  # Target current in milliamps
-        'MaxPower': None,
-        'V_Measured': None,
-        'I_Measured': None,
-        'Range': None,
-        'Rshunt': None,
-        'Load': [],
-        'Duty': 0,
-        'PushPullConnected': False,
-        'State': '',
-        'SafetyRelayPin': src,
-        'SafetyRelayOn': True,
-        'SwitchPin': ppswitchc,
-        'pwm': pwmc,
-        'HigIDevice': inaA,
-        'LowIDevice': inaB,
-        'BusId': 3}
+        Channel('a', sra, ppswitcha, pwma, inaA, inaB, 1, push_pull_connected=True),
+        Channel('b', srb, ppswitchb, pwmb, inaA, inaB, 2),
+        Channel('c', src, ppswitchc, pwmc, inaA, inaB, 3)
     ]
 
+    for ch in channels:
+        update_activity(ch, channels)
+
     # Start range selector monitoring task
     asyncio.create_task(watch_user_panel_state(channels))
 
     # Start serial communication task
+    asyncio.create_task(link.tx_loop())
     asyncio.create_task(serial_write(channels))
     asyncio.create_task(serial_read(channels))
     asyncio.create_task(send_channels_state(channels))
+    asyncio.create_task(upload_captures(channels))
+    asyncio.create_task(log.forward())
 
-    # Start the regulation tasks
-    for ch in channels:
-        asyncio.create_task(regulator(ch))
+    # Start the regulation
+    start_control(channels)
 
     # Safety relays task
     asyncio.create_task(safety_relays_control(channels))
     
-    # Start do_nothing task to keep the event loop running
-    asyncio.create_task(do_nothing())
+    # Garbage collection task
+    asyncio.create_task(memory_keeper())
 
 
 
-# Create an Event Loop
-loop = asyncio.get_event_loop()
-# Create a task to run the main function
-loop.create_task(main())
-#loop.create_task(test_pwm_output())
+if __name__ == '__main__':
+    # Create an Event Loop
+    loop = asyncio.get_event_loop()
+    # Create a task to run the main function
+    loop.create_task(main())
+    #loop.create_task(test_pwm_output())
 
-try:
-    # Run the event loop indefinitely
-    loop.run_forever()
-except Exception as e:
-    print('Error occurred: ', e)
-except KeyboardInterrupt:
-    print('Program Interrupted by the user')
\ No newline at end of file
+    try:
+        # Run the event loop indefinitely
+        loop.run_forever()
+    except Exception as e:
+        print('Error occurred: ', e)
+    except KeyboardInterrupt:
+        print('Program Interrupted by the user')
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""
+Front panel inputs: range selector, push-pull switches and safety relays reactivation button
+Pin interrupts wake the panel task instead of polling the pins,
+the pins are read once they have been stable for PANEL_DEBOUNCE_MS
+"""
+import time
+import asyncio
+from machine import Pin
+from config import PANEL_DEBOUNCE_MS
+
+changed = asyncio.ThreadSafeFlag()
+last_edge = 0  # ticks_ms of the last edge on any panel pin
+
+
+def _on_edge(pin) -> None:
+    global last_edge
+    last_edge = time.ticks_ms()
+    changed.set()
+
+
+def watch(pins: list, on_edge=None) -> None:
+    """
+    Wake wait_stable() on both edges of pins
+    on_edge(pin) is also called right from the interrupt, before the debouncing
+    """
+    if on_edge is None:
+        handler = _on_edge
+    else:
+        def handler(pin):
+            on_edge(pin)
+            _on_edge(pin)
+    for pin in pins:
+        pin.irq(handler=handler, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING)
+
+
+async def wait_stable() -> None:
+    """Wait for a pin change, then until no pin has bounced for PANEL_DEBOUNCE_MS"""
+    await changed.wait()
+    while True:
+        quiet = time.ticks_diff(time.ticks_ms(), last_edge)
+        if quiet >= PANEL_DEBOUNCE_MS:
+            return
+        await asyncio.sleep_ms(PANEL_DEBOUNCE_MS - quiet)
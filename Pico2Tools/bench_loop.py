@@ -0,0 +1,102 @@
+"""
+Loop-time benchmark of the per-iteration work done by the regulator, sensors polling and safety loops
+The Channel-based functions of main.py are compared with the former dictionnary-based code
+
+On the board: copy this file next to the firmware and run it instead of main.py
+On the unix port of MicroPython, with the fake machine module:
+    cd Pico2Tools && MICROPYPATH=fakes:../Pico2Internal micropython bench_loop.py
+"""
+import time
+from main import *
+
+N = 2000
+
+
+# Former dictionnary-based implementation, kept here as the reference
+def dict_poll_sensors(ch:dict) -> tuple:
+    if ch['Range']==0:
+        v = ch['HigIDevice'].bus_voltage(ch['BusId'])
+        i = 1e3*ch['HigIDevice'].current(ch['BusId'])* 0.1
+    else:
+        v = ch['LowIDevice'].bus_voltage(ch['BusId'])
+        i = 1e3*ch['LowIDevice'].current(ch['BusId'])* 0.1
+    if ch['Rshunt'] is None:
+        return (None, v)
+    i/= ch['Rshunt']
+    return (i, v)
+
+
+def dict_regulate(ch:dict, se_old:float) -> float:
+    i, v = dict_poll_sensors(ch)
+    ch['I_Measured'] = i
+    ch['V_Measured'] = v
+    Ki= 1e-4
+    Kp= 5e-3
+    Kd= 5e-1
+    se= 0
+    if ch['I_SetPoint'] is None and ch['V_SetPoint'] is not None:
+        se= ch['V_SetPoint']-ch['V_Measured']
+    elif ch['V_SetPoint'] is None and ch['I_SetPoint'] is not None:
+        if ch['I_SetPoint'] < 1e-6:
+            ch['I_SetPoint']= 1e-6
+        se= 1-ch['I_Measured']/ch['I_SetPoint']
+    ise= se*PID_DT
+    dse= (se-se_old)/PID_DT
+    increment= (Kp*se + Kd*dse + Ki*ise)*PWM_RESOLUTION
+    if abs(increment) > MAX_PWM_INCREMENT:
+        increment = MAX_PWM_INCREMENT if increment > 0 else -MAX_PWM_INCREMENT
+    ch['Duty']-= int(increment)
+    if ch['Duty'] < 0:
+        ch['Duty'] = 0
+    elif ch['Duty'] > PWM_RESOLUTION:
+        ch['Duty'] = PWM_RESOLUTION
+    ch['pwm'].duty_u16(ch['Duty'])
+    return se
+
+
+def dict_check_limits(ch:dict) -> str:
+    v= ch['V_Measured']
+    i= ch['I_Measured']
+    message=""
+    if v is not None and v > MAX_VOLTAGE:
+        message="Max voltage reached"
+    if ch['Range'] is not None and i is not None:
+        if i > MAX_CURRENTS[ch['Range']]:
+            message="Max current reached"
+    if ch['MaxPower'] is not None and v is not None and i is not None:
+        if i*v > ch['MaxPower']:
+            message="Max power reached"
+    return message
+
+
+def timeit(label:str, fn, arg) -> float:
+    """Run fn(arg) N times and return the mean duration of one call in microseconds"""
+    t0= time.ticks_us()
+    for _ in range(N):
+        fn(arg)
+    dt= time.ticks_diff(time.ticks_us(), t0) / N
+    print(f"{label:<24}{dt:8.2f} us/iteration")
+    return dt
+
+
+def run():
+    obj= Channel('a', sra, ppswitcha, pwma, inaA, inaB, 1, push_pull_connected=True)
+    obj.Range, obj.Rshunt, obj.V_SetPoint, obj.MaxPower= 1, SHUNTS[1], 2.5, 1000
+    d= {'Name': 'a', 'V_SetPoint': 2.5, 'I_SetPoint': None, 'MaxPower': 1000,
+        'V_Measured': None, 'I_Measured': None, 'Range': 1, 'Rshunt': SHUNTS[1],
+        'Duty': 0, 'pwm': pwma, 'HigIDevice': inaA, 'LowIDevice': inaB, 'BusId': 1}
+
+    print(f"Mean time over {N} iterations")
+    saved= 0
+    for label, old, new, arg_old, arg_new in (
+            ('poll_sensors', dict_poll_sensors, poll_sensors, d, obj),
+            ('regulate', lambda ch: dict_regulate(ch, 0.0), regulate, d, obj),
+            ('check_limits', dict_check_limits, check_limits, d, obj)):
+        t_old= timeit(f"{label} (dict)", old, arg_old)
+        t_new= timeit(f"{label} (Channel)", new, arg_new)
+        print(f"{label:<24}{t_old-t_new:8.2f} us saved")
+        saved+= t_old-t_new
+    print(f"Total saved per channel and iteration: {saved:.2f} us")
+
+
+run()
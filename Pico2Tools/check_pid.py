@@ -0,0 +1,207 @@
+"""
+Comparison of the fixed-point PID (fixedpid.py) with the former float implementation
+Both versions are fed the same register counts, open loop with random inputs and closed loop on a simulated output stage,
+in voltage and current regulation and at both control periods.
+Open loop, the duty cycles must agree within TOLERANCE counts while both errors are within the +-16 clamp of fixedpid,
+beyond it only the differing samples are reported. Closed loop, the output voltages must agree within LOOP_TOLERANCE.
+Allocations: on MicroPython the heap use of the fixed-point iterations is measured,
+on CPython the largest intermediate products are checked against the small int limit of the rp2 port,
+with SMALL_INT_MARGIN of headroom. Only the PID iterations are covered, the float measurements
+of the control step around them allocate
+
+On the host:
+    cd Pico2Tools && python check_pid.py
+On the unix port of MicroPython:
+    cd Pico2Tools && micropython check_pid.py
+"""
+import sys
+import random
+
+# The firmware modules, from the folder uploaded to the board
+sys.path.append('../Pico2Internal')
+
+try:
+    import micropython
+except ImportError:
+    # CPython: the decorators and const() of the firmware have no effect
+    import types
+    micropython = types.ModuleType('micropython')
+    micropython.const = lambda x: x
+    micropython.native = lambda f: f
+    micropython.viper = lambda f: f
+    sys.modules['micropython'] = micropython
+
+from config import *
+import fixedpid
+
+TOLERANCE = 2  # Duty cycle counts, each PID term is truncated on its own
+LOOP_TOLERANCE = 0.01  # Output voltage difference relative to the full scale
+STEPS = 20000
+LOOP_STEPS = 2000
+SMALL_INT = 1 << 30  # Larger ints are heap objects on the rp2 port
+SMALL_INT_MARGIN = 0.8  # Largest fraction of SMALL_INT accepted for the intermediate products
+
+
+# Former float implementation, kept here as the reference
+def float_next_duty(duty, se, se_old, dt):
+    ise= se*dt
+    dse= (se-se_old)/dt # Derivative of error
+    increment= (PID_KP*se + PID_KD*dse + PID_KI*ise)*PWM_RESOLUTION
+    if increment > MAX_PWM_INCREMENT:
+        increment = MAX_PWM_INCREMENT
+    elif increment < -MAX_PWM_INCREMENT:
+        increment = -MAX_PWM_INCREMENT
+    duty-= int(increment)
+    if duty < 0:
+        return 0
+    if duty > PWM_RESOLUTION:
+        return PWM_RESOLUTION
+    return duty
+
+
+def float_error(voltage_mode, sp, shunt, bus, rshunt):
+    if voltage_mode:
+        return sp - bus*BUS_LSB_V
+    return 1 - shunt*SHUNT_LSB_MA/rshunt/max(sp, 1e-6)
+
+
+def fixed_error(voltage_mode, sp, shunt, bus, rshunt):
+    if voltage_mode:
+        return fixedpid.voltage_error(fixedpid.setpoint_mv(sp), bus)
+    return fixedpid.current_error(fixedpid.setpoint_counts(sp, rshunt), shunt)
+
+
+def random_setpoint(voltage_mode, rshunt):
+    if voltage_mode:
+        return random.uniform(0, MAX_VOLTAGE)
+    # Between 1% and 100% of the range full scale
+    return 10**random.uniform(-2, 0) * 32760*SHUNT_LSB_MA/rshunt
+
+
+def open_loop(voltage_mode, dt) -> tuple:
+    """Worst duty cycle difference over random inputs and previous errors, and the count of clamped samples that differ"""
+    worst= 0
+    clamped= 0
+    se_max= fixedpid.SE_LIMIT/(1 << fixedpid.SE_BITS)
+    for _ in range(STEPS):
+        rshunt= random.choice(list(SHUNTS.values()))
+        sp= random_setpoint(voltage_mode, rshunt)
+        counts= [(random.randrange(-4, 4096)*8, random.randrange(0, 1000)*8) for _ in range(2)]
+        duty= random.randrange(PWM_RESOLUTION+1)
+        se_old_f= float_error(voltage_mode, sp, counts[0][0], counts[0][1], rshunt)
+        se_old_q= fixed_error(voltage_mode, sp, counts[0][0], counts[0][1], rshunt)
+        se_f= float_error(voltage_mode, sp, counts[1][0], counts[1][1], rshunt)
+        se_q= fixed_error(voltage_mode, sp, counts[1][0], counts[1][1], rshunt)
+        d_f= float_next_duty(duty, se_f, se_old_f, dt)
+        d_q= fixedpid.next_duty(duty, se_q, se_old_q)
+        if abs(se_f) > se_max or abs(se_old_f) > se_max:
+            clamped+= abs(d_f - d_q) > TOLERANCE
+        else:
+            worst= max(worst, abs(d_f - d_q))
+    return worst, clamped
+
+
+class OutputStage:
+    """Inverting push-pull output with a first-order lag, loaded by a resistor (kohm)"""
+
+    def __init__(self, load, rshunt):
+        self.v= 0.0
+        self.load= load
+        self.rshunt= rshunt
+
+    def step(self, duty, dt):
+        target= MAX_VOLTAGE*(1 - duty/PWM_RESOLUTION)
+        self.v+= (target - self.v)*min(1, dt/20)
+
+    def counts(self):
+        i= self.v/self.load # mA
+        shunt= min(int(i*self.rshunt/SHUNT_LSB_MA/8)*8, 32760)
+        bus= int(self.v*1000/8)*8
+        return shunt, bus
+
+
+def closed_loop(voltage_mode, dt) -> tuple:
+    """
+    Worst output voltage difference along a regulation, relative to the full scale, and the final error
+    Both versions drive their own output stage: a single count of difference changes the following inputs,
+    so the duty cycles are not compared along the trajectory
+    """
+    rshunt= SHUNTS[1]
+    load= 0.1 # kohm
+    sp= 3.3 if voltage_mode else 20.0
+    stage_f, stage_q= OutputStage(load, rshunt), OutputStage(load, rshunt)
+    duty_f= duty_q= PWM_RESOLUTION
+    se_old_f= 0.0
+    se_old_q= 0
+    worst= 0
+    for _ in range(LOOP_STEPS):
+        shunt, bus= stage_f.counts()
+        se= float_error(voltage_mode, sp, shunt, bus, rshunt)
+        duty_f= float_next_duty(duty_f, se, se_old_f, dt)
+        se_old_f= se
+        shunt, bus= stage_q.counts()
+        se= fixed_error(voltage_mode, sp, shunt, bus, rshunt)
+        duty_q= fixedpid.next_duty(duty_q, se, se_old_q)
+        se_old_q= se
+        stage_f.step(duty_f, dt)
+        stage_q.step(duty_q, dt)
+        worst= max(worst, abs(stage_f.v - stage_q.v)/MAX_VOLTAGE)
+    final= stage_q.v - sp if voltage_mode else stage_q.v/load/sp - 1
+    return worst, final
+
+
+def allocations() -> bool:
+    if sys.implementation.name == 'micropython':
+        import gc
+        se_old= 0
+        duty= PWM_RESOLUTION//2
+        gc.collect()
+        gc.disable()
+        before= gc.mem_alloc()
+        for n in range(1000):
+            se= fixedpid.voltage_error(3300, 3000 + (n & 255)*8)
+            duty= fixedpid.next_duty(duty, se, se_old)
+            se= fixedpid.current_error(4000, 3000 + (n & 255)*8)
+            duty= fixedpid.next_duty(duty, se, se_old)
+            se_old= se
+        used= gc.mem_alloc() - before
+        gc.enable()
+        print(f"Heap used by 1000 fixed-point iterations: {used} bytes")
+        return used == 0
+    ok= True
+    for dt in (PID_DT, PID_DT_FAST):
+        fixedpid.set_period(dt)
+        gp, gd, limit= fixedpid.gains
+        products= {
+            'proportional': gp*fixedpid.SE_LIMIT,
+            'derivative': gd*limit,
+            # Clamped setpoint against the most negative bus count
+            'voltage error': ((fixedpid.SETPOINT_MV_LIMIT + fixedpid.COUNTS_LIMIT + 1) << fixedpid.SE_BITS) + 500,
+            'current error': (fixedpid.COUNTS_LIMIT << fixedpid.SE_BITS) + fixedpid.COUNTS_LIMIT//2
+        }
+        for label, value in products.items():
+            print(f"dt={dt} ms  largest {label} product: {value:>11} ({value/SMALL_INT:.0%} of the small int limit)")
+            ok= ok and value < SMALL_INT*SMALL_INT_MARGIN
+    return ok
+
+
+def run():
+    random.seed(1)
+    ok= True
+    for dt in (PID_DT, PID_DT_FAST):
+        fixedpid.set_period(dt)
+        for voltage_mode in (True, False):
+            mode= 'voltage' if voltage_mode else 'current'
+            worst, clamped= open_loop(voltage_mode, dt)
+            loop_worst, final= closed_loop(voltage_mode, dt)
+            print(f"dt={dt} ms {mode:<8} open loop: {worst} counts ({clamped} clamped samples differ)  "
+                  f"closed loop: {loop_worst:.2%} of full scale, final error {final:+.4f}")
+            ok= ok and worst <= TOLERANCE and loop_worst <= LOOP_TOLERANCE
+    alloc_ok= allocations()
+    print("✓ Fixed-point PID matches the float version" if ok else "✗ Fixed-point PID differs from the float version")
+    print("✓ No allocation per PID iteration" if alloc_ok else "✗ The fixed-point PID iterations allocate")
+    if not (ok and alloc_ok):
+        sys.exit(1)
+
+
+run()
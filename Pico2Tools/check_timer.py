@@ -0,0 +1,90 @@
+"""
+Rate of the timer-driven control loop (CONTROL_ON_CORE1 = False), on the simulated board of sim/
+The firmware runs on the virtual clock of the simulator: the control periods must run 1000/control_dt times per second,
+at PID_DT and at PID_DT_FAST (enabled for the check) once a single channel is regulated. Ticks firing while the previous one is still
+pending, or refused by a full schedule queue, must be counted as overruns without stopping the loop,
+and so must a control period raising an error
+
+On the host, with the micropython, machine and time modules of the simulator:
+    cd Pico2Tools && python check_timer.py
+"""
+import sys
+from sim.simulator import Simulator
+from sim.dut import Resistor
+
+RUN_MS = 1000
+
+
+def check(name: str, ok: bool, detail: str) -> bool:
+    print(f"{'OK  ' if ok else 'FAIL'} {name}: {detail}")
+    return ok
+
+
+def run() -> bool:
+    # The timer restarts at the other period when a single channel is regulated
+    sim= Simulator({'a': Resistor(100)}, overrides={'PID_DT_FAST_ENABLED': True})
+    main= sim.main
+    loopstats= main.loopstats
+    micropython= main.micropython
+
+    def ticks_per_second() -> int:
+        count= main.control_stats.count
+        sim.run(RUN_MS)
+        return main.control_stats.count - count
+
+    ok= True
+
+    # Nothing regulated: the default period
+    sim.command("activity a monitor")
+    sim.run(2*main.PID_DT)
+    n= ticks_per_second()
+    ok&= check("idle rate", n == RUN_MS // main.control_dt, f"{n} ticks in {RUN_MS} ms at {main.control_dt} ms")
+
+    # One regulated channel, the timer restarts at the new period on the next tick
+    sim.command("activity a auto")
+    sim.run(2*main.PID_DT)
+    overruns= loopstats.overruns
+    n= ticks_per_second()
+    ok&= check("regulating rate", n == RUN_MS // main.control_dt, f"{n} ticks in {RUN_MS} ms at {main.control_dt} ms")
+    ok&= check("no overrun", loopstats.overruns == overruns, f"{loopstats.overruns - overruns} overruns")
+
+    # Ticks held back by the scheduler are overruns, the loop goes on once the pending one ran
+    pending= []
+    schedule= micropython.schedule
+    micropython.schedule= lambda f, arg: pending.append((f, arg))
+    sim.run(3*main.timer_dt)
+    ok&= check("pending ticks", len(pending) == 1 and loopstats.overruns == overruns + 2,
+               f"{len(pending)} scheduled, {loopstats.overruns - overruns} overruns")
+    for f, arg in pending:
+        f(arg)
+
+    # Full schedule queue
+    def full(f, arg):
+        raise RuntimeError("schedule queue full")
+    micropython.schedule= full
+    sim.run(main.timer_dt)
+    micropython.schedule= schedule
+    ok&= check("queue full", loopstats.overruns == overruns + 3 and not main.tick_pending,
+               f"{loopstats.overruns - overruns} overruns")
+
+    # A control period raising an error
+    step= main.control_step
+    def failing(channels):
+        raise ValueError("failing control period")
+    main.control_step= failing
+    try:
+        sim.run(main.timer_dt)
+    except ValueError:
+        pass
+    main.control_step= step
+    n= ticks_per_second()
+    ok&= check("after an error", n == RUN_MS // main.control_dt and loopstats.overruns == overruns + 3,
+               f"{n} ticks, {loopstats.overruns - overruns} overruns")
+    return ok
+
+
+if run():
+    print("✓ Timer-driven loop rate checked")
+else:
+    print("✗ Timer-driven loop failed")
+    sys.exit(1)
@@ -0,0 +1,135 @@
+"""
+Fake machine module to run the firmware on the unix port of MicroPython (or CPython)
+Only the features used by device.py are implemented, peripherals keep their state in memory
+"""
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        # Inputs with pull-up resistors read high until something drives them
+        self._value = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self._value = value
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self._irq = handler
+
+    def drive(self, v):
+        """Test helper: change an input level and fire its interrupt handler"""
+        self._value = 1 if v else 0
+        if getattr(self, '_irq', None) is not None:
+            self._irq(self)
+
+
+class PWM:
+    def __init__(self, pin, freq=1000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+
+    def freq(self, f=None):
+        if f is None:
+            return self._freq
+        self._freq = f
+
+    def duty_u16(self, d=None):
+        if d is None:
+            return self._duty
+        self._duty = d
+
+
+class I2C:
+    """Memory-backed I2C bus: registers are 16-bit words stored per (address, register)"""
+
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+        self.registers = {}
+
+    def writeto_mem(self, addr, reg, buf):
+        self.registers[(addr, reg)] = (buf[0] << 8) | buf[1]
+
+    def readfrom_mem_into(self, addr, reg, buf):
+        value = self.registers.get((addr, reg), 0)
+        buf[0] = (value >> 8) & 0xFF
+        buf[1] = value & 0xFF
+
+
+class UART:
+    """Loopback-free UART: written bytes are kept in tx, bytes to be read are queued in rx"""
+
+    def __init__(self, id, baudrate=115200, tx=None, rx=None, txbuf=256):
+        self.id = id
+        self.baudrate = baudrate
+        self.tx = bytearray()
+        self.rx = bytearray()
+
+    def init(self, baudrate=115200, **kwargs):
+        self.baudrate = baudrate
+
+    def any(self):
+        return len(self.rx)
+
+    def txdone(self):
+        return True
+
+    def read(self, n=-1):
+        if not self.rx:
+            return None
+        if n < 0:
+            n = len(self.rx)
+        data = bytes(self.rx[:n])
+        self.rx = self.rx[n:]
+        return data
+
+    def readinto(self, buf, n=-1):
+        if not self.rx:
+            return None
+        if n < 0 or n > len(buf):
+            n = len(buf)
+        n = min(n, len(self.rx))
+        buf[:n] = self.rx[:n]
+        self.rx = self.rx[n:]
+        return n
+
+    def write(self, data):
+        self.tx.extend(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class Timer:
+    """Timer that never fires, the loop timing is checked on the simulator (see check_timer.py)"""
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        self.callback = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None, hard=False):
+        self.mode = mode
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
@@ -0,0 +1,13 @@
+"""
+Closed-loop simulation of the board and its DUTs, for tuning the firmware offline
+The unmodified firmware runs on CPython against models of the PWM output stages, the shunts of the ranges,
+the INA3221 conversions and the DUTs, on a virtual clock faster than real time.
+The step responses of setpoint sweeps give settling times, overshoot, steady state error and noise
+
+From Pico2Tools:
+    python -m sim --dut a=resistor:100 --mode v --sweep 0.5:5:0.5
+    python -m sim --dut a=diode --mode i --sweep 1:20:1 --set PID_KP=1e-2 --set MAX_PWM_INCREMENT=2000
+"""
+from .simulator import Simulator
+from .dut import DUT, Resistor, Diode, Capacitor
+from . import metrics
@@ -0,0 +1,92 @@
+"""
+Command line of the simulator, see __init__.py
+Prints the metrics of each setpoint step of the sweep and their summary
+"""
+import sys
+import time
+import argparse
+from . import dut, metrics
+from .simulator import Simulator
+from .board import SUPPLY_V
+
+
+def parse_sweep(text: str) -> list:
+    """start:stop:step, stop included, or a comma-separated list of setpoints"""
+    if ':' not in text:
+        return [float(v) for v in text.split(',')]
+    start, stop, step = (float(v) for v in text.split(':'))
+    count = int(round((stop - start) / step)) + 1
+    return [round(start + n * step, 9) for n in range(count)]
+
+
+def parse_value(text: str):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return {'True': True, 'False': False}.get(text, text)
+
+
+def format_value(value, unit: str = '') -> str:
+    if value is None:
+        return '-'
+    return f"{value:.4g}{unit}"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m sim', description="Closed-loop simulation of the board and its DUTs")
+    parser.add_argument('--dut', action='append', default=[], metavar='CH=MODEL',
+                        help="DUT of a channel, as in a=resistor:100, a=diode or a=capacitor:10e-6 (default a=resistor:100)")
+    parser.add_argument('--channel', default='a', help="Channel to sweep")
+    parser.add_argument('--mode', choices=('v', 'i'), default='v', help="Voltage or current regulation")
+    parser.add_argument('--sweep', default='1:5:1', help="Setpoints, start:stop:step or a list, in V or mA")
+    parser.add_argument('--dwell', type=float, default=300, help="Time on each setpoint in ms")
+    parser.add_argument('--range', type=int, default=1, help="Position of the range selector")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="Replace a value of config.py, as in PID_KP=1e-2")
+    parser.add_argument('--ina-averaging', type=int, help="INA3221 averaging count")
+    parser.add_argument('--ina-conversion', type=int, help="INA3221 conversion time in us")
+    parser.add_argument('--no-noise', action='store_true', help="Noiseless INA3221 conversions")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--supply', type=float, default=SUPPLY_V, help="Push-pull output at 0%% duty cycle in V")
+    args = parser.parse_args(argv)
+
+    duts = {}
+    for spec in args.dut or ['a=resistor:100']:
+        name, _, model = spec.partition('=')
+        duts[name] = dut.parse(model)
+    overrides = {}
+    for item in args.set:
+        name, _, value = item.partition('=')
+        overrides[name] = parse_value(value)
+
+    wall = time.perf_counter()
+    sim = Simulator(duts, args.range, overrides, args.ina_averaging, args.ina_conversion, not args.no_noise, args.seed,
+                    args.supply)
+    steps = sim.sweep(args.channel, args.mode, parse_sweep(args.sweep), args.dwell)
+    wall = time.perf_counter() - wall
+
+    unit = 'V' if args.mode == 'v' else 'mA'
+    print(f"Channel {args.channel}: {duts.get(args.channel, 'open')}, range {args.range}, {args.mode} regulation"
+          + (f", {overrides}" if overrides else ''))
+    print(f"{'setpoint':>10} {'settling':>10} {'firmware':>10} {'rise':>8} {'overshoot':>10} {'error':>10} {'noise':>10}")
+    for s in steps:
+        print(f"{format_value(s['setpoint'], unit):>10} {format_value(s['settling_ms'], ' ms'):>10} "
+              f"{format_value(s['firmware_settling_ms'], ' ms'):>10} {format_value(s['rise_ms'], ' ms'):>8} "
+              f"{s['overshoot_pct']:>9.1f}% {format_value(s['error'], unit):>10} {format_value(s['noise'], unit):>10}")
+    total = metrics.summary(steps)
+    print(f"Settling: mean {format_value(total['mean_settling_ms'], ' ms')}, max {format_value(total['max_settling_ms'], ' ms')}, "
+          f"{total['not_settled']} of {total['steps']} not settled")
+    print(f"Worst overshoot {total['max_overshoot_pct']:.1f}%, worst error {format_value(total['max_error'], unit)}, "
+          f"mean noise {format_value(total['mean_noise'], unit)}")
+    print(f"{sim.now_ms/1000:.2f} s simulated in {wall:.2f} s ({sim.now_ms/1000/wall:.1f}x real time), "
+          f"{sim.overruns} control periods missed")
+    alerts = [line for _, line in sim.events if line.startswith('ALERT')]
+    for line in alerts:
+        print(f"⚠ {line}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+Analog model of the board
+Each channel: the PWM output drives an inverting push-pull stage followed by a first-order filter,
+with the output resistance of the stage in series with the shunt of the selected range and the DUT.
+The high-current INA3221 measures the SHUNTS[0] shunt and is read on range 0,
+the low-current one the shunts of the other ranges. Both read the DUT voltage on their bus input.
+The front panel inputs (range selector, push-pull switches) are driven from the board settings
+"""
+import math
+import random
+from . import machine
+from .sensor import Ina3221Model
+
+SUPPLY_V = 10.0  # Default output of the push-pull stage at 0% duty cycle, after the inverter
+OUTPUT_TAU_US = 1000.0  # Time constant of the output filter
+OUTPUT_R = 1.0  # Output resistance of the push-pull stage and the filter, in ohms
+INA_ADDRESS = 0x40
+
+
+class OutputChannel:
+    """Analog state of one channel"""
+
+    def __init__(self, number: int, dut):
+        self.number = number  # INA3221 channel, 1 to 3
+        self.dut = dut  # None when nothing is connected: the push-pull switch is open
+        self.vf = 0.0  # Filtered output of the push-pull stage
+        self.v = 0.0  # DUT voltage
+        self.i = 0.0  # DUT current in amps
+
+
+class Board:
+    """
+    The board and its DUTs, attached to the simulation clock
+    Created before the firmware is imported so that its INA3221 drivers find their devices on the I2C buses
+    """
+
+    def __init__(self, clock, duts: dict, config, range_: int = 1, noise: bool = True, seed: int = 1,
+                 supply: float = SUPPLY_V):
+        """
+        Arguments:
+            - clock of the simulation
+            - DUT per channel name ('a', 'b', 'c'), None or missing for a disconnected channel
+            - the firmware config module, for the pins, shunts and PWM resolution
+            - position of the range selector
+            - add the INA3221 conversion noise
+            - seed of the noise
+            - output of the push-pull stage at 0% duty cycle, the gain of the regulation loop is proportional to it
+        """
+        self.config = config
+        self.range = range_
+        self.supply = supply
+        names = ('a', 'b', 'c')
+        self.channels = [OutputChannel(n + 1, duts.get(name)) for n, name in enumerate(names)]
+        self.pwm_pins = (config.PWM_PIN_CHA, config.PWM_PIN_CHB, config.PWM_PIN_CHC)
+        self.relay_pins = (config.SR_PIN_CHA, config.SR_PIN_CHB, config.SR_PIN_CHC)
+        self.switch_pins = (config.PP_SWITCH_CHA, config.PP_SWITCH_CHB, config.PP_SWITCH_CHC)
+        rng = random.Random(seed) if noise else None
+        self.ina_high = Ina3221Model(lambda ch: self.inputs(ch, True), rng)
+        self.ina_low = Ina3221Model(lambda ch: self.inputs(ch, False), rng)
+        machine.buses[config.I2CA_ID] = {INA_ADDRESS: self.ina_high}
+        machine.buses[config.I2CB_ID] = {INA_ADDRESS: self.ina_low}
+        clock.listeners += [self, self.ina_high, self.ina_low]
+
+    def inputs(self, number: int, high: bool) -> tuple:
+        """Shunt and bus voltages seen by an INA3221 channel"""
+        ch = self.channels[number - 1]
+        if high != (self.range == 0):
+            return 0.0, ch.v
+        return ch.i * self.config.SHUNTS[self.range], ch.v
+
+    def connect_panel(self) -> None:
+        """Drive the panel inputs, once the firmware has created its pins"""
+        for n, pin in enumerate(self.config.RANGE_SELECTOR_PINS):
+            machine.pins[pin].drive(0 if n == self.range else 1)
+        for ch, pin in zip(self.channels, self.switch_pins):
+            machine.pins[pin].drive(ch.dut is not None)
+
+    def step(self, t_us: float, dt: float) -> None:
+        rshunt = self.config.SHUNTS[self.range]
+        decay = math.exp(-dt / OUTPUT_TAU_US)
+        for ch, pwm_pin, relay_pin in zip(self.channels, self.pwm_pins, self.relay_pins):
+            pwm = machine.pwms.get(pwm_pin)
+            duty = pwm.duty_u16() if pwm is not None else self.config.PWM_RESOLUTION
+            target = self.supply * (1 - duty / self.config.PWM_RESOLUTION)
+            ch.vf = target + (ch.vf - target) * decay
+            relay = machine.pins.get(relay_pin)  # Not created yet while the firmware is imported
+            if ch.dut is None:
+                ch.v, ch.i = 0.0, 0.0
+            elif relay is None or relay.value():
+                ch.v, ch.i = ch.dut.release(dt * 1e-6)
+            else:
+                ch.v, ch.i = ch.dut.solve(ch.vf, OUTPUT_R + rshunt, dt * 1e-6)
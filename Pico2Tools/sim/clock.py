@@ -0,0 +1,57 @@
+"""
+Virtual clock of the simulation
+The firmware reads it through time.ticks_ms() and time.ticks_us(). It only moves forward when the simulator
+waits for the next control period, when a peripheral transfer takes time, or a little on every ticks_us() read
+so that the busy-wait loops of the firmware end. Each move steps the physics of the board
+"""
+
+TICKS_PERIOD = 1 << 30  # ticks_ms and ticks_us wrap like on the rp2 port
+TICKS_HALF = TICKS_PERIOD // 2
+STEP_US = 100  # Longest physics step
+TICK_READ_US = 1  # CPU time of a ticks_us() call in a busy-wait loop
+
+
+class Clock:
+    """Simulated time in microseconds, listeners are stepped as it advances"""
+
+    def __init__(self):
+        self.now_us = 0
+        self.listeners = []  # Objects with a step(t_us, dt_us) method, called in order
+
+    def advance(self, us: float) -> None:
+        """Move the time forward by us microseconds, in physics steps of at most STEP_US"""
+        end = self.now_us + us
+        while self.now_us < end:
+            dt = min(STEP_US, end - self.now_us)
+            self.now_us += dt
+            for listener in self.listeners:
+                listener.step(self.now_us, dt)
+
+    def advance_to(self, t_us: float) -> None:
+        if t_us > self.now_us:
+            self.advance(t_us - self.now_us)
+
+    # The time module functions of MicroPython, installed by shims.modules()
+    def ticks_us(self) -> int:
+        self.advance(TICK_READ_US)
+        return int(self.now_us) % TICKS_PERIOD
+
+    def ticks_ms(self) -> int:
+        return int(self.now_us // 1000) % TICKS_PERIOD
+
+    def ticks_cpu(self) -> int:
+        return self.ticks_us()
+
+    @staticmethod
+    def ticks_add(ticks: int, delta: int) -> int:
+        return (ticks + delta) % TICKS_PERIOD
+
+    @staticmethod
+    def ticks_diff(a: int, b: int) -> int:
+        return (a - b + TICKS_HALF) % TICKS_PERIOD - TICKS_HALF
+
+    def sleep_ms(self, ms: int) -> None:
+        self.advance(ms * 1000)
+
+    def sleep_us(self, us: int) -> None:
+        self.advance(us)
@@ -0,0 +1,112 @@
+"""
+Devices under test
+A DUT is connected between the shunt output of a channel and the ground. solve() gives its voltage and current
+when it is driven by the source voltage vs through the series resistance rs (output stage and shunt),
+release() when the safety relay or the push-pull switch disconnects it.
+New models derive from DUT and are registered in MODELS to be named on the command line
+"""
+import math
+
+THERMAL_VOLTAGE = 0.02585  # kT/q at 300 K
+
+
+class DUT:
+    """Open circuit"""
+    name = 'open'
+
+    def solve(self, vs: float, rs: float, dt: float) -> tuple:
+        """Voltage (V) and current (A) of the DUT at the end of a dt seconds step"""
+        return 0.0, 0.0
+
+    def release(self, dt: float) -> tuple:
+        """Voltage and current of the disconnected DUT"""
+        return 0.0, 0.0
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class Resistor(DUT):
+    name = 'resistor'
+
+    def __init__(self, ohms: float = 100.0):
+        self.ohms = ohms
+
+    def solve(self, vs: float, rs: float, dt: float) -> tuple:
+        i = vs / (rs + self.ohms)
+        return i * self.ohms, i
+
+    def __str__(self) -> str:
+        return f"resistor {self.ohms:g} ohm"
+
+
+class Diode(DUT):
+    """Shockley diode with a series resistance, the defaults are those of a small red LED"""
+    name = 'diode'
+
+    def __init__(self, saturation: float = 1e-18, ideality: float = 2.0, series: float = 10.0):
+        self.saturation = saturation
+        self.ideality = ideality
+        self.series = series
+        self.v = 0.0
+
+    def current(self, vj: float) -> float:
+        # The exponent is bounded, the bisection never goes that far into conduction
+        return self.saturation * (math.exp(min(vj / (self.ideality * THERMAL_VOLTAGE), 200)) - 1)
+
+    def solve(self, vs: float, rs: float, dt: float) -> tuple:
+        # Junction voltage vj such that vs = vj + (rs + series)*i(vj), by bisection: the function is monotonic
+        r = rs + self.series
+        lo, hi = min(0.0, vs), max(0.0, vs)
+        for _ in range(40):
+            vj = (lo + hi) / 2
+            if vj + r * self.current(vj) > vs:
+                hi = vj
+            else:
+                lo = vj
+        i = self.current(lo)
+        self.v = lo + self.series * i
+        return self.v, i
+
+    def __str__(self) -> str:
+        return f"diode Is={self.saturation:g} A n={self.ideality:g} Rs={self.series:g} ohm"
+
+
+class Capacitor(DUT):
+    """Capacitor with its series resistance and a parallel leakage resistance"""
+    name = 'capacitor'
+
+    def __init__(self, farads: float = 10e-6, esr: float = 0.1, leakage: float = 1e7):
+        self.farads = farads
+        self.esr = esr
+        self.leakage = leakage
+        self.vc = 0.0
+
+    def solve(self, vs: float, rs: float, dt: float) -> tuple:
+        # Exact RC step towards the source, then the leakage
+        r = rs + self.esr
+        self.vc = vs + (self.vc - vs) * math.exp(-dt / (r * self.farads))
+        self.vc *= math.exp(-dt / (self.leakage * self.farads))
+        i = (vs - self.vc) / r
+        return self.vc + self.esr * i, i
+
+    def release(self, dt: float) -> tuple:
+        self.vc *= math.exp(-dt / (self.leakage * self.farads))
+        return self.vc, 0.0
+
+    def __str__(self) -> str:
+        return f"capacitor {self.farads:g} F ESR={self.esr:g} ohm"
+
+
+MODELS = {model.name: model for model in (DUT, Resistor, Diode, Capacitor)}
+
+
+def parse(spec: str) -> DUT:
+    """
+    DUT from its command line description: the model name and its parameters separated by colons,
+    as in resistor:100, diode, diode:1e-14:1.9:5 or capacitor:100e-6:0.05
+    """
+    name, *values = spec.split(':')
+    if name not in MODELS:
+        raise ValueError(f"Unknown DUT model {name}, available: {', '.join(MODELS)}")
+    return MODELS[name](*[float(v) for v in values])
@@ -0,0 +1,93 @@
+"""
+Cooperative scheduler on the virtual clock, standing for the asyncio loop of the communication core
+The firmware tasks are plain coroutines: the asyncio shims make them yield a Sleep or a Park object,
+the scheduler resumes them when their time comes or their flag is set
+"""
+
+
+class Sleep:
+    """Awaitable of asyncio.sleep_ms()"""
+
+    def __init__(self, ms: float):
+        self.ms = ms
+
+    def __await__(self):
+        yield self
+
+
+class Park:
+    """Awaitable of ThreadSafeFlag.wait(): the task waits without polling until the flag is set"""
+
+    def __init__(self, flag):
+        self.flag = flag
+
+    def __await__(self):
+        yield self
+
+
+class Task:
+    def __init__(self, coro, wake: float):
+        self.coro = coro
+        self.wake = wake  # Time in microseconds to resume the task, None while parked on a flag
+        self.done = False
+
+    def cancel(self) -> None:
+        self.done = True
+        self.coro.close()
+
+
+class Loop:
+    def __init__(self, clock):
+        self.clock = clock
+        self.tasks = []
+
+    def create_task(self, coro) -> Task:
+        task = Task(coro, self.clock.now_us)
+        self.tasks.append(task)
+        return task
+
+    def next_wake(self) -> float:
+        """Time of the next task to resume, None if all of them wait for a flag"""
+        wakes = [t.wake for t in self.tasks if t.wake is not None]
+        return min(wakes) if wakes else None
+
+    def run_due(self) -> None:
+        """Resume the tasks due by now, in their creation order like the round-robin of asyncio"""
+        now = self.clock.now_us
+        for task in list(self.tasks):
+            if task.done or task.wake is None or task.wake > now:
+                continue
+            try:
+                awaited = task.coro.send(None)
+            except StopIteration:
+                task.done = True
+                continue
+            if isinstance(awaited, Park):
+                task.wake = None
+                awaited.flag.waiters.append(task)
+            else:
+                task.wake = self.clock.now_us + awaited.ms * 1000
+        self.tasks = [t for t in self.tasks if not t.done]
+
+
+class ThreadSafeFlag:
+    def __init__(self):
+        self.state = False
+        self.waiters = []
+
+    def set(self) -> None:
+        self.state = True
+        for task in self.waiters:
+            task.wake = clock.now_us
+        self.waiters = []
+
+    def clear(self) -> None:
+        self.state = False
+
+    async def wait(self) -> None:
+        while not self.state:
+            await Park(self)
+        self.state = False
+
+
+clock = None  # Clock of the simulation, set by shims.modules()
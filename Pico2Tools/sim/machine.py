@@ -0,0 +1,201 @@
+"""
+machine module of the simulation, installed in place of the MicroPython one by shims.modules()
+Pins and PWM outputs are registered by pin number for the board model to read or drive them,
+the I2C buses forward the register transfers to the INA3221 models and take the time of the transfer
+"""
+
+clock = None  # Clock of the simulation, set by shims.modules()
+pins = {}  # Pin number -> Pin
+pwms = {}  # Pin number -> PWM
+buses = {}  # I2C bus id -> {address: device model}
+timers = []
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.handler = None
+        # Inputs with pull-up resistors read high until something drives them
+        self._value = 1 if pull == Pin.PULL_UP else 0
+        if value is not None:
+            self._value = value
+        pins[id] = self
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self.handler = handler
+
+    def drive(self, v) -> None:
+        """Change the level of an input from the outside, its interrupt handler runs on a change"""
+        v = 1 if v else 0
+        if v == self._value:
+            return
+        self._value = v
+        if self.handler is not None:
+            self.handler(self)
+
+
+class PWM:
+    def __init__(self, pin, freq=1000, duty_u16=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty_u16
+        pwms[pin.id] = self
+
+    def freq(self, f=None):
+        if f is None:
+            return self._freq
+        self._freq = f
+
+    def duty_u16(self, d=None):
+        if d is None:
+            return self._duty
+        self._duty = d
+
+    def deinit(self):
+        pass
+
+
+class I2C:
+    """I2C bus forwarding the 16-bit register transfers to the device models attached by the board"""
+
+    def __init__(self, id, scl=None, sda=None, freq=400000):
+        self.id = id
+        self.freq = freq
+        self.devices = buses.setdefault(id, {})
+
+    def _transfer(self, nbytes: int) -> None:
+        # Start, address and register bytes, a repeated start for reads, then the data bytes, 9 clocks each
+        clock.advance((nbytes + 2) * 9 * 1e6 / self.freq)
+
+    def writeto_mem(self, addr, reg, buf):
+        device = self.devices.get(addr)
+        self._transfer(len(buf))
+        if device is None:
+            raise OSError(5)  # EIO, like a missing device
+        device.write_register(reg, (buf[0] << 8) | buf[1])
+
+    def readfrom_mem_into(self, addr, reg, buf):
+        device = self.devices.get(addr)
+        self._transfer(len(buf) + 1)
+        if device is None:
+            raise OSError(5)
+        value = device.read_register(reg)
+        buf[0] = (value >> 8) & 0xFF
+        buf[1] = value & 0xFF
+
+
+class UART:
+    """Host link: written bytes are kept in tx, bytes to be read are queued in rx"""
+
+    def __init__(self, id, baudrate=115200, tx=None, rx=None, txbuf=256):
+        self.id = id
+        self.baudrate = baudrate
+        self.tx = bytearray()
+        self.rx = bytearray()
+
+    def init(self, baudrate=115200, **kwargs):
+        self.baudrate = baudrate
+
+    def any(self):
+        return len(self.rx)
+
+    def txdone(self):
+        return True
+
+    def read(self, n=-1):
+        if not self.rx:
+            return None
+        if n < 0:
+            n = len(self.rx)
+        data = bytes(self.rx[:n])
+        self.rx = self.rx[n:]
+        return data
+
+    def readinto(self, buf, n=-1):
+        if not self.rx:
+            return None
+        if n < 0 or n > len(buf):
+            n = len(buf)
+        n = min(n, len(self.rx))
+        buf[:n] = self.rx[:n]
+        self.rx = self.rx[n:]
+        return n
+
+    def write(self, data):
+        self.tx.extend(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class Timer:
+    """
+    Periodic or one-shot timer fired by the simulator at the times given by the simulation clock
+    A period elapsed while the callback was still running is missed, like a tick still pending on the pico
+    """
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, **kwargs):
+        self.id = id
+        self.callback = None
+        self.period_us = 0
+        self.next_us = 0
+        timers.append(self)
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=-1, period=-1, callback=None, hard=False):
+        self.mode = mode
+        self.period_us = 1e6 / freq if freq > 0 else period * 1000
+        self.callback = callback
+        self.next_us = clock.now_us + self.period_us
+
+    def deinit(self):
+        self.callback = None
+
+    def fire(self) -> int:
+        """
+        Run the callback and schedule the next period, returns the number of periods missed meanwhile
+        The timer keeps its schedule when the callback raises, like the hardware one
+        """
+        callback = self.callback
+        due = self.next_us
+        try:
+            callback(self)
+        finally:
+            restarted = self.next_us != due
+            if not restarted:
+                if self.mode == Timer.ONE_SHOT:
+                    self.callback = None
+                else:
+                    self.next_us += self.period_us
+        if restarted or self.mode == Timer.ONE_SHOT:
+            return 0
+        missed = 0
+        while self.next_us <= clock.now_us:
+            self.next_us += self.period_us
+            missed += 1
+        return missed
+
+
+def reset():
+    raise SystemExit('machine.reset() called by the firmware')
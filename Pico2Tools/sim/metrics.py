@@ -0,0 +1,69 @@
+"""
+Step response metrics of a regulated channel
+Computed from the measurements of each control period after a setpoint change
+"""
+import math
+
+STEADY_FRACTION = 0.25  # Last part of a step used for the steady state error and the noise
+
+
+def step_metrics(times: list, values: list, start: float, target: float, tolerance: float) -> dict:
+    """
+    Metrics of one setpoint step
+
+    Arguments:
+        - times of the measurements in ms from the setpoint change
+        - measurements (V or mA), None when the sensors could not be read
+        - value before the change
+        - new setpoint
+        - half width of the band the output must stay in to be settled
+    Returns:
+        - dictionnary with
+          settling_ms: time after which the output stays within the band, None if it does not settle
+          rise_ms: time to go from 10% to 90% of the step, None if it does not
+          overshoot_pct: largest excursion beyond the setpoint, in % of the step
+          error: mean steady state error, noise: its standard deviation, over the last STEADY_FRACTION
+    """
+    points = [(t, v) for t, v in zip(times, values) if v is not None]
+    result = {'settling_ms': None, 'rise_ms': None, 'overshoot_pct': 0.0, 'error': None, 'noise': None}
+    if not points:
+        return result
+
+    # Settled after the last point out of the band
+    settling = 0.0
+    for n, (t, v) in enumerate(points):
+        if abs(v - target) > tolerance:
+            settling = points[n + 1][0] if n + 1 < len(points) else None
+    result['settling_ms'] = settling
+
+    step = target - start
+    if abs(step) > tolerance:
+        sign = 1 if step > 0 else -1
+        t10 = next((t for t, v in points if sign * (v - start) >= 0.1 * abs(step)), None)
+        t90 = next((t for t, v in points if sign * (v - start) >= 0.9 * abs(step)), None)
+        if t10 is not None and t90 is not None:
+            result['rise_ms'] = t90 - t10
+        excess = max(sign * (v - target) for _, v in points)
+        result['overshoot_pct'] = max(0.0, 100 * excess / abs(step))
+
+    steady = [v for t, v in points if t >= points[-1][0] * (1 - STEADY_FRACTION)]
+    mean = sum(steady) / len(steady)
+    result['error'] = mean - target
+    result['noise'] = math.sqrt(sum((v - mean) ** 2 for v in steady) / len(steady))
+    return result
+
+
+def summary(steps: list) -> dict:
+    """Worst and mean figures over the steps of a sweep"""
+    settled = [s['settling_ms'] for s in steps if s['settling_ms'] is not None]
+    errors = [abs(s['error']) for s in steps if s['error'] is not None]
+    noises = [s['noise'] for s in steps if s['noise'] is not None]
+    return {
+        'steps': len(steps),
+        'not_settled': len(steps) - len(settled),
+        'mean_settling_ms': sum(settled) / len(settled) if settled else None,
+        'max_settling_ms': max(settled) if settled else None,
+        'max_overshoot_pct': max((s['overshoot_pct'] for s in steps), default=0.0),
+        'max_error': max(errors) if errors else None,
+        'mean_noise': sum(noises) / len(noises) if noises else None
+    }
@@ -0,0 +1,134 @@
+"""
+INA3221 model
+The registers behave like the real device's for what the firmware uses: configuration, shunt and bus voltages
+of the three channels and the conversion ready flag. Conversions run in sequence over the enabled channels,
+shunt then bus, each one averaging its input over the conversion time (and the averaging count),
+with gaussian noise, then quantized to the register LSB and saturated like the ADC
+"""
+import math
+
+REG_CONFIG = 0x00
+REG_MASK_ENABLE = 0x0F
+REG_MANUFACTURER_ID = 0xFE
+REG_DIE_ID = 0xFF
+SHUNT_REGISTERS = {0x01: 1, 0x03: 2, 0x05: 3}
+BUS_REGISTERS = {0x02: 1, 0x04: 2, 0x06: 3}
+
+CONFIG_DEFAULT = 0x7127
+CONFIG_RESET = 0x8000
+ENABLE_BITS = {1: 0x4000, 2: 0x2000, 3: 0x1000}
+AVERAGES = (1, 4, 16, 64, 128, 256, 512, 1024)
+CONVERSION_US = (140, 204, 332, 588, 1100, 2116, 4156, 8244)
+CONV_READY = 0x0001
+
+SHUNT_LSB_V = 40e-6
+BUS_LSB_V = 8e-3
+ADC_MAX = 4095  # 12-bit magnitude, the registers hold it left-aligned on 3 bits
+
+# Input-referred noise of a single conversion at the 1.1 ms conversion time, it goes down with longer ones
+SHUNT_NOISE_V = 10e-6
+BUS_NOISE_V = 3e-3
+
+
+class Ina3221Model:
+    """
+    One INA3221 on an I2C bus
+    inputs(channel) gives the (shunt, bus) voltages of a channel at the current time, in volts
+    """
+
+    def __init__(self, inputs, rng=None):
+        self.inputs = inputs
+        self.rng = rng  # random.Random for the noise, None for noiseless conversions
+        self.registers = {}
+        self.config = CONFIG_DEFAULT
+        self.flags = 0
+        self.sequence = []  # Conversions of a cycle: (channel, is_shunt)
+        self.position = 0
+        self.elapsed = 0.0  # Time spent on the current conversion
+        self.integral = 0.0
+        self.single_shot = False
+        self.idle = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.registers = {reg: 0 for reg in list(SHUNT_REGISTERS) + list(BUS_REGISTERS)}
+        self.configure(CONFIG_DEFAULT)
+
+    def configure(self, config: int) -> None:
+        """New configuration register, a new conversion cycle starts"""
+        self.config = config
+        self.flags &= ~CONV_READY
+        mode = config & 0x7
+        shunt = bool(mode & 0x1)
+        bus = bool(mode & 0x2)
+        self.single_shot = not mode & 0x4
+        self.sequence = []
+        for ch in (1, 2, 3):
+            if config & ENABLE_BITS[ch]:
+                if shunt:
+                    self.sequence.append((ch, True))
+                if bus:
+                    self.sequence.append((ch, False))
+        self.idle = not self.sequence
+        self.position = 0
+        self.elapsed = 0.0
+        self.integral = 0.0
+
+    def averages(self) -> int:
+        return AVERAGES[(self.config >> 9) & 0x7]
+
+    def conversion_us(self, is_shunt: bool) -> int:
+        return CONVERSION_US[(self.config >> (3 if is_shunt else 6)) & 0x7]
+
+    def write_register(self, reg: int, value: int) -> None:
+        if reg == REG_CONFIG:
+            self.configure(CONFIG_DEFAULT if value & CONFIG_RESET else value)
+        elif reg == REG_MASK_ENABLE:
+            self.flags = (self.flags & 0x03FF) | (value & 0xFC00)
+        else:
+            self.registers[reg] = value
+
+    def read_register(self, reg: int) -> int:
+        if reg == REG_CONFIG:
+            return self.config
+        if reg == REG_MASK_ENABLE:
+            value = self.flags
+            self.flags &= ~CONV_READY  # The flag is cleared by reading the register
+            return value
+        if reg == REG_MANUFACTURER_ID:
+            return 0x5449
+        if reg == REG_DIE_ID:
+            return 0x3220
+        return self.registers.get(reg, 0)
+
+    def step(self, t_us: float, dt: float) -> None:
+        """Integrate the input of the running conversion over dt microseconds"""
+        while dt > 0 and not self.idle:
+            ch, is_shunt = self.sequence[self.position]
+            window = self.conversion_us(is_shunt) * self.averages()
+            take = min(dt, window - self.elapsed)
+            self.integral += self.inputs(ch)[0 if is_shunt else 1] * take
+            self.elapsed += take
+            dt -= take
+            if self.elapsed >= window:
+                self.complete(ch, is_shunt, self.integral / window)
+                self.elapsed = 0.0
+                self.integral = 0.0
+                self.position += 1
+                if self.position == len(self.sequence):
+                    self.position = 0
+                    self.flags |= CONV_READY
+                    if self.single_shot:
+                        self.idle = True
+
+    def complete(self, ch: int, is_shunt: bool, value: float) -> None:
+        """Store a conversion result: noise, quantization and saturation"""
+        lsb = SHUNT_LSB_V if is_shunt else BUS_LSB_V
+        if self.rng is not None:
+            noise = SHUNT_NOISE_V if is_shunt else BUS_NOISE_V
+            value += self.rng.gauss(0, noise * math.sqrt(1100 / self.conversion_us(is_shunt) / self.averages()))
+        counts = int(round(value / lsb))
+        # The bus input cannot measure below ground
+        counts = max(-ADC_MAX - 1 if is_shunt else 0, min(ADC_MAX, counts))
+        reg = (1 if is_shunt else 2) + 2 * (ch - 1)
+        self.registers[reg] = (counts << 3) & 0xFFFF
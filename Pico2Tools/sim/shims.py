@@ -0,0 +1,114 @@
+"""
+MicroPython modules for the firmware running on CPython
+The firmware gets its own micropython, machine, time, asyncio, gc and _thread modules, bound to the simulation
+clock and scheduler: they are only in sys.modules while the firmware is imported, so the modules
+of the simulator itself and of the rest of the process are left alone
+"""
+import os
+import sys
+import types
+import builtins
+import gc as cpython_gc
+import time as cpython_time
+import _thread as cpython_thread
+# The standard modules of the firmware, imported before the shims are installed
+import array, json, random, select
+from . import machine, loop
+
+# The firmware folder, next to the host tools
+FIRMWARE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'Pico2Internal')
+SHIMMED = ('micropython', 'machine', 'time', 'asyncio', 'gc', '_thread')
+
+# Emitters of the viper code generator: annotations only on CPython
+for _name in ('ptr8', 'ptr16', 'ptr32', 'uint'):
+    setattr(builtins, _name, int)
+
+
+def _module(name: str, base=None, **attributes) -> types.ModuleType:
+    """New module with the attributes of base, replaced or completed by attributes"""
+    module = types.ModuleType(name)
+    if base is not None:
+        module.__dict__.update({k: v for k, v in vars(base).items() if not k.startswith('__')})
+    module.__dict__.update(attributes)
+    return module
+
+
+def modules(clock, scheduler) -> dict:
+    """The shim modules for a simulation"""
+    machine.clock = clock
+    loop.clock = clock
+
+    def schedule(function, argument):
+        # Soft interrupts run right away: the simulator fires the timers between two firmware steps
+        function(argument)
+        return True
+
+    micropython = _module('micropython',
+                          const=lambda x: x,
+                          native=lambda f: f,
+                          viper=lambda f: f,
+                          schedule=schedule,
+                          alloc_emergency_exception_buf=lambda n: None,
+                          mem_info=lambda *args: None)
+    time = _module('time', cpython_time,
+                   ticks_ms=clock.ticks_ms,
+                   ticks_us=clock.ticks_us,
+                   ticks_cpu=clock.ticks_cpu,
+                   ticks_add=clock.ticks_add,
+                   ticks_diff=clock.ticks_diff,
+                   sleep_ms=clock.sleep_ms,
+                   sleep_us=clock.sleep_us,
+                   sleep=lambda s: clock.sleep_us(s * 1e6),
+                   time=lambda: clock.now_us / 1e6)
+    asyncio = _module('asyncio',
+                      sleep_ms=loop.Sleep,
+                      sleep=lambda s: loop.Sleep(s * 1000),
+                      create_task=scheduler.create_task,
+                      ThreadSafeFlag=loop.ThreadSafeFlag,
+                      CancelledError=Exception)
+    gc = _module('gc', cpython_gc,
+                 collect=lambda: None,
+                 enable=lambda: None,
+                 disable=lambda: None,
+                 mem_free=lambda: 128 * 1024,
+                 mem_alloc=lambda: 64 * 1024)
+
+    def start_new_thread(function, args):
+        raise RuntimeError("The second core is not simulated, the control loop must be timer driven")
+
+    thread = _module('_thread', cpython_thread,
+                     allocate_lock=cpython_thread.allocate_lock,
+                     start_new_thread=start_new_thread)
+    return {'micropython': micropython, 'machine': machine, 'time': time, 'asyncio': asyncio,
+            'gc': gc, '_thread': thread}
+
+
+class Firmware:
+    """
+    Import context of the firmware modules with the shims installed
+    The firmware modules imported by a previous simulation are dropped first,
+    so each simulation starts from a fresh firmware state and its own config values
+    """
+
+    def __init__(self, shims: dict):
+        self.shims = shims
+        self.saved = {}
+
+    def __enter__(self):
+        for name in [n for n, m in sys.modules.items()
+                     if os.path.dirname(os.path.abspath(getattr(m, '__file__', None) or '/')) == FIRMWARE_DIR]:
+            del sys.modules[name]
+        for name in SHIMMED:
+            self.saved[name] = sys.modules.get(name)
+            sys.modules[name] = self.shims[name]
+        if FIRMWARE_DIR not in sys.path:
+            sys.path.insert(0, FIRMWARE_DIR)
+        return self
+
+    def __exit__(self, *args):
+        for name, module in self.saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        return False
@@ -0,0 +1,182 @@
+"""
+The firmware running on the simulated board
+main.main() starts as on the pico, its tasks run on the scheduler of the virtual clock,
+and the control loop is driven by the timer, so that the control periods run the unmodified control_step().
+The host talks to it through the uart like the UserControl scripts
+"""
+from . import machine, shims, metrics
+from .clock import Clock
+from .loop import Loop
+from .board import Board, SUPPLY_V
+from .sensor import AVERAGES, CONVERSION_US
+
+# Firmware settings the simulation needs: a single core, and no USB link reading the stdin of the process
+FIRMWARE_OVERRIDES = {'CONTROL_ON_CORE1': False, 'USB_LINK': False}
+STARTUP_MS = 200  # Time for the firmware to start and read the panel
+MODE_SETTLE_MS = 50  # Wait after a regulation mode change
+REPORT_MS = 600  # Wait for the last settling times, reported every 500 ms by send_channels_state()
+
+
+class Simulator:
+    """
+    One simulation: the board, its DUTs and a fresh import of the firmware
+    A process runs one simulation at a time, creating a new one replaces the firmware of the previous one
+    """
+
+    def __init__(self, duts: dict, range_: int = 1, overrides: dict = None,
+                 ina_averaging: int = None, ina_conversion_us: int = None, noise: bool = True, seed: int = 1,
+                 supply: float = SUPPLY_V):
+        """
+        Arguments:
+            - DUT model per channel name, the other channels are disconnected
+            - position of the range selector
+            - config.py values replaced for this simulation, like PID_KP, PID_DT or MAX_PWM_INCREMENT
+            - INA3221 averaging count and conversion time (us) replacing the ones set by the driver
+            - add the INA3221 conversion noise
+            - seed of the noise
+            - output voltage of the push-pull stages at 0% duty cycle
+        """
+        self.clock = Clock()
+        self.loop = Loop(self.clock)
+        for registry in (machine.pins, machine.pwms, machine.buses):
+            registry.clear()
+        machine.timers.clear()
+        self.events = []  # (ms, line) of the messages from the pico, telemetry frames excepted
+        self.frames = 0  # Telemetry frames received
+        self.overruns = 0  # Control periods missed because the previous one was still running
+        self.samples = {}  # Channel name -> list of (ms, setpoint, i, v, duty) after each control period
+
+        with shims.Firmware(shims.modules(self.clock, self.loop)):
+            import config
+            for name, value in {**FIRMWARE_OVERRIDES, **(overrides or {})}.items():
+                if not hasattr(config, name):
+                    raise ValueError(f"Unknown config value {name}")
+                setattr(config, name, value)
+            self.config = config
+            self.board = Board(self.clock, duts, config, range_, noise, seed, supply)
+            import main
+            import link
+        self.main = main
+        self.uart = link.uart_link.uart
+
+        if ina_averaging is not None or ina_conversion_us is not None:
+            for ina in (main.inaA, main.inaB):
+                value = ina.read(0)
+                if ina_averaging is not None:
+                    value = (value & ~0x0E00) | (AVERAGES.index(ina_averaging) << 9)
+                if ina_conversion_us is not None:
+                    code = CONVERSION_US.index(ina_conversion_us)
+                    value = (value & ~0x01F8) | (code << 6) | (code << 3)
+                ina.write(0, value)
+
+        self.board.connect_panel()
+        self.loop.create_task(main.main())
+        self.run(STARTUP_MS)
+
+    @property
+    def now_ms(self) -> float:
+        return self.clock.now_us / 1000
+
+    def command(self, line: str) -> None:
+        """Send a command line to the pico, it is executed by its serial_read task"""
+        self.uart.rx.extend((line + '\n').encode('utf-8'))
+
+    def run(self, ms: float) -> None:
+        """Run the firmware for ms milliseconds of simulated time"""
+        end = self.clock.now_us + ms * 1000
+        while self.clock.now_us < end:
+            wakes = [end] + [t.next_us for t in machine.timers if t.callback is not None]
+            task_wake = self.loop.next_wake()
+            if task_wake is not None:
+                wakes.append(task_wake)
+            self.clock.advance_to(min(wakes))
+            for timer in machine.timers:
+                if timer.callback is not None and timer.next_us <= self.clock.now_us:
+                    periodic = timer.mode == machine.Timer.PERIODIC
+                    missed = timer.fire()
+                    self.overruns += missed
+                    if periodic:  # Control period, the one-shot timer runs the pulse phases
+                        self.record()
+            self.loop.run_due()
+            self.receive()
+
+    def record(self) -> None:
+        """Keep the state of the channels after a control period"""
+        t = self.now_ms
+        for ch in self.main.control_channels or ():
+            sp = ch.V_SetPoint if ch.V_SetPoint is not None else ch.I_SetPoint
+            self.samples.setdefault(ch.Name, []).append((t, sp, ch.I_Measured, ch.V_Measured, ch.Duty))
+
+    def receive(self) -> None:
+        """Split the bytes sent by the pico into lines, events are kept"""
+        tx = self.uart.tx
+        end = tx.rfind(b'\n')
+        if end < 0:
+            return
+        for line in bytes(tx[:end]).decode('utf-8', errors='replace').split('\n'):
+            if line.startswith('D '):
+                self.frames += 1
+            elif line:
+                self.events.append((self.now_ms, line))
+        del tx[:end + 1]
+
+    def step(self, name: str, setpoint: float, dwell_ms: float) -> dict:
+        """
+        Apply a setpoint to a regulated channel and measure its response over dwell_ms
+        Returns the metrics of metrics.step_metrics() with the setpoint, the value before the change
+        and the time of the change. The settling time reported by the firmware arrives later,
+        see firmware_settling()
+        """
+        history = self.samples.get(name, [])
+        voltage = self.channel(name).V_SetPoint is not None
+        field = 3 if voltage else 2
+        start = next((s[field] for s in reversed(history) if s[field] is not None), 0.0)
+        first = len(history)
+        since = self.now_ms
+        self.command(f"{name} {setpoint}")
+        self.run(dwell_ms)
+        rows = self.samples[name][first:]
+        # The setpoint changes when serial_read executes the command
+        changed = next((r[0] for r in rows if r[1] == setpoint), rows[0][0])
+        rows = [r for r in rows if r[0] >= changed]
+        if voltage:
+            tolerance = self.config.SETTLE_TOLERANCE
+        else:
+            ch = self.channel(name)
+            lsb = self.config.SHUNT_LSB_MA / (ch.Rshunt or 1)
+            tolerance = max(self.config.SETTLE_TOLERANCE * abs(setpoint), lsb)
+        result = metrics.step_metrics([r[0] - changed for r in rows], [r[field] for r in rows], start, setpoint, tolerance)
+        result['setpoint'] = setpoint
+        result['start'] = start
+        result['since'] = since
+        result['firmware_settling_ms'] = None
+        return result
+
+    def firmware_settling(self, name: str, steps: list) -> None:
+        """
+        Fill the settling time reported by the firmware in the results of steps, None if not reported
+        The SETTLED events come with the setpoint of the change, they are matched to the steps in order
+        """
+        events = [(t, line.split(' ')) for t, line in self.events if line.startswith(f"SETTLED {name} ")]
+        for result in steps:
+            for n, (t, parts) in enumerate(events):
+                if t >= result['since'] and float(parts[4]) == result['setpoint']:
+                    result['firmware_settling_ms'] = None if parts[2] == 'timeout' else int(parts[2])
+                    events = events[n + 1:]
+                    break
+
+    def sweep(self, name: str, mode: str, setpoints: list, dwell_ms: float) -> list:
+        """Step response of each setpoint in turn, mode 'v' or 'i' for voltage or current regulation"""
+        self.command(f"{name} {mode}")
+        self.run(MODE_SETTLE_MS)
+        steps = [self.step(name, sp, dwell_ms) for sp in setpoints]
+        self.run(REPORT_MS)
+        self.firmware_settling(name, steps)
+        return steps
+
+    def channel(self, name: str):
+        """Channel object of the firmware"""
+        for ch in self.main.control_channels:
+            if ch.Name == name:
+                return ch
+        raise KeyError(name)
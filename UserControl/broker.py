@@ -0,0 +1,333 @@
+"""
+Serial broker: one process owns the link to the pico and shares it with any number of local clients,
+so the GUI can monitor the board while run_carac.py runs a characterization
+
+    python broker.py -device /dev/ttyACM0
+    python run_carac.py sweep.yaml -device broker:/tmp/pispos.sock
+
+The broker listens on a Unix socket path, only open to the user running it (mode 0600), or on localhost:<port> for TCP.
+It sends one JSON object per line:
+    {"type": "data", "channels": {"a": {"SeqData": [...], "TData": [...], "IData": [...], "VData": [...]}, ...}}
+    {"type": "event", "line": "RANGE 2"}
+    {"type": "dropped", "count": 12}    data batches a slow client missed
+Current values are not calibrated, each client applies its own calibration.
+Frame numbers are forwarded so clients also detect the batches they missed.
+Clients send plain command lines, written to the pico in arrival order.
+Link commands (set baud, set link, link ...) are refused, the link belongs to the broker.
+"""
+import os
+import json
+import socket
+import select
+import asyncio
+from collections import deque
+
+import serial_functions as serfn
+
+import logging
+# ✓ ✗ ⚠ ℹ️ ⏳
+
+
+BROKER_PREFIX='broker:' # Device name prefix selecting the broker instead of a serial port
+DEFAULT_ADDRESS='/tmp/pispos.sock'
+MAX_PENDING_BATCHES=100 # Data batches kept for a slow client before dropping the oldest ones
+MAX_PENDING_EVENTS=1000
+LINK_COMMANDS=('set baud', 'set link', 'link ')
+DATA_KEYS=('TData', 'IData', 'VData', 'SeqData', 'GapData') + tuple(serfn.EXTRA_FIELDS.values())
+
+
+def parse_address(address: str):
+    """
+    Returns (host, port) for a host:port address, the socket path otherwise
+    """
+    host, sep, port= address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+
+def encode(message: dict) -> bytes:
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+def take_batch(channels: list) -> dict:
+    """
+    Move the values read since the last call out of the channels buffers
+    Returns the values per channel name, empty if nothing was read
+    """
+    batch= {}
+    for ch in channels:
+        if not ch['TData']:
+            continue
+        batch[ch['Name']]= {key: ch[key] for key in DATA_KEYS if key in ch}
+        for key in batch[ch['Name']]:
+            ch[key]= []
+    return batch
+
+
+class Subscriber:
+    """
+    Connection of one client with its own queues: a slow client only delays itself,
+    it loses its oldest data batches but never the events
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer= writer
+        self.events= deque(maxlen=MAX_PENDING_EVENTS)
+        self.batches= deque(maxlen=MAX_PENDING_BATCHES)
+        self.dropped= 0
+        self.wakeup= asyncio.Event()
+
+    def publish(self, message: dict) -> None:
+        if message['type'] == 'data':
+            if len(self.batches) == self.batches.maxlen:
+                self.dropped+= 1
+            self.batches.append(message)
+        else:
+            self.events.append(message)
+        self.wakeup.set()
+
+    async def send_loop(self) -> None:
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.events or self.dropped or self.batches:
+                # Events go first, they must not wait behind the data
+                if self.events:
+                    message= self.events.popleft()
+                elif self.dropped:
+                    message= {'type': 'dropped', 'count': self.dropped}
+                    self.dropped= 0
+                else:
+                    message= self.batches.popleft()
+                self.writer.write(encode(message))
+                await self.writer.drain()
+
+
+class Broker:
+    """Serial session shared by the connected subscribers"""
+
+    def __init__(self, ser, channel_names: list):
+        self.ser= ser
+        self.subscribers= set()
+        self.commands= asyncio.Queue()
+        # Values are published without calibration
+        self.channels= [{'Name': n, 'IData': [], 'VData': [], 'TData': [], 'ioffset': None}
+                        for n in channel_names]
+
+    def publish(self, message: dict) -> None:
+        for sub in self.subscribers:
+            sub.publish(message)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        sub= Subscriber(writer)
+        self.subscribers.add(sub)
+        sender= asyncio.create_task(sub.send_loop())
+        logging.info(f"✓ Client connected, {len(self.subscribers)} subscriber(s)")
+        try:
+            while line := await reader.readline():
+                cmd= line.decode('utf-8', errors='replace').strip()
+                if not cmd:
+                    continue
+                if cmd.startswith(LINK_COMMANDS):
+                    sub.publish({'type': 'event', 'line': f"BROKER refused {cmd}"})
+                    continue
+                await self.commands.put(cmd)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.discard(sub)
+            sender.cancel()
+            # Collect the end of the sender, it stops on its own when the client went away while sending
+            result, = await asyncio.gather(sender, return_exceptions=True)
+            if isinstance(result, Exception):
+                logging.info(f"ℹ️ Client connection lost: {result}")
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            logging.info(f"ℹ️ Client disconnected, {len(self.subscribers)} subscriber(s)")
+
+    async def write_loop(self) -> None:
+        """Write the commands of every client to the pico, one at a time"""
+        while True:
+            cmd= await self.commands.get()
+            logging.info(f"ℹ️ Sending to serial {cmd}")
+            try:
+                self.ser.write(f"{cmd}\n".encode('utf-8'))
+                self.ser.flush()
+            except Exception as e:
+                logging.error(f"Error while sending data to serial: {e}")
+            await asyncio.sleep(serfn.WRITE_DELAY)
+
+    async def read_loop(self) -> None:
+        """Publish the events and a batch of the values read on each pass"""
+        while True:
+            events= []
+            serfn.read_serial_values(self.ser, events, self.channels)
+            for event in events:
+                self.publish({'type': 'event', 'line': event})
+            batch= take_batch(self.channels)
+            if batch:
+                self.publish({'type': 'data', 'channels': batch})
+            await asyncio.sleep(serfn.FAST_LOOP_TIME)
+
+
+async def serve(ser, address: str, channel_names: list) -> None:
+    """
+    Share the serial session on address until cancelled
+    TCP servers only listen on localhost
+    """
+    broker= Broker(ser, channel_names)
+    target= parse_address(address)
+    if isinstance(target, tuple):
+        server= await asyncio.start_server(broker.handle_client, 'localhost', target[1])
+    else:
+        if os.path.exists(target):
+            os.remove(target)
+        # Only the user running the broker may connect, the socket is created with mode 0600
+        umask= os.umask(0o177)
+        try:
+            server= await asyncio.start_unix_server(broker.handle_client, target)
+        finally:
+            os.umask(umask)
+    logging.info(f"✓ Broker listening on {address}")
+    try:
+        async with server:
+            await asyncio.gather(broker.read_loop(), broker.write_loop())
+    finally:
+        if not isinstance(target, tuple) and os.path.exists(target):
+            os.remove(target)
+
+
+class BrokerLink:
+    """
+    Client side of the broker, used where serial_functions expects a serial.Serial:
+    events are read as lines and data batches are merged into the channels by read_values()
+    """
+    shared= True
+
+    def __init__(self, address: str):
+        target= parse_address(address)
+        if isinstance(target, tuple):
+            self.sock= socket.create_connection(target)
+        else:
+            self.sock= socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(target)
+        self.port= BROKER_PREFIX + address
+        self.baudrate= None
+        self.standby_on_close= True # Set back to standby when closing, unless only monitoring
+        self._buffer= b''
+        self._lines= deque()
+        self._batches= deque()
+
+    def _receive(self) -> None:
+        """Read what the broker sent without blocking"""
+        while select.select([self.sock], [], [], 0)[0]:
+            chunk= self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("Broker closed the connection")
+            self._buffer+= chunk
+        *lines, self._buffer= self._buffer.split(b'\n')
+        for line in lines:
+            message= json.loads(line)
+            if message['type'] == 'data':
+                self._batches.append(message['channels'])
+            elif message['type'] == 'event':
+                self._lines.append(message['line'])
+            elif message['type'] == 'dropped':
+                logging.warning(f"⚠ Too slow to follow the broker, {message['count']} data batches dropped")
+
+    @property
+    def in_waiting(self) -> int:
+        self._receive()
+        return len(self._lines)
+
+    def readline(self) -> bytes:
+        self._receive()
+        if not self._lines:
+            return b''
+        return (self._lines.popleft() + '\n').encode('utf-8')
+
+    def read_values(self, events: list, channels: list) -> None:
+        """
+        Append the received events to the events list and the data batches to the channels buffers,
+        currents are corrected with the calibration of each channel
+        """
+        self._receive()
+        events.extend(self._lines)
+        self._lines.clear()
+        while self._batches:
+            batch= self._batches.popleft()
+            for ch in channels:
+                data= batch.get(ch['Name'])
+                if data is None:
+                    continue
+                i= data['IData']
+                if ch.get('ioffset') is not None:
+                    i= serfn.correct_currents(i, data['VData'], ch['ioffset'], ch.get('icoef', 1)).tolist()
+                ch['IData'].extend(i)
+                ch['VData'].extend(data['VData'])
+                ch['TData'].extend(data['TData'])
+                # Gaps include the frames the broker could not read and the batches dropped for this client
+                for seq in data['SeqData']:
+                    serfn.mark_gap(ch, seq)
+                for field, key in serfn.EXTRA_FIELDS.items():
+                    if key in data:
+                        values= data[key]
+                        if field in serfn.CURRENT_FIELDS and ch.get('ioffset') is not None:
+                            values= serfn.correct_currents(values, data['VData'], ch['ioffset'], ch.get('icoef', 1)).tolist()
+                        ch.setdefault(key, []).extend(values)
+
+    def write(self, data: bytes) -> None:
+        self.sock.sendall(data)
+
+    def flush(self) -> None:
+        pass
+
+    def reset_input_buffer(self) -> None:
+        self._receive()
+        self._lines.clear()
+        self._batches.clear()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def main() -> None:
+    import argparse
+    import yaml
+    from pathlib import Path
+
+    parser = argparse.ArgumentParser(description='Share the serial link of the Raspberry Pico with local clients.')
+    parser.add_argument('-device', type=str, default='/dev/ttyACM0', help='Path to the Raspberry Pico device.')
+    parser.add_argument('-baud', type=int, default=115200, help='Baud rate for serial communication.')
+    parser.add_argument('-usb-device', type=str, default=None, help='Native USB port of the Raspberry Pico, tried first by the fast link.')
+    parser.add_argument('--slow-link', action='store_true', help="Don't negotiate a faster link with the board.")
+    parser.add_argument('-address', type=str, default=None, help=f'Unix socket path or localhost:<port> to listen on (default: {DEFAULT_ADDRESS}).')
+    parser.add_argument('-d', '--debug', action='store_true', help='Activate debug logging.')
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    with open(Path('pispos_config.yaml'), 'r') as f:
+        config= yaml.safe_load(f)
+    address= args.address or config['setup'].get('broker') or DEFAULT_ADDRESS
+
+    ser= serfn.setup_serial_link(args.device, args.baud, None,
+                                 usb_device=args.usb_device, fast=not args.slow_link)
+    if ser is None:
+        logging.error("Cant connect to serial device")
+        return
+    try:
+        asyncio.run(serve(ser, address, config['setup']['channels']))
+    except KeyboardInterrupt:
+        logging.info("✓ Broker stopped")
+    finally:
+        serfn.close_serial_link(ser)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,6 @@
 from pathlib import Path
-import pandas as pd
-import numpy as np
-from scipy.ndimage import gaussian_filter1d
-from scipy.stats import linregress
+import threading
+import hashlib
 
 import logging
 # ✓ ✗ ⚠ ℹ️ ⏳
@@ -11,10 +9,176 @@ import logging
 OFFSETS_I_FILENAME= 'offsets_i_noload_range'
 COEFFS_I_FILENAME= 'coeffs_i'
 
+# Pre-processed calibrations are kept outside the calibration folder
+# so that writing them does not change the folder mtime used as a cache key
+CACHE_DIR= Path.home() / '.cache' / 'pispos'
+CACHE_FILENAME= 'calib_range'
+RANGES= range(5)
+
+# Processing of the calibration files, part of the cache key
+RESAMPLE_POINTS= 300 # Points of the resampled current offsets table
+RESAMPLE_SIGMA= 3 # Width of the gaussian filter applied before resampling
+REFERENCE_CHANNEL= 'va' # Voltage column of the channel connected to the reference resistor
+
+# In-memory cache: range index -> {'sources': tuple, 'channels': {name: (ioffset, icoef)}}
+_calib_cache= {}
+_calib_lock= threading.Lock()
+
+
 def load_calibration_files(range_index: int, channels: list, dir: Path)-> None:
-    """Load calibration files for ammeter range r (0-4)"""
-    
-    calfile= dir / f"{OFFSETS_I_FILENAME}{range_index}.dat"
+    """
+    Apply the calibration of ammeter range r (0-4) to the channels
+    The pre-processed calibration is taken from the cache when the source files did not change
+    """
+    names= [ch['Name'] for ch in channels]
+    calib= get_calibration(range_index, names, dir)
+    apply_calibration(calib, channels)
+
+
+def apply_calibration(calib: dict, channels: list)-> None:
+    """
+    Swap the channels corrections with the ones of a pre-processed calibration
+    Channels missing from the calibration fall back to no correction
+    """
+    for ch in channels:
+        ch['ioffset'], ch['icoef']= calib.get(ch['Name'], (None, 1))
+
+
+def get_calibration(range_index: int, names: list, dir: Path)-> dict:
+    """
+    Return the pre-processed calibration of a range from the memory cache, the disk cache,
+    or by processing the calibration files if none of the caches matches the source files
+    Arguments:
+        - ammeter range (0-4)
+        - list of channel names
+        - calibration folder
+    Returns:
+        - dictionnary {channel name: ((v, i) offset arrays or None, current coefficient)}
+    """
+    with _calib_lock:
+        entry= _calib_cache.get(range_index)
+        if entry is not None and entry['sources'] == calibration_sources(range_index, names, dir, entry['files']):
+            return entry['channels']
+
+        files= find_calibration_files(range_index, dir)
+        sources= calibration_sources(range_index, names, dir, files)
+        # Nothing to process (and no heavy import needed) without calibration files
+        if len(files) == 1 and not files[0].exists():
+            logging.warning(f"⚠ No calibration available for range {range_index}")
+            calib= {}
+        else:
+            calib= read_cached_calibration(range_index, names, dir, sources)
+        if calib is None:
+            calib= process_calibration_files(range_index, names, dir, files)
+            write_cached_calibration(range_index, names, dir, sources, calib)
+        _calib_cache[range_index]= {'files': files, 'sources': sources, 'channels': calib}
+        return calib
+
+
+def preload_calibrations(names: list, dir: Path, ranges=RANGES)-> threading.Thread:
+    """
+    Fill the calibration cache for the ammeter ranges (all by default) in a background thread
+    so that later range switches only have to swap the corrections
+    """
+    def _preload():
+        for r in ranges:
+            try:
+                get_calibration(r, names, dir)
+            except Exception as e:
+                logging.warning(f"⚠ Cannot preload calibration for range {r}: {e}")
+        logging.info("✓ Calibrations preloaded")
+
+    thread= threading.Thread(target=_preload, name='calib-preload', daemon=True)
+    thread.start()
+    return thread
+
+
+def find_calibration_files(range_index: int, dir: Path)-> tuple:
+    """Return the offsets and coefficients files used by range r (0-4)"""
+    files= [dir / f"{OFFSETS_I_FILENAME}{range_index}.dat"]
+    try:
+        for f in sorted(dir.iterdir()):
+            if f.name.startswith(COEFFS_I_FILENAME) \
+                and f.name.endswith(f"range{range_index}.dat"):
+                files.append(f)
+    except Exception as e:
+        logging.warning(f"⚠ Cannot list calibration folder {dir}: {e}")
+    return tuple(files)
+
+
+def calibration_sources(range_index: int, names: list, dir: Path, files: tuple)-> tuple:
+    """
+    Build the cache key of a range: the channel names, the processing parameters,
+    and the folder and files paths with their mtime
+    The folder mtime changes when a calibration file is added or removed
+    """
+    sources= [str(range_index), f"channels\t{','.join(names)}",
+              f"processing\t{RESAMPLE_POINTS},{RESAMPLE_SIGMA},{REFERENCE_CHANNEL}"]
+    for f in (dir,)+tuple(files):
+        try:
+            mtime= f.stat().st_mtime_ns
+        except OSError:
+            mtime= None
+        sources.append(f"{f}\t{mtime}")
+    return tuple(sources)
+
+
+def cache_file(range_index: int, names: list, dir: Path)-> Path:
+    """Disk cache of a range, one per calibration folder and set of channels"""
+    key= f"{Path(dir).resolve()}\t{','.join(names)}"
+    digest= hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return CACHE_DIR / f"{CACHE_FILENAME}{range_index}_{digest}.npz"
+
+
+def read_cached_calibration(range_index: int, names: list, dir: Path, sources: tuple):
+    """Read a pre-processed calibration from disk, None if missing or outdated"""
+    import numpy as np
+    f= cache_file(range_index, names, dir)
+    try:
+        with np.load(f, allow_pickle=False) as data:
+            if tuple(data['sources'].tolist()) != sources:
+                logging.debug(f"Outdated calibration cache {f}")
+                return None
+            calib= {}
+            for n in data['names'].tolist():
+                ioffset= None
+                if f"v{n}" in data.files:
+                    ioffset= (data[f"v{n}"], data[f"i{n}"])
+                calib[n]= (ioffset, float(data[f"icoef{n}"]))
+        logging.info(f"✓ Loaded cached calibration for range {range_index}")
+        return calib
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"⚠ Cannot read calibration cache {f}: {e}")
+        return None
+
+
+def write_cached_calibration(range_index: int, names: list, dir: Path, sources: tuple, calib: dict)-> None:
+    """Store a pre-processed calibration as binary tables"""
+    import numpy as np
+    f= cache_file(range_index, names, dir)
+    tables= {
+        'sources': np.array(sources),
+        'names': np.array(list(calib.keys()))
+    }
+    for n, (ioffset, icoef) in calib.items():
+        if ioffset is not None:
+            tables[f"v{n}"], tables[f"i{n}"]= ioffset
+        tables[f"icoef{n}"]= np.float64(icoef)
+    try:
+        f.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(f, **tables)
+    except Exception as e:
+        logging.warning(f"⚠ Cannot write calibration cache {f}: {e}")
+
+
+def process_calibration_files(range_index: int, names: list, dir: Path, files: tuple)-> dict:
+    """Read and process the calibration files for ammeter range r (0-4)"""
+    import pandas as pd
+    channels= [{'Name': n, 'ioffset': None, 'icoef': 1} for n in names]
+
+    calfile= files[0]
     logging.info(f"ℹ️ Trying to read offset file {calfile}...")
     df=pd.DataFrame()
     try:
@@ -22,7 +186,7 @@ def load_calibration_files(range_index: int, channels: list, dir: Path)-> None:
         logging.info(f"✓ Loaded {len(df)} calibration points")
     except Exception as e:
         logging.warning(f"⚠ No calibration available for range {range_index}: {e}")
-    
+
     # Process channels if data loaded
     if not df.empty:
         cols= df.columns.to_list()
@@ -34,8 +198,8 @@ def load_calibration_files(range_index: int, channels: list, dir: Path)-> None:
                 logging.info(f"ℹ️ Loading current offsets for channel {n}")
                 cal = df[[i, v]]
                 cal = cal.sort_values(v).reset_index(drop=True)
-                ch['ioffset'] = resample_xy(cal, v, i, 300, 3)\
-                            .rename(columns={v: 'v', i: 'i'})
+                cal = resample_xy(cal, v, i, RESAMPLE_POINTS, RESAMPLE_SIGMA)
+                ch['ioffset'] = (cal[v].values, cal[i].values)
             else:
                 logging.warning(f"Column {v} or {i} are missing from I offsets table")
 
@@ -43,28 +207,27 @@ def load_calibration_files(range_index: int, channels: list, dir: Path)-> None:
     logging.info(f"ℹ️ Getting Ammeters coeficients for range {range_index}...")
     try:
         #Get the apropriate file
-        for f in dir.iterdir():
-            if f.name.startswith(COEFFS_I_FILENAME) \
-                and f.name.endswith(f"range{range_index}.dat"):
-                # Get the resistor value from the filename _R1k_range
-                R= f.name.split('_')[2][1:-1]
-                logging.info(f"✓ Found a file for R={R} kOmhs ({f.name})")
-
-                df= pd.DataFrame
-                df = pd.read_csv(f)
-                logging.debug(f"✓ Loaded {len(df)} calibration points")
-                if not df.empty:
-                    calculate_ammeter_coefs(df, float(R), channels, 'va')
+        for f in files[1:]:
+            # Get the resistor value from the filename _R1k_range
+            R= f.name.split('_')[2][1:-1]
+            logging.info(f"✓ Found a file for R={R} kOmhs ({f.name})")
+
+            df = pd.read_csv(f)
+            logging.debug(f"✓ Loaded {len(df)} calibration points")
+            if not df.empty:
+                calculate_ammeter_coefs(df, float(R), channels, REFERENCE_CHANNEL)
     except Exception as e:
         logging.warning(f"⚠ Cannot set a current coefficient for range {range_index}: {e}")
 
+    return {ch['Name']: (ch['ioffset'], ch['icoef']) for ch in channels}
 
-def calculate_ammeter_coefs(df: pd.DataFrame, R: float, channels: list, chvref: str):
+
+def calculate_ammeter_coefs(df: 'pd.DataFrame', R: float, channels: list, chvref: str):
     """
     This fuction performs a linear fit of the I(V) charateristics measured
     with a reference resistir R. It returns a scaling factor for each channel
     to match Ohm's law expectations
-    
+
     Arguments:
         - df: Dataframe containing the calibration data
         - R: the resistor used with this dataset
@@ -73,6 +236,7 @@ def calculate_ammeter_coefs(df: pd.DataFrame, R: float, channels: list, chvref:
     Returns:
         - List of 3 floats (scaling factor for each channel)
     """
+    from scipy.stats import linregress
     for ch in channels:
         try:
             n= ch['Name']
@@ -88,7 +252,7 @@ def calculate_ammeter_coefs(df: pd.DataFrame, R: float, channels: list, chvref:
 
 
 
-def resample_xy(df: pd.DataFrame, x: str, y: str, n: int, sigma: int):
+def resample_xy(df: 'pd.DataFrame', x: str, y: str, n: int, sigma: int):
     """
     This function resamples a two-columns dataframe over a given number of points n
     Arguments:
@@ -99,10 +263,13 @@ def resample_xy(df: pd.DataFrame, x: str, y: str, n: int, sigma: int):
     Returns:
         - Resampled df
     """
+    import numpy as np
+    import pandas as pd
+    from scipy.ndimage import gaussian_filter1d
     df= df[[x,y]] #Ensure the df has only two columns
     df = df.sort_values(x).drop_duplicates(subset=[x])
     df[y] = gaussian_filter1d(df[y].values, sigma=sigma)
-    
+
     # Define new regular x grid (100 points over your range of interest)
     xmin, xmax = df[x].min(), df[x].max()
     x_new = np.linspace(xmin, xmax, n)
@@ -110,4 +277,4 @@ def resample_xy(df: pd.DataFrame, x: str, y: str, n: int, sigma: int):
     # Interpolate y onto the regular grid
     y_new = np.interp(x_new, df[x].values, df[y].values)
 
-    return pd.DataFrame({x: x_new, y: y_new})
\ No newline at end of file
+    return pd.DataFrame({x: x_new, y: y_new})
@@ -1,7 +1,8 @@
+import startup_profile
+startup_profile.enabled_from_argv()
+
 import tkinter as tk
 from tkinter import ttk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
 from pathlib import Path
 import serial_functions as serfn
 import calib_functions as calfn
@@ -26,6 +27,9 @@ def read_yaml(filepath: Path)-> dict:
         logging.error(f"✗ Error opening file: {e}")
         return None
 
+# Period of the device statistics requests in milliseconds
+STATS_PERIOD= 5000
+
 # Load configuration file
 yamlpath= Path('pispos_config.yaml')
 config= None
@@ -41,9 +45,26 @@ class RealTimeGUI:
         self.ser = None
         self.device_var = None
         self.connection_status = None
+        self.stats_box = None
 
         # Board state
         self.events= [] # Buffer to store events coming from the board
+        self.event_handlers= {
+            'STATS': self.on_stats,
+            'SWITCH': self.on_switch,
+            'RANGE': self.on_range,
+            'STATE': self.on_state,
+            'ALERT': self.on_alert,
+            'SETTLED': self.on_settled,
+            'FEEDFORWARD': self.on_feedforward,
+            'CAPTURE': self.on_capture,
+            'CAPDATA': self.on_capture,
+            'CAPEND': self.on_capture,
+            'ACTIVITY': self.on_activity,
+            'LOG': serfn.log_device_message,
+            'LOGEND': serfn.log_device_message
+        }
+        self.pending_captures= {} # Transient captures being received, by channel name
         self.range= None
         self.sampling_freq= config['gui']['sampling frequency']
         self.graph_duration= config['gui']['chart duration']
@@ -108,6 +129,8 @@ class RealTimeGUI:
         
         
         # RIGHT: PLOTS
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
         plot_frame = tk.Frame(main_frame)
         plot_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
         
@@ -207,6 +230,11 @@ class RealTimeGUI:
                             bg="#e0e0e0", fg="Black", font=("Arial", 10, "bold"), width=8)
         update_btn.pack(fill=tk.X, pady=(5, 0))
 
+        # Capture button: upload the last second of full-rate measurements
+        capture_btn = tk.Button(ch_frame, text="Capture", command=lambda c=ch: self.request_capture(c),
+                            bg="#e0e0e0", fg="Black", font=("Arial", 10, "bold"), width=8)
+        capture_btn.pack(fill=tk.X, pady=(2, 0))
+
         # Status textbox
         ch['StatusBox'] = tk.Label(ch_frame, 
                                     text="Undefined", 
@@ -254,53 +282,137 @@ class RealTimeGUI:
 
     def update_events(self)-> None:
         """
-        This function watches the content of the event_list and
-        eventually update GUI textboxes or trigger relays in case of overload
+        This function periodically processes the content of the event_list
         """
-        for event in self.events:
-            logging.info(f"Event recieved: {event}")
-            ep= event.split(' ')
-            if 'PushPullConnected' in event and len(ep)==4:
-                try:
-                    n= self.channel_names.index(ep[1])
-                    if ep[3]=='True':
-                        self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Push-pull output connected", fg="green"))
-                    else:
-                        self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Push-pull output disconnected", fg="gray"))
-                except Exception as e:
-                    logging.error(f"Error parsing switch state: {e}")
-            elif 'Range' in event and len(ep)==3:
-                try:
-                    self.range= int(ep[1])
-                    # Update the calibrations for the new range
-                    try:
-                        calfn.load_calibration_files(self.range, self.channels, self.calibpath)
-                    except Exception as e:
-                        logging.error(f"Error getting the calibration for range {self.range}: {e}")
-                except Exception as e:
-                    logging.error(f"Error parsing range: {e}")
-            elif 'State' in event and len(ep)>=3:
-                try:
-                   n= self.channel_names.index(ep[1])
-                   message= ' '.join(ep[2:])
-                   color= "green"
-                   if 'Saturation' in message:
-                       color= "red"
-                   self.root.after(0, self.channels[n]['StatusBox'].config(text=message, fg=color))
-                except Exception as e:
-                    logging.error(f"Error parsing state: {e}")
-            elif 'Alert ' in event:
-                try:
-                    n= self.channel_names.index(ep[1])
-                    message= ' '.join(ep[3:])
-                    self.root.after(0, self.channels[n]['StatusBox'].config(text=message, fg="red"))
-                except Exception as e:
-                    logging.error(f"Error parsing alert: {e}")
+        self.dispatch_events()
+        if self._running:
+            self.root.after(100, self.update_events)
 
 
+    def dispatch_events(self)-> None:
+        """
+        Update GUI textboxes from the events received from the board,
+        each event goes to the handler registered for its message type
+        """
+        for event in self.events:
+            if event.startswith('CAPDATA'):
+                logging.debug(f"Event recieved: {event}")
+            else:
+                logging.info(f"Event recieved: {event}")
+            serfn.dispatch_event(event, self.event_handlers)
         self.events.clear()
-        if self._running:
-            self.root.after(100, self.update_events)
+
+
+    def on_stats(self, ep: list)-> None:
+        self.show_device_stats(serfn.parse_device_stats(' '.join(ep)))
+
+
+    def on_switch(self, ep: list)-> None:
+        """SWITCH <ch> <True|False>"""
+        n= self.channel_names.index(ep[1])
+        if ep[2]=='True':
+            self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Push-pull output connected", fg="green"))
+        else:
+            self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Push-pull output disconnected", fg="gray"))
+
+
+    def on_range(self, ep: list)-> None:
+        """RANGE <range>"""
+        self.range= int(ep[1])
+        # Update the calibrations for the new range
+        try:
+            calfn.load_calibration_files(self.range, self.channels, self.calibpath)
+        except Exception as e:
+            logging.error(f"Error getting the calibration for range {self.range}: {e}")
+
+
+    def on_state(self, ep: list)-> None:
+        """STATE <ch> <message>"""
+        n= self.channel_names.index(ep[1])
+        message= ' '.join(ep[2:])
+        color= "green"
+        if 'Saturation' in message:
+            color= "red"
+        self.root.after(0, self.channels[n]['StatusBox'].config(text=message, fg=color))
+
+
+    def on_settled(self, ep: list)-> None:
+        """SETTLED <ch> <ms|timeout> <ff|pid> <setpoint>"""
+        n= self.channel_names.index(ep[1])
+        mode= 'feedforward' if ep[3] == 'ff' else 'PID'
+        if ep[2] == 'timeout':
+            self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Not settled ({mode})", fg="red"))
+        else:
+            self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Settled in {ep[2]} ms ({mode})", fg="green"))
+
+
+    def on_feedforward(self, ep: list)-> None:
+        """FEEDFORWARD <ch> <points|failed>"""
+        n= self.channel_names.index(ep[1])
+        if ep[2] == 'failed':
+            self.root.after(0, self.channels[n]['StatusBox'].config(text="Characterization failed", fg="red"))
+        else:
+            self.root.after(0, self.channels[n]['StatusBox'].config(text=f"Characterized on {ep[2]} points", fg="green"))
+
+
+    def on_capture(self, ep: list)-> None:
+        """CAPTURE <ch> <reason> <samples> <period_ms>, CAPDATA <ch> <ms>,<i>,<v>..., CAPEND <ch>"""
+        capture= serfn.collect_capture(ep, self.pending_captures)
+        if capture is not None:
+            self.show_capture(capture)
+
+
+    def request_capture(self, ch: dict)-> None:
+        serfn.safe_write(self.ser, f"capture {ch['Name']} now")
+
+
+    def show_capture(self, capture: dict)-> None:
+        """
+        Plot a transient capture in its own window, time 0 is the trigger
+        """
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+        n= self.channel_names.index(capture['Name'])
+        ch= self.channels[n]
+        i= capture['IData']
+        if ch['ioffset'] is not None and i:
+            i= serfn.correct_currents(i, capture['VData'], ch['ioffset'], ch['icoef'])
+        logging.info(f"ℹ️ Capture of channel {ch['Name']} ({capture['Reason']}): {len(capture['TData'])} samples")
+
+        window= tk.Toplevel(self.root)
+        window.title(f"Channel {ch['Name']} capture - {capture['Reason']}")
+        fig= Figure(figsize=(8, 6))
+        ax_v= fig.add_subplot(2, 1, 1)
+        ax_v.plot(capture['TData'], capture['VData'], color=ch['FgColor'], lw=1.5, marker='.')
+        ax_v.set_ylabel('Voltage (V)')
+        ax_v.tick_params(axis='x', bottom=False, labelbottom=False)
+        ax_i= fig.add_subplot(2, 1, 2, sharex=ax_v)
+        ax_i.plot(capture['TData'], i, color=ch['FgColor'], lw=1.5, marker='.')
+        ax_i.set_ylabel('Current (mA)')
+        ax_i.set_xlabel(f"Time from the trigger (s), {capture['Period']*1e3:g} ms per sample")
+        for ax in (ax_v, ax_i):
+            ax.axvline(0, color='gray', ls='--')
+            ax.grid(True)
+        canvas= FigureCanvasTkAgg(fig, master=window)
+        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        canvas.draw()
+        self.channels[n]['StatusBox'].config(text=f"Captured ({capture['Reason']})", fg="blue")
+
+
+    def on_activity(self, ep: list)-> None:
+        """ACTIVITY <ch> <active|monitor|parked>"""
+        n= self.channel_names.index(ep[1])
+        if ep[2] == 'parked':
+            self.root.after(0, self.channels[n]['StatusBox'].config(text="Parked", fg="gray"))
+        elif ep[2] == 'monitor':
+            self.root.after(0, self.channels[n]['StatusBox'].config(text="Monitoring only", fg="gray"))
+
+
+    def on_alert(self, ep: list)-> None:
+        """ALERT <ch> <message>"""
+        n= self.channel_names.index(ep[1])
+        message= ' '.join(ep[2:])
+        self.root.after(0, self.channels[n]['StatusBox'].config(text=message, fg="red"))
 
 
     def update_plot(self)-> None:
@@ -324,12 +436,9 @@ class RealTimeGUI:
             max_points= int(self.graph_duration*self.sampling_freq)
             logging.debug("Removing oldest points")
             for ch in self.channels:
-                if len(ch['VData']) > max_points:
-                    ch['VData']= ch['VData'][-max_points:]
-                if len(ch['IData']) > max_points:
-                    ch['IData']= ch['IData'][-max_points:]
-                if len(ch['TData']) > max_points:
-                    ch['TData']= ch['TData'][-max_points:]
+                for key in ('VData', 'IData', 'TData', 'SeqData', 'GapData'):
+                    if len(ch.get(key, [])) > max_points:
+                        ch[key]= ch[key][-max_points:]
             
             # Update the plots
             for ch in self.channels:
@@ -367,6 +476,9 @@ class RealTimeGUI:
         else:
             try:
                 serfn.read_serial_values(self.ser, self.events, self.channels)
+                # Events do not wait for the next update_events pass behind the telemetry
+                if self.events:
+                    self.dispatch_events()
             except Exception as e:
                 logging.error(f"Error while reading serial: {e}")
             if self._running:
@@ -446,6 +558,9 @@ class RealTimeGUI:
         import glob
         self.device_ports = [p for p in glob.glob(config['setup']['device']) 
                             if 'Bluetooth' not in p]
+        # The serial broker shares the link of another program
+        if config['setup'].get('broker'):
+            self.device_ports.append(f"broker:{config['setup']['broker']}")
         self.device_ports = self.device_ports or ["No device found"]
         
         self.device_var = tk.StringVar(value=self.device_ports[0])
@@ -496,22 +611,59 @@ class RealTimeGUI:
         time_entry = tk.Entry(time_frame, textvariable=self.time_var, font=("Arial", 12), width=12, justify=tk.CENTER)
         time_entry.pack(anchor=tk.W, pady=(0, 3))
 
+        # Line 5: Device loop timing statistics
+        self.stats_box = tk.Label(parent, text="No device statistics",
+                                        font=("Courier", 9), fg="gray",
+                                        justify=tk.LEFT, anchor=tk.W)
+        self.stats_box.pack(fill=tk.X, padx=10, pady=(0, 5))
+
+
+    def request_stats(self)-> None:
+        """Periodically ask the board for its loop timing statistics"""
+        if self.ser is not None:
+            serfn.request_device_stats(self.ser)
+        if self._running:
+            self.root.after(STATS_PERIOD, self.request_stats)
+
+
+    def show_device_stats(self, stats: dict)-> None:
+        lines= []
+        for name, task in stats['tasks'].items():
+            lines.append(f"{name:<14} worst {task['worst_us']/1e3:6.2f} ms")
+        gc= stats['gc']
+        lines.append(f"GC {gc['count']} runs, max {gc['max_pause_us']/1e3:.2f} ms, {gc.get('auto', 0)} automatic, "
+                     f"{stats.get('overruns', 0)} overruns")
+        lines.append(f"Heap {stats['mem_free']/1024:.0f} kB free, I2C errors {stats['i2c_errors']}, "
+                     f"control errors {stats.get('control_errors', 0)}")
+        if 'tx' in stats:
+            tx= stats['tx']
+            lines.append(f"TX {tx['dropped']} frames dropped, {tx['lost']} events lost, peak {tx['peak']} B")
+        self.stats_box.config(text='\n'.join(lines), fg="black")
+
 
     def connect_pico(self):
         try:
             port = self.device_var.get()
             baud = int(self.baud_var.get())
             
-            self.ser = serfn.setup_serial_link(port, baud, None)
+            self.ser = serfn.setup_serial_link(port, baud, None,
+                                               usb_device=config['setup'].get('usb device'),
+                                               fast=config['setup'].get('fast link', True))
             self.get_user_panel()
+            # Pre-process the calibrations of the other ranges in the background
+            calfn.preload_calibrations(self.channel_names, self.calibpath)
             if self.ser is None:
                 self.connection_status.config(text=f"No reply from {port}", fg="red")
             else:
-                self.connection_status.config(text=f"Connected: {port} @ {baud}", fg="green")
-                logging.info(f"Connected to {port} @ {baud}")
+                port, baud= self.ser.port, self.ser.baudrate
+                port= f"{port} @ {baud}" if baud else port
+                self.connection_status.config(text=f"Connected: {port}", fg="green")
+                logging.info(f"Connected to {port}")
 
                 # Set the sampling frequency to 10 Hz
                 serfn.safe_write(self.ser, f"set sampling {self.sampling_freq}")
+                # Show the device log messages in the host log
+                serfn.safe_write(self.ser, "log stream 1")
             
         except Exception as e:
             self.connection_status.config(text=f"Connection failed: {str(e)}", fg="red")
@@ -521,6 +673,7 @@ class RealTimeGUI:
 
     def run(self):
         self.read_serial()
+        self.request_stats()
         self.update_events()
         self.update_ivp_monitor()
         self.update_plot()
@@ -531,6 +684,7 @@ if __name__ == "__main__":
         config = read_yaml(yamlpath)
         if config is not None:
             app = RealTimeGUI()
+            startup_profile.report()
             app.run()
         else:
             logging.error(f"Cant open configuration yaml file {yamlpath}")
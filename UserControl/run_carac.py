@@ -1,12 +1,10 @@
+import startup_profile
+startup_profile.enabled_from_argv()
+
 from pathlib import Path
 import yaml
-from jsonschema import validate, ValidationError
-import pandas as pd
 import asyncio
 
-import matplotlib.pyplot as plt
-plt.ion()  # Enable interactive mode
-
 import os
 import signal
 def is_valid_file(parser, arg):
@@ -19,10 +17,13 @@ def is_valid_file(parser, arg):
 import argparse
 parser = argparse.ArgumentParser(description='Run voltage sweeps or monitor the multichannel Voltage/Current sensing inteface.')
 parser.add_argument('file', type=lambda x: is_valid_file(parser, x), help='YAML file describing the process.')
-parser.add_argument('-device', type=str, default='/dev/ttyACM0', help='Path to the Raspberry Pico device.')
+parser.add_argument('-device', type=str, default='/dev/ttyACM0', help='Path to the Raspberry Pico device, or broker:<address> to share the link of broker.py.')
 parser.add_argument('-baud', type=int, default=115200, help='Baud rate for serial communication.')
+parser.add_argument('-usb-device', type=str, default=None, help='Native USB port of the Raspberry Pico, tried first by the fast link.')
+parser.add_argument('--slow-link', action='store_true', help="Don't negotiate a faster link with the board.")
 parser.add_argument('-d', '--debug', action='store_true', help='Activate debug logging.')
 parser.add_argument('--no-prompt', action='store_true', help="Don't wait for interactive prompt at the end of a characterization")
+parser.add_argument('--profile-startup', action='store_true', help='Report the import time of each module on startup.')
 args = parser.parse_args()
 
 import logging
@@ -70,6 +71,7 @@ def read_yaml(filepath: Path)-> dict:
 
 
 def validate_yaml(data_file: Path, schema_file: Path) -> bool:
+    from jsonschema import validate, ValidationError
     # Load YAML files
     with open(data_file) as f:
         data = yaml.safe_load(f)
@@ -109,17 +111,26 @@ def create_channels(config: dict)-> list:
     return channels
 
 
-def get_channel_time_series(channels: list)-> pd.DataFrame:
+def get_channel_time_series(channels: list)-> 'pd.DataFrame':
     """
     This function extract the voltage and current vs time of all channels
     and return it in a single pandas dataframe
+    The gap column holds the number of telemetry frames missed just before each row,
+    the other streamed fields get a <field><channel> column, e.g. ja for the minimum current of channel a
     """
+    import pandas as pd
     df= pd.DataFrame()
     try:
         for ch in channels:
             chdf= pd.DataFrame(list(zip(ch['TData'], ch['VData'], ch['IData'])),
                                     columns=['t', f"v{ch['Name']}", f"i{ch['Name']}"])
+            for field, key in serfn.EXTRA_FIELDS.items():
+                if len(ch.get(key, [])) == len(chdf):
+                    chdf[f"{field}{ch['Name']}"]= ch[key]
             if df.empty:
+                # Every frame carries all the channels, the gaps of the first one are the gaps of all
+                if len(ch.get('GapData', [])) == len(chdf):
+                    chdf['gap']= ch['GapData']
                 df=chdf
             else:
                 df= pd.merge(df, chdf, on='t')
@@ -143,6 +154,9 @@ async def plot_values(channels: list, par: dict, dir: Path):
     This function show real-time charts of channel data according to
     the user requirements depicted in the input yaml file
     """
+    # matplotlib is only needed when the carac defines plots
+    import matplotlib.pyplot as plt
+    plt.ion()  # Enable interactive mode
     _, ax = plt.subplots()
     logging.info(f"ℹ️ Starting plot for {par}")
     while True:
@@ -170,6 +184,7 @@ async def plot_values(channels: list, par: dict, dir: Path):
 
 
 async def main()-> None:
+    startup_profile.report()
     usr_file= args.file
     dir= usr_file.parents[0]
 
@@ -179,7 +194,7 @@ async def main()-> None:
 
     # Create the channels according to the configuration file
     channels= create_channels(config)
-
+    calibpath= Path(config['setup']['calibration folder'])
 
     # Validate input YAML file against schema
     schema= Path('schema.yaml')
@@ -189,116 +204,161 @@ async def main()-> None:
     # Load configuration using helper that opens the file
     usr_input = read_yaml(usr_file)
 
-    # Execute required electical characterization based on configurations
-    for carac in usr_input['caracs']:
-        logging.info(f"ℹ️ Running electrical characterization: {carac['name']}")
+    # One link for all the characterizations, set up with the first one
+    caracs= usr_input['caracs']
+    # The calibration of the first range is loaded when needed, the other ranges used are preloaded meanwhile
+    ranges= list(dict.fromkeys(int(carac['init']['range']) for carac in caracs))
+    if len(ranges) > 1:
+        calfn.preload_calibrations(config['setup']['channels'], calibpath, ranges[1:])
+    session= serfn.open_session(args.device, args.baud, caracs[0]['init'],
+                                usb_device=args.usb_device, fast=not args.slow_link)
+    if session is None:
+        logging.error("Cant connect to serial device")
+        return
+    try:
+        for carac in caracs:
+            await run_carac(carac, session, channels, calibpath, dir)
+    finally:
+        session.close()
+
 
-        ser = None
-        loop = None
-        try:
-            # Setting up the pico to the sampling rate and time step
-            ser = serfn.setup_serial_link(args.device, args.baud, carac['init'])
-            if ser is None:
-                logging.error("Cant connect to serial device")
-                return
-
-            # Make sure panel switches are at their right position
-            range = serfn.wait_until_panel_ready(ser, carac['init'])
-
-            # Load the calibration files
-            calfn.load_calibration_files(range, channels, Path(config['setup']['calibration folder']))
-
-            # Define async tasks for reading serial values and running sweeps
-            events = []
-            task_list = []
-            task_list.append(asyncio.create_task(serfn.read_serial_loop(ser, events, channels)))
-            if 'sweep' in carac:
-                task_list.append(asyncio.create_task(serfn.run_sweep(carac['sweep'], ser)))
-            elif 'static' in carac:
-                # if no sweep defined, just wait for the specified duration while reading values
-                task_list.append(asyncio.create_task(static_run(carac['static'])))
-            else:
-                logging.error("✗ No sweep or static defined in the configuration. Exiting.")
-                serfn.initialize_channels(None, ser)
-                continue
-
-            # prepare the list of plots to generate
-            if 'plots' in carac:
-                for chart in carac['plots']:
-                    task_list.append(asyncio.create_task(plot_values(channels, chart, dir)))
-
-            # Handle signals: create a stop event and a waiter task
-            stop = asyncio.Event()
-            loop = asyncio.get_running_loop()
-            stop_task = asyncio.create_task(stop.wait())
-
-            def _signal_handler():
-                logging.info("ℹ️ Signal received, stopping tasks...")
-                stop.set()
-
-            for s in (signal.SIGINT, signal.SIGTERM):
-                try:
-                    loop.add_signal_handler(s, _signal_handler)
-                except NotImplementedError:
-                    # Windows or unsupported loop implementation
-                    pass
-
-            wait_tasks = task_list + [stop_task]
-            _, pending = await asyncio.wait(
-                wait_tasks,
-                return_when=asyncio.FIRST_COMPLETED
-            )
-
-            if stop.is_set():
-                logging.info("✓ Stopping due to external signal")
-            else:
-                logging.info("✓ First task completed. Cancelling others...")
+async def run_carac(carac: dict, session: 'serfn.DeviceSession', channels: list, calibpath: Path, dir: Path) -> None:
+    """
+    Run one electrical characterization on the open session
+    The pico keeps the setup of the previous characterization, only the changes are sent
+    """
+    logging.info(f"ℹ️ Running electrical characterization: {carac['name']}")
+    ser = session.ser
+    loop = None
+    try:
+        # Setting up the pico to the sampling rate and time step,
+        # only streaming the channels and fields this characterization uses
+        session.configure(carac['init'], carac.get('plots'))
+
+        # Make sure panel switches are at their right position
+        range = session.wait_panel_ready(carac['init'])
 
-            for task in pending:
-                task.cancel()
+        # Load the calibration files
+        calfn.load_calibration_files(range, channels, calibpath)
 
-            # Wait for cancellation to be processed
+        # Duty cycle to voltage curves of the feedforward lookup, once the push-pull outputs are connected
+        session.characterize(carac)
+
+        # The frames streamed since the previous characterization were dropped, they are not gaps
+        for ch in channels:
+            ch.pop('LastSeq', None)
+
+        # Define async tasks for reading serial values and running sweeps
+        events = []
+        task_list = []
+        task_list.append(asyncio.create_task(serfn.read_serial_loop(ser, events, channels)))
+        if 'sweep' in carac:
+            task_list.append(asyncio.create_task(serfn.run_sweep(carac['sweep'], ser, carac.get('pulsed'))))
+        elif 'static' in carac:
+            if 'setpoint' in carac.get('pulsed', {}):
+                serfn.safe_write(ser, serfn.pulse_command(carac['pulsed'], carac['pulsed']['setpoint']))
+            if carac['static'].get('integrate'):
+                serfn.reset_integrals(ser)
+            # if no sweep defined, just wait for the specified duration while reading values
+            task_list.append(asyncio.create_task(static_run(carac['static'])))
+        else:
+            logging.error("✗ No sweep or static defined in the configuration. Exiting.")
+            session.standby()
+            return
+
+        # prepare the list of plots to generate
+        if 'plots' in carac:
+            for chart in carac['plots']:
+                task_list.append(asyncio.create_task(plot_values(channels, chart, dir)))
+
+        # Handle signals: create a stop event and a waiter task
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        stop_task = asyncio.create_task(stop.wait())
+
+        def _signal_handler():
+            logging.info("ℹ️ Signal received, stopping tasks...")
+            stop.set()
+
+        for s in (signal.SIGINT, signal.SIGTERM):
             try:
-                await asyncio.gather(*pending, return_exceptions=True)
-            except asyncio.CancelledError:
+                loop.add_signal_handler(s, _signal_handler)
+            except NotImplementedError:
+                # Windows or unsupported loop implementation
                 pass
 
-            # close the serial link
-            serfn.close_serial_link(ser)
-            ser=None
+        wait_tasks = task_list + [stop_task]
+        _, pending = await asyncio.wait(
+            wait_tasks,
+            return_when=asyncio.FIRST_COMPLETED
+        )
 
-            if 'datafile' in carac:
-                data = get_channel_time_series(channels)
-                outfile = dir / carac['datafile']
-                data.to_csv(outfile, index=False)
-                logging.info(f"✓ Results saved to {outfile}")
+        if stop.is_set():
+            logging.info("✓ Stopping due to external signal")
+        else:
+            logging.info("✓ First task completed. Cancelling others...")
 
-            if not args.no_prompt:
-                try:
-                    await asyncio.to_thread(input, "Press Enter to end this characterization")
-                except Exception:
-                    pass
+        for task in pending:
+            task.cancel()
 
-        except Exception as e:
-            logging.error('✗ Error occurred: %s', e)
-        finally:
-            # Remove signal handlers if we registered them
+        # Wait for cancellation to be processed
+        try:
+            await asyncio.gather(*pending, return_exceptions=True)
+        except asyncio.CancelledError:
+            pass
+
+        # Charge and energy integrated by the pico over the static run
+        integrals= None
+        if carac.get('static', {}).get('integrate'):
+            integrals= serfn.read_integrals(ser, [ch['Name'] for ch in channels])
+            for name, integ in integrals.items():
+                logging.info(f"ℹ️ Channel {name}: {integ['charge_mAh']:.6g} mAh, {integ['energy_mWh']:.6g} mWh "
+                             f"in {integ['time_s']:.1f} s")
+
+        # Back to 0 until the next characterization, the link stays open
+        session.track(events)
+        session.release(carac['init'], carac.get('pulsed'))
+
+        serfn.log_device_messages(events)
+        for mode, s in serfn.settling_summary(events).items():
+            logging.info(f"ℹ️ Settling ({'feedforward' if mode == 'ff' else 'PID only'}): {s['count']} setpoint changes, "
+                         f"mean {s['mean_ms']} ms, max {s['max_ms']} ms, {s['timeouts']} not settled")
+
+        if 'datafile' in carac:
+            data = get_channel_time_series(channels)
+            outfile = dir / carac['datafile']
+            data.to_csv(outfile, index=False)
+            logging.info(f"✓ Results saved to {outfile}")
+            if integrals:
+                import pandas as pd
+                outfile= outfile.with_name(f"{outfile.stem}_integrals.csv")
+                pd.DataFrame.from_dict(integrals, orient='index').rename_axis('channel').to_csv(outfile)
+                logging.info(f"✓ Charge and energy saved to {outfile}")
+
+        if not args.no_prompt:
             try:
-                if loop is not None:
-                    for s in (signal.SIGINT, signal.SIGTERM):
-                        try:
-                            loop.remove_signal_handler(s)
-                        except Exception:
-                            pass
-            except NameError:
+                await asyncio.to_thread(input, "Press Enter to end this characterization")
+            except Exception:
                 pass
 
-            # Ensure serial link is closed
-            if ser is not None:
-                try:
-                    serfn.close_serial_link(ser)
-                except Exception:
-                    pass
+    except Exception as e:
+        logging.error('✗ Error occurred: %s', e)
+        # The state of the pico is unknown, the next characterization sends its whole setup
+        try:
+            session.standby()
+        except Exception:
+            pass
+    finally:
+        # Remove signal handlers if we registered them
+        try:
+            if loop is not None:
+                for s in (signal.SIGINT, signal.SIGTERM):
+                    try:
+                        loop.remove_signal_handler(s)
+                    except Exception:
+                        pass
+        except NameError:
+            pass
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -1,7 +1,6 @@
 import serial
 import asyncio
-import numpy as np
-from time import sleep
+from time import sleep, monotonic
 
 import logging
 # ✓ ✗ ⚠ ℹ️ ⏳
@@ -17,14 +16,69 @@ STANDBY={
     ]
 }
 
+# Upper bounds of the firmware jitter histogram bins in microseconds (see loopstats.py)
+JITTER_BINS_US=(100, 500, 1000, 2000, 5000, 10000)
+
+# Every line from the pico starts with its message type, telemetry frames with DATA_TAG
+# and events with an upper case word dispatched by dispatch_event (see write_serial in main.py)
+DATA_TAG='D'
+SEQ_MODULO=65536 # Telemetry frames are numbered modulo this value (see config.py of the firmware)
+
+# Telemetry stream fields stored in addition to IData and VData: duty, setpoint, power (mW),
+# the aggregates of the measurements between two frames: count, current and voltage min and max,
+# and the integrals since their reset: charge (mAh) and energy (mWh)
+EXTRA_FIELDS={'d': 'DutyData', 's': 'SPData', 'p': 'PData',
+              'n': 'CountData', 'j': 'IMinData', 'k': 'IMaxData', 'w': 'VMinData', 'x': 'VMaxData',
+              'q': 'QData', 'e': 'EData'}
+CURRENT_FIELDS=('j', 'k') # Extra fields corrected with the current calibration
+DEFAULT_STREAM_FIELDS='iv'
+
+# Raw telemetry fields (r)ange, sh(u)nt and (b)us counts are converted on the host (see config.py of the firmware)
+SHUNT_LSB_MA=40e-6/8*1e3 # mA per shunt count across a 1 ohm shunt
+BUS_LSB_V=8e-3/8 # V per bus count
+SHUNTS=(0.1, 1, 10, 100, 1000) # Gross shunt resistor values per range
+
 SLOW_LOOP_TIME=1
+PANEL_CHANNELS=('a', 'b', 'c') # Channels of the push-pull switch states of a PANEL answer, in order
 FAST_LOOP_TIME=1e-3
 WRITE_DELAY=1e-1
+MAX_LINES_PER_READ=256 # Lines read per call of read_serial_values, so the caller keeps control
+LINK_TIMEOUT=1
+FF_TIMEOUT=10 # Time in seconds for the pico to measure the duty cycle to voltage curve of a channel
 
+# Baud rates tried by the fast link negotiation, fastest first
+FAST_BAUDS=(921600, 460800, 230400)
+LINK_RESET_DELAY=5e-2 # Time in seconds for the pico to execute a link reset
 
-def setup_serial_link(device: str, baud: int, init: dict):
+# Host logging levels of the device log messages (see log.py of the firmware)
+DEVICE_LOG_LEVELS={'error': logging.ERROR, 'warn': logging.WARNING, 'info': logging.INFO, 'debug': logging.DEBUG}
+
+
+def setup_serial_link(device: str, baud: int, init: dict, usb_device: str = None, fast: bool = True):
+    """
+    Open the link to the pico and initialize its channels
+    With fast=True, the fastest working link is picked: the pico native USB port if usb_device is given,
+    otherwise the uart link at the highest baud rate both sides agree on
+    A device named broker:<address> connects to the serial broker (see broker.py) instead,
+    the channels are then left as they are if there is no init to send
+    """
     try:
-        ser= serial.Serial(device, baud, timeout=1)
+        ser= None
+        if device.startswith('broker:'):
+            import broker
+            ser= broker.BrokerLink(device[len(broker.BROKER_PREFIX):])
+            ser.standby_on_close= init is not None
+            if init is not None:
+                initialize_channels(init, ser)
+            ser.reset_input_buffer()
+            return ser
+        if fast and usb_device:
+            ser= open_usb_link(usb_device)
+        if ser is None:
+            ser= serial.Serial(device, baud, timeout=1)
+            recover_link(ser, baud)
+            if fast:
+                negotiate_baud(ser, baud)
         initialize_channels(init, ser)
 
         # Purge the serial buffer
@@ -35,10 +89,99 @@ def setup_serial_link(device: str, baud: int, init: dict):
         return None
 
 
+def wait_for_line(ser: serial.Serial, prefix: str, timeout: float = LINK_TIMEOUT):
+    """
+    Read lines until one starts with prefix, telemetry and events are dropped meanwhile
+    Returns the line, or None after timeout seconds
+    """
+    deadline= monotonic() + timeout
+    while monotonic() < deadline:
+        if ser.in_waiting > 0:
+            line= ser.readline().decode('utf-8', errors='replace').strip()
+            if line.startswith(prefix):
+                return line
+        else:
+            sleep(FAST_LOOP_TIME)
+    return None
+
+
+def open_usb_link(device: str):
+    """
+    Try to move the link to the pico native USB port
+    Returns the serial connection, or None if the pico does not answer on it
+    """
+    try:
+        ser= serial.Serial(device, timeout=1)
+        ser.reset_input_buffer()
+        ser.write(b"set link usb\n")
+        ser.flush()
+        if wait_for_line(ser, 'LINK usb') is not None:
+            logging.info(f"✓ Fast link on the USB port {device}")
+            return ser
+        ser.close()
+    except Exception as e:
+        logging.info(f"ℹ️ USB link not available on {device}: {e}")
+    return None
+
+
+def recover_link(ser: serial.Serial, baud: int) -> None:
+    """
+    Bring the pico back to its default link, the uart at the base rate
+    A session that ended without close_serial_link() may have left it answering on the USB port,
+    or listening at a negotiated rate: the reset is sent at each rate the pico may use, the base one last
+    """
+    for rate in FAST_BAUDS + (baud,):
+        ser.baudrate= rate
+        # The leading newline ends the garbage received at the wrong rates
+        ser.write(b"\nlink reset\n")
+        ser.flush()
+        sleep(LINK_RESET_DELAY)
+    ser.reset_input_buffer()
+
+
+def negotiate_baud(ser: serial.Serial, baud: int) -> int:
+    """
+    Raise the uart baud rate to the fastest rate confirmed by both sides
+    The pico announces the new rate, switches, and goes back to the previous one
+    if the host does not confirm it within a second
+    Returns the baud rate in use
+    """
+    for rate in FAST_BAUDS:
+        if rate <= baud:
+            continue
+        logging.info(f"ℹ️ Trying baud rate {rate}...")
+        ser.write(f"set baud {rate}\n".encode('utf-8'))
+        ser.flush()
+        if wait_for_line(ser, f"BAUD {rate}") is None:
+            logging.info("ℹ️ The board cannot change its baud rate")
+            return baud
+        ser.baudrate= rate
+        ser.reset_input_buffer()
+        ser.write(b"link confirm\n")
+        ser.flush()
+        if wait_for_line(ser, f"LINK uart {rate}") is not None:
+            logging.info(f"✓ Fast link at {rate} baud")
+            return rate
+        # Let the board go back to the previous rate
+        ser.baudrate= baud
+        sleep(LINK_TIMEOUT)
+        ser.reset_input_buffer()
+    return baud
+
+
 def close_serial_link(ser: serial.Serial)-> None:
     if ser is not None:
         try:
+            # The link of the serial broker is shared: only put back in standby what was set up
+            if getattr(ser, 'shared', False):
+                if ser.standby_on_close:
+                    initialize_channels(None, ser)
+                ser.close()
+                logging.info("Broker connection closed")
+                return
             initialize_channels(None, ser)
+            # Give the link back in its default state for the next session
+            safe_write(ser, "link reset")
             ser.close()
             logging.info("Serial port closed")
         except Exception as e:
@@ -60,7 +203,7 @@ def get_current_config(ser: serial.Serial) -> dict:
     for _ in range(1,30):
         while ser.in_waiting > 0:
             line = ser.readline().decode('utf-8').strip()
-            if line.startswith('STATE'):
+            if line.startswith('PANEL '):
                 logging.debug(line)
                 try:
                     line= line.split(' ')
@@ -81,78 +224,429 @@ def get_current_config(ser: serial.Serial) -> dict:
 
 
 
-def wait_until_panel_ready(ser: serial.Serial, init: dict) -> int:
+def request_device_stats(ser: serial.Serial, reset: bool = False) -> None:
     """
-    This function ask the user to actuate panels switches until having
-    the configuration required for the measurement
-    
-    Arguments:
-        - serial connection to communicate with the board
-        - dictionnary containing the measurement setup
+    Ask the pico for its loop timing statistics, the reply is a STATS event
+    If reset is True, the statistics are cleared instead
+    """
+    safe_write(ser, "stats reset" if reset else "stats")
+
+
+def parse_device_stats(line: str) -> dict:
+    """
+    Parse a STATS line from the pico
     Returns:
-        - Ammeter range switch state (0,1,2,3 or 4)
-    """
-    ready= False
-    range_index= None
-    while not ready:
-        # Ask for the current switches state
-        board_state= get_current_config(ser)
-        logging.debug(f"Current board state: {board_state}")
-        if not board_state['Communicating']:
-            logging.info("ℹ️ Cannot get an answer from the board")
+        - dictionnary with:
+            'tasks': {name: {'count', 'worst_us', 'hist'}} for each instrumented loop
+            'gc': {'count', 'pause_us', 'max_pause_us', 'auto'} timed collections, and automatic ones detected
+            'mem_free': free heap in bytes
+            'i2c_errors': number of failed sensor readings
+            'overruns': number of control periods skipped or overrun
+            'control_errors': number of control periods that raised an error
+            'tx': {'dropped', 'lost', 'peak'} telemetry frames dropped, events lost and peak bytes queued for transmission
+    """
+    stats= {'tasks': {}}
+    for token in line.split(' ')[1:]:
+        key, value= token.split('=')
+        values= value.split(',')
+        if key == 'gc':
+            stats['gc']= dict(zip(['count', 'pause_us', 'max_pause_us', 'auto'], map(int, values)))
+        elif key == 'mem':
+            stats['mem_free']= int(value)
+        elif key == 'i2c':
+            stats['i2c_errors']= int(value)
+        elif key == 'overruns':
+            stats['overruns']= int(value)
+        elif key == 'errors':
+            stats['control_errors']= int(value)
+        elif key == 'tx':
+            stats['tx']= dict(zip(['dropped', 'lost', 'peak'], map(int, values)))
         else:
-            try:
-                ready= True
-                # Check if the current panel switches matche the yaml requirements
-                range_index= int(board_state['AmmeterRange']) # current range switch
-                if range_index != int(init['range']):
-                    logging.info(f"ℹ️ Please set the ammeter range to {init['range']}")
-                    ready= False
-                for ch in init['channels']:
-                    required_state= ch['control']
-                    current_state= board_state[f"{ch['Name']}_PushPullConnected"]
-                    logging.debug(f"Required state for Ch{ch}: {required_state}")
-                    if required_state == 'nc' and current_state == 'True':
-                        logging.info(f"ℹ️ Please disable the push-pull output from {ch['Name']}")
-                        ready= False
-                    if required_state != 'nc' and current_state == 'False':
-                        logging.info(f"ℹ️ Please enable the push-pull output on {ch['Name']}")
-                        ready= False
-            except Exception as e:
-                logging.error(f"Error while checking the panel state: {e}")
-                ready= False
+            stats['tasks'][key]= {
+                'count': int(values[0]),
+                'worst_us': int(values[1]),
+                'hist': [int(h) for h in values[2].split('/')]
+            }
+    return stats
+
+
+def get_device_stats(ser: serial.Serial) -> dict:
+    """
+    Ask the pico for its loop timing statistics and wait for the answer
+    Returns the parsed statistics, or None without an answer
+    """
+    request_device_stats(ser)
+    for _ in range(1,30):
+        while ser.in_waiting > 0:
+            line = ser.readline().decode('utf-8').strip()
+            if line.startswith('STATS'):
+                logging.debug(line)
+                try:
+                    return parse_device_stats(line)
+                except Exception as e:
+                    logging.error(f"✗ Error parsing device stats: {e}")
+                    logging.error(f"✗ Line content: {line}")
         sleep(SLOW_LOOP_TIME)
-    return range_index
+    return None
+
 
+def open_session(device: str, baud: int, init: dict, usb_device: str = None, fast: bool = True):
+    """
+    Open the link to the pico for a series of characterizations, see setup_serial_link()
+    Returns the DeviceSession, or None if the link cannot be set up
+    """
+    ser= setup_serial_link(device, baud, init, usb_device=usb_device, fast=fast)
+    if ser is None:
+        return None
+    session= DeviceSession(ser)
+    session.assume(init)
+    return session
 
 
-def initialize_channels(init: dict, ser: serial.Serial) -> None:
-    logging.info("ℹ️ Initializing channels and time settings...")
+class DeviceSession:
+    """
+    Link to the pico kept open across characterizations
+    The command lines sent are remembered per parameter (see init_commands()), so that a characterization
+    only sends the parameters that differ from the previous one. The panel state is followed
+    from the PANEL, RANGE and SWITCH events, the pico sends them as soon as a switch moves
+    """
+
+    def __init__(self, ser: serial.Serial):
+        self.ser= ser
+        self.sent= {} # parameter -> command lines last sent
+        self.range= None # Position of the ammeter range selector, None until known
+        self.switches= {} # channel name -> push-pull switch connected
+
+    def assume(self, init: dict) -> None:
+        """Record the setup sent by initialize_channels(), with the default stream and activity of every channel"""
+        self.sent= init_commands(init)
+        for ch in (init or STANDBY)['channels']:
+            self.sent[f"{ch['Name']} stream"]= (f"subscribe {ch['Name']} {DEFAULT_STREAM_FIELDS}",)
+            self.sent[f"{ch['Name']} activity"]= mode_activity(ch['Name'], ch['control'])
+
+    def configure(self, init: dict, plots: list = None) -> int:
+        """
+        Set the pico up for a characterization, only the parameters that changed are sent
+        The channels the characterization does not list are put back in standby. The channels streaming
+        nothing in 'nc' mode are parked, as by subscribe_channels(), and unparked once streamed again
+        Arguments:
+            - dictionnary containing the measurement setup
+            - list of plots of the characterization
+        Returns:
+            - number of command lines sent
+        """
+        listed= [ch['Name'] for ch in init['channels']]
+        init= {**init, 'channels': init['channels'] + [ch for ch in STANDBY['channels'] if ch['Name'] not in listed]}
+        controls= {ch['Name']: ch['control'] for ch in init['channels']}
+        commands= init_commands(init)
+        # Streams are set channel by channel instead of being reset
+        del commands['subscribe']
+        option= init.get('feedforward')
+        if option is not None:
+            commands['feedforward']= (f"set feedforward {0 if option is False else 1}",)
+        for ch in init['channels']:
+            fields= stream_fields(ch, plots or [])
+            commands[f"{ch['Name']} stream"]= (f"subscribe {ch['Name']} {fields}",)
+            if fields == '-' and ch['control'] == 'nc':
+                commands[f"{ch['Name']} activity"]= (f"activity {ch['Name']} parked",)
+            else:
+                commands[f"{ch['Name']} activity"]= mode_activity(ch['Name'], ch['control'])
+
+        count= 0
+        for par, lines in commands.items():
+            if self.sent.get(par) == lines:
+                continue
+            for line in lines:
+                safe_write(self.ser, line)
+            count+= len(lines)
+            self.sent[par]= lines
+            if par.endswith(' mode'):
+                # A mode change resets the setpoint, which is sent again, and the activity request
+                name= par.split(' ')[0]
+                self.sent.pop(f"{name} setpoint", None)
+                self.sent[f"{name} activity"]= mode_activity(name, controls[name])
+        logging.info(f"✓ {count} setup commands sent, {len(commands)} parameters checked")
+        return count
+
+    def characterize(self, carac: dict) -> None:
+        """
+        Measure the duty cycle to voltage curves of the voltage regulated channels if the 'feedforward' option
+        of the init is 'characterize', once per session: the pico keeps the curves for the next characterizations
+        The output of each channel is ramped up to the highest setpoint of the characterization, no further
+        Called once the push-pull outputs are connected
+        """
+        init= carac['init']
+        if init.get('feedforward') != 'characterize':
+            return
+        for ch in init['channels']:
+            par= f"{ch['Name']} curve"
+            if ch['control'] != 'v' or par in self.sent:
+                continue
+            limit= highest_setpoint(carac, ch['Name'])
+            if limit <= 0:
+                continue
+            logging.info(f"⏳ Measuring the duty cycle to voltage curve of channel {ch['Name']} up to {limit} V...")
+            lines= (f"characterize {ch['Name']} {limit} confirm",)
+            safe_write(self.ser, lines[0])
+            line= wait_for_line(self.ser, f"FEEDFORWARD {ch['Name']}", FF_TIMEOUT)
+            if line is None or line.endswith('failed'):
+                logging.error(f"✗ Cannot characterize channel {ch['Name']}")
+            else:
+                logging.info(f"✓ Channel {ch['Name']} characterized on {line.split(' ')[2]} points")
+                self.sent[par]= lines
 
+    def release(self, init: dict, pulsed: dict = None) -> None:
+        """
+        Bring the regulated channels back to 0 after a characterization, the sweeps left their setpoints
+        anywhere, and end the pulsed mode of the pulsed channel if any
+        """
+        if pulsed is not None:
+            safe_write(self.ser, f"pulse {pulsed['channel']} off")
+        for ch in init['channels']:
+            self.sent.pop(f"{ch['Name']} setpoint", None)
+            if ch['control'] != 'nc':
+                lines= (f"{ch['Name']} 0",)
+                safe_write(self.ser, lines[0])
+                self.sent[f"{ch['Name']} setpoint"]= lines
+
+    def standby(self) -> None:
+        """Put all the channels in standby, the next configure() sends the whole setup"""
+        initialize_channels(None, self.ser)
+        self.assume(None)
+
+    def close(self) -> None:
+        close_serial_link(self.ser)
+        self.ser= None
+
+    def track(self, events: list) -> None:
+        """Follow the panel state from the events of a run"""
+        for event in events:
+            parts= event.split(' ')
+            try:
+                if parts[0] == 'PANEL':
+                    self.range= int(parts[1]) if parts[1].isdigit() else None
+                    self.switches.update(zip(PANEL_CHANNELS, [p == 'True' for p in parts[2:]]))
+                elif parts[0] == 'RANGE':
+                    self.range= int(parts[1])
+                elif parts[0] == 'SWITCH':
+                    self.switches[parts[1]]= parts[2] == 'True'
+            except (IndexError, ValueError):
+                logging.error(f"✗ Cannot parse the panel event: {event}")
+
+    def poll(self) -> None:
+        """Read what the pico sent, telemetry is dropped and the panel events followed"""
+        events= []
+        read_serial_values(self.ser, events, [])
+        self.track(events)
+
+    def panel_problems(self, init: dict) -> list:
+        """Switch changes the user still has to make for the measurement setup"""
+        problems= []
+        if self.range != int(init['range']):
+            problems.append(f"Please set the ammeter range to {init['range']}")
+        for ch in init['channels']:
+            connected= self.switches.get(ch['Name'])
+            if ch['control'] == 'nc' and connected:
+                problems.append(f"Please disable the push-pull output from {ch['Name']}")
+            if ch['control'] != 'nc' and connected is False:
+                problems.append(f"Please enable the push-pull output on {ch['Name']}")
+        return problems
+
+    def wait_panel_ready(self, init: dict) -> int:
+        """
+        Ask the user to actuate the panel switches until having the configuration required for the measurement
+        The panel state is asked once, then followed from the events of the pico
+
+        Arguments:
+            - dictionnary containing the measurement setup
+        Returns:
+            - Ammeter range switch state (0,1,2,3 or 4)
+        """
+        # Events received since the last characterization
+        while self.ser.in_waiting > 0:
+            self.poll()
+        requested= None
+        shown= None
+        while True:
+            if self.range is None or len(self.switches) < len(PANEL_CHANNELS):
+                if requested is None or monotonic() - requested > LINK_TIMEOUT:
+                    if requested is not None:
+                        logging.info("ℹ️ Cannot get an answer from the board")
+                    logging.info("ℹ️ Asking for the board status...")
+                    safe_write(self.ser, "USER PANEL STATE")
+                    requested= monotonic()
+            else:
+                problems= self.panel_problems(init)
+                if not problems:
+                    logging.info(f"✓ Panel ready, ammeter range {self.range}")
+                    return self.range
+                if problems != shown:
+                    for problem in problems:
+                        logging.info(f"ℹ️ {problem}")
+                    shown= problems
+            sleep(FAST_LOOP_TIME)
+            self.poll()
+
+
+def init_commands(init: dict) -> dict:
+    """
+    Commands setting up the pico for a measurement, grouped by parameter
+    Arguments:
+        - dictionnary containing the measurement setup, None for the standby setup
+    Returns:
+        - dictionnary {parameter: tuple of command lines}, in the order they are sent
+    """
     if init is None:
         init= STANDBY
 
+    commands= {}
     #Initialize offsets and sampling
     for par in ['voffset','sampling']:
-        safe_write(ser, f"set {par} {init[par]}")
+        commands[par]= (f"set {par} {init[par]}",)
+    # Means of the measurements between two frames instead of the last ones
+    commands['aggregate']= (f"set aggregate {1 if init.get('aggregate') else 0}",)
+    # Device log messages streamed as LOG events, up to the requested level
+    if init.get('log'):
+        commands['log']= (f"log level {init['log']}", "log stream 1")
+    else:
+        commands['log']= ("log stream 0",)
+
+    # Back to the default stream, subscribe_channels() narrows it (DeviceSession.configure() sets each channel instead)
+    commands['subscribe']= ("subscribe",)
 
     #Initialize channels
     for ch in init['channels']:
-        # Send the regulation mode (voltage / current)
-        safe_write(ser, f"{ch['Name']} {ch['control']}")
-        
-        # Send the initial setpoint value
-        if 'initvalue' in ch.keys():
-            safe_write(ser, f"{ch['Name']} {ch['initvalue']}")
-        else:
-            safe_write(ser, f"{ch['Name']} 0")
-        
-        # Send the power limit if available
-        if 'max power' in ch.keys():
-            safe_write(ser, f"{ch['Name']} {ch['max power']}w")
-        else:
-            safe_write(ser, f"{ch['Name']} 1w")
+        # The regulation mode (voltage / current)
+        commands[f"{ch['Name']} mode"]= (f"{ch['Name']} {ch['control']}",)
+        # The initial setpoint value
+        commands[f"{ch['Name']} setpoint"]= (f"{ch['Name']} {ch.get('initvalue', 0)}",)
+        # The power limit if available
+        commands[f"{ch['Name']} power"]= (f"{ch['Name']} {ch.get('max power', 1)}w",)
+    return commands
+
+
+def mode_activity(name: str, control: str) -> tuple:
+    """
+    Activity request a regulation mode command leaves on the pico: monitored in 'nc' mode,
+    otherwise following the push-pull switch
+    """
+    return (f"activity {name} {'monitor' if control == 'nc' else 'auto'}",)
+
 
+def initialize_channels(init: dict, ser: serial.Serial) -> None:
+    logging.info("ℹ️ Initializing channels and time settings...")
+    for lines in init_commands(init).values():
+        for line in lines:
+            safe_write(ser, line)
+
+
+def reset_integrals(ser: serial.Serial) -> None:
+    """Restart the charge and energy integration of all channels"""
+    safe_write(ser, "integral reset")
+
+
+def read_integrals(ser: serial.Serial, names: list) -> dict:
+    """
+    Query the charge and energy integrated by the pico since the last reset
+    Telemetry and events received meanwhile are dropped
+    Returns:
+        - dictionnary {channel name: {'charge_mAh', 'energy_mWh', 'time_s'}}, without the channels that did not answer
+    """
+    integrals= {}
+    for name in names:
+        safe_write(ser, f"integral {name}")
+        line= wait_for_line(ser, f"INTEGRAL {name} ")
+        if line is None:
+            logging.warning(f"⚠ No charge and energy received for channel {name}")
+            continue
+        parts= line.split(' ')
+        integrals[name]= {
+            'charge_mAh': parse_value(parts[2]),
+            'energy_mWh': parse_value(parts[3]),
+            'time_s': parse_value(parts[4])
+        }
+    return integrals
+
+
+def log_device_message(parts: list) -> None:
+    """
+    Forward a LOG or LOGEND line of the pico to the host log
+
+    Arguments:
+        - space-separated words of the line, the message type first:
+          LOG <ticks_ms> <level> <message> or LOGEND <lost>
+    """
+    if parts[0] == 'LOGEND':
+        if int(parts[1]):
+            logging.warning(f"⚠ {parts[1]} device log messages lost")
+        return
+    level= DEVICE_LOG_LEVELS.get(parts[2], logging.INFO)
+    logging.log(level, f"Pico [{parts[1]} ms] {' '.join(parts[3:])}")
+
+
+def log_device_messages(events: list) -> None:
+    """Forward the LOG and LOGEND events of a run to the host log, in their order"""
+    for event in events:
+        parts= event.split(' ')
+        if parts[0] in ('LOG', 'LOGEND') and len(parts) > 1:
+            log_device_message(parts)
+
+
+def settling_summary(events: list) -> dict:
+    """
+    Settling times of the SETTLED events, grouped by regulation start: 'ff' (feedforward lookup) or 'pid'
+    Returns:
+        - dictionnary {mode: {'count', 'timeouts', 'mean_ms', 'max_ms'}}
+    """
+    times= {}
+    for event in events:
+        parts= event.split(' ')
+        if parts[0] == 'SETTLED' and len(parts) >= 4:
+            times.setdefault(parts[3], []).append(None if parts[2] == 'timeout' else int(parts[2]))
+    summary= {}
+    for mode, values in times.items():
+        settled= [t for t in values if t is not None]
+        summary[mode]= {
+            'count': len(values),
+            'timeouts': len(values) - len(settled),
+            'mean_ms': sum(settled)/len(settled) if settled else None,
+            'max_ms': max(settled) if settled else None
+        }
+    return summary
+
+
+def stream_fields(ch: dict, plots: list) -> str:
+    """
+    Fields of a channel to subscribe to: the 'stream' option if given,
+    nothing for a 'nc' channel that no plot uses, current and voltage otherwise
+    """
+    if 'stream' in ch:
+        return ch['stream']
+    if ch['control'] == 'nc':
+        used= set()
+        for plot in plots:
+            y= plot['y'] if isinstance(plot['y'], list) else [plot['y']]
+            used.update([plot['x']] + y)
+        if f"i{ch['Name']}" not in used and f"v{ch['Name']}" not in used:
+            return '-'
+    return DEFAULT_STREAM_FIELDS
+
+
+def subscribe_channels(ser: serial.Serial, init: dict, plots: list = None) -> None:
+    """
+    Only stream the channels and fields the characterization needs,
+    the 'nc' channels streaming nothing are parked: the pico neither reads nor regulates them
+    Arguments:
+        - serial connection to communicate with the board
+        - dictionnary containing the measurement setup
+        - list of plots of the characterization
+    """
+    for ch in init['channels']:
+        fields= stream_fields(ch, plots or [])
+        if fields != DEFAULT_STREAM_FIELDS:
+            safe_write(ser, f"subscribe {ch['Name']} {fields}")
+        if fields == '-' and ch['control'] == 'nc':
+            safe_write(ser, f"activity {ch['Name']} parked")
 
 
 def safe_write(ser: serial.Serial, cmd: str) -> None:
@@ -168,7 +662,40 @@ def safe_write(ser: serial.Serial, cmd: str) -> None:
     sleep(WRITE_DELAY)
 
 
-async def run_sweep(sweep: dict, ser: serial.Serial) -> bool:
+def highest_setpoint(carac: dict, name: str) -> float:
+    """
+    Highest setpoint a characterization applies to a channel: its initial value,
+    the values of the sweeps and nested sweeps of the channel and the level of its pulses
+    """
+    setpoints= [0]
+    for ch in carac['init']['channels']:
+        if ch['Name'] == name:
+            setpoints.append(ch.get('initvalue', 0))
+    sweep= carac.get('sweep')
+    while sweep is not None:
+        if sweep['channel'] == name:
+            if 'values' in sweep:
+                values= sweep['values']
+                setpoints.extend(float(v) for v in (values.split(' ') if isinstance(values, str) else values))
+            else:
+                setpoints.extend((sweep['start'], sweep['stop']))
+        sweep= sweep.get('sweep')
+    pulsed= carac.get('pulsed')
+    if pulsed is not None and pulsed['channel'] == name:
+        setpoints.append(pulsed.get('setpoint', 0))
+    return max(setpoints)
+
+
+def pulse_command(pulsed: dict, sp: float) -> str:
+    """Command applying the setpoint sp as pulses, with the timing of a pulsed block"""
+    return f"pulse {pulsed['channel']} {sp} {pulsed['width']} {pulsed['delay']} {pulsed['period']}"
+
+
+async def run_sweep(sweep: dict, ser: serial.Serial, pulsed: dict = None) -> bool:
+    """
+    Apply the setpoints of a sweep, and of its nested sweeps, for timestep seconds each
+    The setpoints of the channel of the pulsed block, if any, are applied as pulses
+    """
     ch= sweep['channel']
     dt= sweep['timestep']
     logging.info(f"ℹ️ Running channel {ch} sweep with config: {sweep}")
@@ -181,13 +708,16 @@ async def run_sweep(sweep: dict, ser: serial.Serial) -> bool:
         logging.info(f"ℹ️ Setting channel {ch} setpoint to: {sp}")
         
         # Prepare command to send to Pico
-        safe_write(ser,f"{ch} {sp}")
+        if pulsed is not None and pulsed['channel'] == ch:
+            safe_write(ser, pulse_command(pulsed, sp))
+        else:
+            safe_write(ser,f"{ch} {sp}")
 
         await asyncio.sleep(dt)
 
         # Run another nested sweeps if defined
         if 'sweep' in sweep:
-            await run_sweep(sweep['sweep'], ser)
+            await run_sweep(sweep['sweep'], ser, pulsed)
     logging.info(f"✓ Completed sweep for channel {ch}")
     return True
 
@@ -195,72 +725,269 @@ async def run_sweep(sweep: dict, ser: serial.Serial) -> bool:
 def read_serial_values(ser: serial.Serial, events: list, channels: list)-> None:
     """
     This function reads serial port incoming messages
-    If the message contains a row with datapoints, it parses and appends it to each channel data buffers
-    If a calib file is available, it will apply the corrections
-    If the message contains something else than datapoints, it appends it to the events list
+    The lines already received are read at once, up to MAX_LINES_PER_READ
+    If a line contains a row with datapoints, it parses and appends it to each channel data buffers
+    Raw register counts are converted for the whole batch of lines in one go
+    If a calib file is available, its corrections are applied to the whole batch as well
+    If a line contains something else than datapoints, it appends it to the events list
 
     Arguments:
         - Serial port connection
         - Event list that to be updated
         - List of channels dictionnaries
     """
-    if ser.in_waiting > 0:
+    # The serial broker sends values already parsed
+    if hasattr(ser, 'read_values'):
+        ser.read_values(events, channels)
+        return
+
+    raw= {} # channel name -> rows of raw counts waiting for conversion
+    calib= {} # channel name -> currents waiting for the calibration
+    lines= 0
+    while ser.in_waiting > 0 and lines < MAX_LINES_PER_READ:
         line = ser.readline().decode('utf-8').strip()
         logging.debug(f"Received from Pico: {line}")
-        
-        # Parse the line into a dataframe
-        try:
-            parts = line.split(' ')
-            expected_tokens = 3 * len(channels) + 1
-            # If a line don't have the expected number of elements, then it's an event
-            if len(parts) != expected_tokens:
-                logging.debug(f"Recieved event {line}")
-                events.append(line)
-            
+        parse_serial_line(line, events, channels, raw, calib)
+        lines+= 1
+
+    for ch in channels:
+        if ch['Name'] in raw:
+            store_raw_values(ch, raw[ch['Name']])
+        if ch['Name'] in calib:
+            store_calibrated_values(ch, calib[ch['Name']])
+
+
+def parse_serial_line(line: str, events: list, channels: list, raw: dict, calib: dict = None)-> None:
+    """
+    Parse one line: events are appended to the events list, datapoints to the channels data buffers
+    Channels streamed as raw counts get nan placeholders, their counts are added to the raw dictionnary
+    The currents of calibrated channels are stored as measured, and added to the calib dictionnary
+    to be corrected with the rest of the batch (see store_calibrated_values())
+
+    Arguments:
+        - Received line
+        - Event list that to be updated
+        - List of channels dictionnaries
+        - Dictionnary of the raw counts rows per channel name
+        - Dictionnary of the currents waiting for the calibration per channel name, None to correct them right away
+    """
+    pending= {} if calib is None else calib
+    # Parse the line into a dataframe
+    try:
+        tag, _, payload= line.partition(' ')
+        # Telemetry frames are tagged, everything else is an event
+        if tag != DATA_TAG:
+            logging.debug(f"Recieved event {line}")
+            events.append(line)
+            return
+        parts = payload.split(' ')
+        seq= int(parts[0])
+        t= float(parts[1])
+
+        # Then, parse the subscribed channels: <name>:<fields> <values>...
+        values= {}
+        pos= 2
+        while pos < len(parts):
+            name, fields= parts[pos].split(':')
+            values[name]= dict(zip(fields, parts[pos+1:pos+1+len(fields)]))
+            pos+= 1+len(fields)
+
+        missed= 0
+        for ch in channels:
+            logging.debug(f"Parsing channel {ch['Name']}")
+            missed= mark_gap(ch, seq)
+            chvalues= values.get(ch['Name'], {})
+            if 'u' in chvalues and 'b' in chvalues:
+                # Raw counts, converted later with the rest of the batch
+                raw.setdefault(ch['Name'], []).append((len(ch['IData']),
+                    parse_value(chvalues.get('r')), parse_value(chvalues['u']), parse_value(chvalues['b'])))
+                i= v= float('nan')
             else:
-                # Get  the raspberry pico time from the first chunk
-                t= float(parts[0])
-
-                # Then, parse the channels
-                for n, ch in enumerate(channels):
-                    logging.debug(f"Parsing channel {ch['Name']}")
-                    try:
-                        i = parts[3*n + 2]
-                        if i != 'None':
-                            i= float(i)
-                        else: # This happens when switching range
-                            i = float('nan')
-                    except Exception as e:
-                        logging.error(f"Error parsing current for channel {ch['Name']}: {e}")
-                        i = float('nan')
-                    try:
-                        v = parts[3*n + 3]
-                        if v != 'None':
-                            v= float(v)
-                        else: # not supposed to happen
-                            v = float('nan')
-                    except Exception as e:
-                        logging.error(f"Error parsing voltage for channel {ch['Name']}: {e}")
-                        v = float('nan')
-
-                    # Apply current offset corrections
-                    try:
-                        if ch.get('ioffset') is not None:
-                            df = ch['ioffset']
-                            i_interp = np.interp(v, df['v'].values, df['i'].values, left=0, right=0)
-                            i -= i_interp
-                            i *= ch.get('icoef', 1)
-                    except Exception as e:
-                        logging.error(f"✗ Error while correcting current values: {e}")
-
-                    ch['IData'].append(i)
-                    ch['VData'].append(v)
-                    ch['TData'].append(t)
+                i= parse_value(chvalues.get('i')) # None happens when switching range
+                v= parse_value(chvalues.get('v'))
+                if ch.get('ioffset') is not None and i is not None and v is not None:
+                    pending.setdefault(ch['Name'], []).append(('IData', len(ch['IData']), v))
+
+            # Unsubscribed current and voltage are stored as nan to keep the time series aligned
+            ch['IData'].append(i)
+            ch['VData'].append(v)
+            ch['TData'].append(t)
+            for field, value in chvalues.items():
+                if field in EXTRA_FIELDS:
+                    x= parse_value(value)
+                    data= ch.setdefault(EXTRA_FIELDS[field], [])
+                    if field in CURRENT_FIELDS and ch.get('ioffset') is not None and x is not None and v is not None:
+                        pending.setdefault(ch['Name'], []).append((EXTRA_FIELDS[field], len(data), v))
+                    data.append(x)
+        if missed:
+            logging.warning(f"⚠ {missed} telemetry frames missed before frame {seq}")
+        if calib is None:
+            for ch in channels:
+                if ch['Name'] in pending:
+                    store_calibrated_values(ch, pending[ch['Name']])
+
+    except Exception as e:
+        logging.error(f"✗ Error parsing line: {e}")
+        logging.error(f"✗ Line content: {line}")
+
+
+def convert_raw_counts(ranges, shunt_counts, bus_counts, ioffset: tuple = None, icoef: float = 1):
+    """
+    Convert INA3221 register counts to currents and voltages, on whole arrays
+
+    Arguments:
+        - ammeter range of each sample (nan if unknown)
+        - shunt voltage register counts
+        - bus voltage register counts
+        - calibration offset table (voltages, currents), if any
+        - calibration current coefficient
+    Returns:
+        - currents in mA and voltages in V, as numpy arrays
+    """
+    import numpy as np
+    ranges= np.asarray(ranges, dtype=float)
+    valid= np.isfinite(ranges) & (ranges >= 0) & (ranges < len(SHUNTS))
+    rshunt= np.full(ranges.shape, np.nan)
+    rshunt[valid]= np.asarray(SHUNTS)[ranges[valid].astype(int)]
+
+    v= np.asarray(bus_counts, dtype=float)*BUS_LSB_V
+    i= np.asarray(shunt_counts, dtype=float)*SHUNT_LSB_MA/rshunt
+    if ioffset is not None:
+        i= correct_currents(i, v, ioffset, icoef)
+    return i, v
+
+
+def correct_currents(i, v, ioffset: tuple, icoef: float = 1):
+    """
+    Apply a calibration to arrays of currents in mA measured at the voltages v
+    Returns the corrected currents as a numpy array
+    """
+    import numpy as np
+    voff, ioff= ioffset
+    v= np.asarray(v, dtype=float)
+    return (np.asarray(i, dtype=float) - np.interp(v, voff, ioff, left=0, right=0))*icoef
+
+
+def store_raw_values(ch: dict, rows: list)-> None:
+    """
+    Replace the placeholders of a channel data buffers with its converted raw counts
+
+    Arguments:
+        - channel dictionnary
+        - rows of (buffer index, range, shunt counts, bus counts)
+    """
+    try:
+        index, ranges, shunts, buses= zip(*rows)
+        i, v= convert_raw_counts(ranges, shunts, buses, ch.get('ioffset'), ch.get('icoef', 1))
+        for n, k in enumerate(index):
+            ch['IData'][k]= float(i[n])
+            ch['VData'][k]= float(v[n])
+    except Exception as e:
+        logging.error(f"✗ Error while converting raw values of channel {ch['Name']}: {e}")
+
+
+def store_calibrated_values(ch: dict, rows: list)-> None:
+    """
+    Apply the current calibration of a channel to the values stored as measured, one buffer at a time
+
+    Arguments:
+        - channel dictionnary
+        - rows of (buffer name, index in the buffer, voltage of the sample)
+    """
+    try:
+        buffers= {}
+        for key, k, v in rows:
+            buffers.setdefault(key, []).append((k, v))
+        for key, items in buffers.items():
+            index, v= zip(*items)
+            data= ch[key]
+            i= correct_currents([data[k] for k in index], v, ch['ioffset'], ch.get('icoef', 1))
+            for n, k in enumerate(index):
+                data[k]= float(i[n])
+    except Exception as e:
+        logging.error(f"✗ Error while correcting the current values of channel {ch['Name']}: {e}")
+
+
+def mark_gap(ch: dict, seq: int) -> int:
+    """
+    Store the number of the frame of a new sample and the number of frames missed since the previous one,
+    in the SeqData and GapData buffers of the channel. The total is accumulated in ch['Gaps']
+    Returns the number of missed frames
+    """
+    last= ch.get('LastSeq')
+    missed= 0 if last is None else (seq - last - 1) % SEQ_MODULO
+    ch['LastSeq']= seq
+    ch.setdefault('SeqData', []).append(seq)
+    ch.setdefault('GapData', []).append(missed)
+    if missed:
+        ch['Gaps']= ch.get('Gaps', 0) + missed
+    return missed
+
+
+def dispatch_event(event: str, handlers: dict) -> bool:
+    """
+    Call the handler registered for the type of an event
+
+    Arguments:
+        - event line received from the pico
+        - dictionnary of handlers keyed by message type, called with the space-separated
+          words of the event, the message type first
+    Returns:
+        - True if a handler processed the event
+    """
+    parts= event.split(' ')
+    handler= handlers.get(parts[0])
+    if handler is None:
+        logging.debug(f"Unhandled event {event}")
+        return False
+    try:
+        handler(parts)
+    except Exception as e:
+        logging.error(f"✗ Error handling event {event}: {e}")
+    return True
+
+
+def collect_capture(parts: list, pending: dict):
+    """
+    Assemble a transient capture from its CAPTURE, CAPDATA and CAPEND lines (see upload_captures in main.py)
+
+    Arguments:
+        - space-separated words of the line, the message type first
+        - dictionnary of the captures being received, keyed by channel name
+    Returns:
+        - on CAPEND, the capture {'Name', 'Reason', 'Period', 'TData', 'IData', 'VData'}
+          with times in seconds from the trigger and uncalibrated currents in mA, None otherwise
+    """
+    tag, name= parts[0], parts[1]
+    if tag == 'CAPTURE':
+        pending[name]= {'Name': name, 'Reason': parts[2], 'Period': int(parts[4])*1e-3,
+                        'TData': [], 'IData': [], 'VData': []}
+        return None
+    capture= pending.get(name)
+    if capture is None:
+        logging.warning(f"⚠ {tag} received without the capture header of channel {name}")
+        return None
+    if tag == 'CAPDATA':
+        for sample in parts[2:]:
+            t, i, v= sample.split(',')
+            capture['TData'].append(int(t)*1e-3)
+            capture['IData'].append(parse_value(i))
+            capture['VData'].append(parse_value(v))
+        return None
+    del pending[name]
+    return capture
+
+
+def parse_value(value: str) -> float:
+    """Convert a telemetry value to float, missing and None values give nan"""
+    if value is None or value == 'None':
+        return float('nan')
+    try:
+        return float(value)
+    except ValueError:
+        logging.error(f"Error parsing value {value}")
+        return float('nan')
 
-        except Exception as e:
-            logging.error(f"✗ Error parsing line: {e}")
-            logging.error(f"✗ Line content: {line}")
-                   
 
 async def read_serial_loop(ser: serial.Serial, events: list, channels: list) -> None:
     """
@@ -0,0 +1,53 @@
+"""
+Import time profiling for the entry points (--profile-startup option)
+Times are cumulative: a module time includes the modules it imports itself
+"""
+import sys
+import builtins
+from time import perf_counter
+
+import logging
+# ✓ ✗ ⚠ ℹ️ ⏳
+
+
+_original_import= builtins.__import__
+_timings= {} # module name -> first import duration in seconds
+_start= None
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # Only time the first absolute import of a module, later ones are sys.modules lookups
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    t0= perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _timings.setdefault(name, perf_counter() - t0)
+
+
+def enable()-> None:
+    """Start timing module imports"""
+    global _start
+    _start= perf_counter()
+    builtins.__import__= _timed_import
+
+
+def enabled_from_argv()-> bool:
+    """Enable the profiling if --profile-startup is on the command line"""
+    if '--profile-startup' in sys.argv:
+        enable()
+        return True
+    return False
+
+
+def report(top: int = 20)-> None:
+    """Log the slowest imports and the time elapsed since profiling started"""
+    if _start is None:
+        return
+    elapsed= perf_counter() - _start
+    logging.info(f"ℹ️ Startup took {elapsed*1e3:.1f} ms, slowest imports (cumulative):")
+    # Keep top-level packages only, submodules are included in their parent time
+    roots= {n: t for n, t in _timings.items() if n.split('.')[0] == n or n.split('.')[0] not in _timings}
+    for name, t in sorted(roots.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        logging.info(f"\t{t*1e3:8.1f} ms  {name}")
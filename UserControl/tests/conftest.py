@@ -0,0 +1,5 @@
+"""The host modules are imported from the UserControl folder"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
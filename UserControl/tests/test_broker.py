@@ -0,0 +1,78 @@
+import json
+import asyncio
+
+import broker
+
+
+class FakeSerial:
+    """Pico link replaying the given lines, and recording the written ones"""
+
+    def __init__(self):
+        self.lines= []
+        self.written= []
+
+    def receive(self, lines: list) -> None:
+        self.lines.extend(f"{line}\n".encode('utf-8') for line in lines)
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.lines)
+
+    def readline(self) -> bytes:
+        return self.lines.pop(0)
+
+    def write(self, data: bytes) -> None:
+        self.written.append(data.decode('utf-8'))
+
+    def flush(self) -> None:
+        pass
+
+
+def test_take_batch_empties_the_buffers():
+    ch= {'Name': 'a', 'TData': [0.1], 'IData': [1.0], 'VData': [2.0], 'SeqData': [3]}
+    idle= {'Name': 'b', 'TData': [], 'IData': [], 'VData': []}
+    assert broker.take_batch([ch, idle]) == {'a': {'TData': [0.1], 'IData': [1.0], 'VData': [2.0], 'SeqData': [3]}}
+    assert ch['TData'] == [] and ch['SeqData'] == []
+
+
+def test_subscriber_drops_the_oldest_batches_first():
+    async def run():
+        sub= broker.Subscriber(writer=None)
+        for n in range(broker.MAX_PENDING_BATCHES + 2):
+            sub.publish({'type': 'data', 'channels': {'n': n}})
+        sub.publish({'type': 'event', 'line': 'RANGE 1'})
+        return sub
+    sub= asyncio.run(run())
+    assert sub.dropped == 2
+    assert sub.batches[0]['channels'] == {'n': 2}
+    assert list(sub.events) == [{'type': 'event', 'line': 'RANGE 1'}]
+
+
+def test_broker_relays_lines_both_ways(tmp_path):
+    address= str(tmp_path / 'broker.sock')
+    ser= FakeSerial()
+
+    async def run():
+        server= asyncio.create_task(broker.serve(ser, address, ['a']))
+        while not (tmp_path / 'broker.sock').exists():
+            await asyncio.sleep(0.01)
+        reader, writer= await asyncio.open_unix_connection(address)
+        writer.write(b"a 1.2\nset baud 9600\n")
+        await writer.drain()
+        # The lines of the pico are only published to the clients already connected
+        while not ser.written:
+            await asyncio.sleep(0.01)
+        ser.receive(["RANGE 2", "D 1 0.5 a:iv 1.5 2.5"])
+        messages= [json.loads(await reader.readline()) for _ in range(3)]
+        writer.close()
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+        return messages
+
+    messages= asyncio.run(asyncio.wait_for(run(), 5))
+    assert {'type': 'event', 'line': 'RANGE 2'} in messages
+    assert {'type': 'event', 'line': 'BROKER refused set baud 9600'} in messages
+    data= [m for m in messages if m['type'] == 'data']
+    assert data[0]['channels']['a']['IData'] == [1.5]
+    assert data[0]['channels']['a']['SeqData'] == [1]
+    assert ser.written == ["a 1.2\n"]
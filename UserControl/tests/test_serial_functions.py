@@ -0,0 +1,143 @@
+import math
+
+import pytest
+
+import serial_functions as serfn
+
+
+def new_channel(name: str, **extra) -> dict:
+    return {'Name': name, 'IData': [], 'VData': [], 'TData': [], **extra}
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Lines sent to the pico, without the write delay"""
+    lines= []
+    monkeypatch.setattr(serfn, 'safe_write', lambda ser, cmd: lines.append(cmd))
+    return lines
+
+
+# mark_gap
+
+def test_mark_gap_counts_missed_frames():
+    ch= new_channel('a')
+    assert serfn.mark_gap(ch, 10) == 0
+    assert serfn.mark_gap(ch, 11) == 0
+    assert serfn.mark_gap(ch, 15) == 3
+    assert ch['SeqData'] == [10, 11, 15]
+    assert ch['GapData'] == [0, 0, 3]
+    assert ch['Gaps'] == 3
+
+
+def test_mark_gap_wraps_around_the_frame_counter():
+    ch= new_channel('a')
+    serfn.mark_gap(ch, serfn.SEQ_MODULO - 2)
+    assert serfn.mark_gap(ch, 1) == 2
+    assert ch['Gaps'] == 2
+
+
+# convert_raw_counts
+
+def test_convert_raw_counts_per_range():
+    i, v= serfn.convert_raw_counts([0, 1, 4], [8000, 8000, 8000], [1000, 2000, 4000])
+    assert list(v) == pytest.approx([1, 2, 4])
+    assert list(i) == pytest.approx([8000*serfn.SHUNT_LSB_MA/r for r in (0.1, 1, 1000)])
+
+
+def test_convert_raw_counts_unknown_range_is_nan():
+    i, v= serfn.convert_raw_counts([float('nan'), 5, -1], [1, 1, 1], [8, 8, 8])
+    assert all(math.isnan(x) for x in i)
+    assert list(v) == pytest.approx([8*serfn.BUS_LSB_V]*3)
+
+
+def test_convert_raw_counts_applies_the_calibration():
+    ioffset= ([0, 10], [0.1, 0.1])
+    i, _= serfn.convert_raw_counts([1], [8000], [1000], ioffset, 2)
+    assert i[0] == pytest.approx((8000*serfn.SHUNT_LSB_MA - 0.1)*2)
+
+
+# parse_serial_line
+
+def test_parse_serial_line_events_are_tagged_apart():
+    events= []
+    channels= [new_channel('a')]
+    for line in ("RANGE 2", "SETTLED a 120 ff 1.5", "Data without tag"):
+        serfn.parse_serial_line(line, events, channels, {})
+    assert events == ["RANGE 2", "SETTLED a 120 ff 1.5", "Data without tag"]
+    assert channels[0]['TData'] == []
+
+
+def test_parse_serial_line_stores_the_subscribed_fields():
+    events= []
+    a, b= new_channel('a'), new_channel('b')
+    serfn.parse_serial_line("D 7 0.5 a:ivd 1.5 2.5 30000", events, [a, b], {})
+    assert events == []
+    assert (a['IData'], a['VData'], a['TData'], a['DutyData']) == ([1.5], [2.5], [0.5], [30000])
+    assert a['SeqData'] == [7]
+    # Unsubscribed channels keep aligned time series
+    assert b['TData'] == [0.5] and math.isnan(b['IData'][0])
+
+
+def test_parse_serial_line_queues_raw_counts():
+    raw= {}
+    a= new_channel('a')
+    serfn.parse_serial_line("D 1 0.1 a:rub 1 8000 1000", [], [a], raw)
+    assert math.isnan(a['IData'][0]) and math.isnan(a['VData'][0])
+    assert raw == {'a': [(0, 1, 8000, 1000)]}
+    serfn.store_raw_values(a, raw['a'])
+    assert a['VData'] == pytest.approx([1])
+    assert a['IData'] == pytest.approx([8000*serfn.SHUNT_LSB_MA])
+
+
+def test_parse_serial_line_calibrates_once_per_batch():
+    a= new_channel('a', ioffset=([0, 10], [0.2, 0.2]), icoef=1)
+    calib= {}
+    serfn.parse_serial_line("D 1 0.1 a:ivj 1 5 0.5", [], [a], {}, calib)
+    serfn.parse_serial_line("D 2 0.2 a:ivj 3 5 0.5", [], [a], {}, calib)
+    # Stored as measured until the batch is corrected
+    assert a['IData'] == [1, 3]
+    serfn.store_calibrated_values(a, calib['a'])
+    assert a['IData'] == pytest.approx([0.8, 2.8])
+    assert a['IMinData'] == pytest.approx([0.3, 0.3])
+
+
+# DeviceSession.configure
+
+INIT= {'voffset': 0, 'sampling': 10,
+       'channels': [{'Name': 'a', 'control': 'v'}, {'Name': 'b', 'control': 'nc'}, {'Name': 'c', 'control': 'i'}]}
+
+
+def test_configure_sends_only_the_changes(written):
+    session= serfn.DeviceSession(None)
+    session.assume(None)
+    session.configure(INIT)
+    assert "set sampling 10" in written
+    assert "b nc" in written and "c i" in written
+    assert "a v" not in written
+
+    written.clear()
+    assert session.configure(INIT) == 0
+    assert written == []
+
+
+def test_configure_parks_and_unparks_the_unused_nc_channels(written):
+    session= serfn.DeviceSession(None)
+    session.assume(INIT)
+    session.configure(INIT)
+    assert written == ["subscribe b -", "activity b parked"]
+
+    # Plotted again, the channel is streamed and monitored
+    written.clear()
+    session.configure(INIT, [{'name': 'p', 'x': 't', 'y': 'vb', 'xlabel': 't', 'ylabel': 'v'}])
+    assert written == ["subscribe b iv", "activity b monitor"]
+
+
+def test_configure_puts_the_unlisted_channels_in_standby(written):
+    session= serfn.DeviceSession(None)
+    session.assume(INIT)
+    init= {**INIT, 'channels': INIT['channels'][:1]}
+    session.configure(init)
+    # b and c are back to the voltage mode of the standby setup, their mode change resets the activity
+    assert "b v" in written and "c v" in written
+    assert "activity b auto" not in written
+    assert session.sent["b activity"] == ("activity b auto",)